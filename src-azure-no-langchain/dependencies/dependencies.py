@@ -9,6 +9,7 @@ from azure.search.documents.models import Vector
 from uuid import uuid4
 
 from dependencies.docprocessing import DocProcessing
+from dependencies.embeddingcache import EmbeddingCache
 from dependencies.logger import logger
 from settings import Credentials
 
@@ -178,7 +179,20 @@ class Dependencies:
         n_tokens = [DocProcessing.count_tokens(text) for text in texts]
         weights = [x / sum(n_tokens) for x in n_tokens]
 
-        embeddings = [self.embed_text_chunk(text) for text in texts]
+        # unchanged chunks are not embedded again, see EmbeddingCache
+        model = self.credentials.OpenAIEmbedding
+        embeddings = EmbeddingCache.get_many(model, texts)
+        hits = sum(x is not None for x in embeddings)
+        missing = [i for i, x in enumerate(embeddings) if x is None]
+        for i in missing:  # one API call per chunk, a hit saves one
+            embeddings[i] = self.embed_text_chunk(texts[i])
+        EmbeddingCache.set_many(
+            model, [texts[i] for i in missing], [embeddings[i] for i in missing]  # noqa: E501
+        )
+        logger.info(
+            f"Embedded {len(texts)} chunks, {hits} from cache "
+            f"(hit rate {hits / max(len(texts), 1):.2f}, {hits} API calls saved)"  # noqa: E501
+        )
         if adjust_weight and len(texts) > 1:
             # weighting and normalization NOT necessary
             # if chunked less than max token
@@ -19,6 +19,61 @@ class DocProcessing:
             return tokenized
         return len(tokenized)
 
+    @staticmethod
+    def overlap(previous: str, text: str, min_chars=20, max_chars=400):
+        """length of the longest suffix of previous that starts text"""
+        for size in range(min(len(previous), len(text), max_chars), min_chars - 1, -1):  # noqa: E501
+            if previous.endswith(text[:size]):
+                return size
+        return 0
+
+    @staticmethod
+    def pack_context(
+        chunks: list,
+        max_tokens: int = 3000,
+        text_key: str = "Content",
+        source_key: str = "SourceId",
+        tokens_key: str = "TokenCount",
+        duplicate_similarity: float = 0.8,
+    ):
+        """
+        search results in relevance order, packed into max_tokens:
+        overlapping sentences shared with a packed chunk of the same source
+        are cut, near-duplicates (word shingles) dropped, chunks that do not
+        fit skipped. returns (packed chunks, raw tokens, packed tokens)
+        """
+        def shingles(text):
+            words = text.lower().split()
+            return {" ".join(words[i:i+3]) for i in range(max(len(words) - 2, 1))}  # noqa: E501
+
+        packed, seen, by_source = [], [], {}
+        raw_tokens, packed_tokens = 0, 0
+        for chunk in chunks:
+            text = chunk[text_key]
+            n_tokens = chunk.get(tokens_key) or DocProcessing.count_tokens(text)  # noqa: E501
+            raw_tokens += n_tokens
+
+            words = shingles(text)
+            if any(len(words & x) / len(words | x) >= duplicate_similarity for x in seen):  # noqa: E501
+                continue
+
+            trimmed = text
+            for other in by_source.get(chunk.get(source_key), []):
+                trimmed = trimmed[DocProcessing.overlap(other, trimmed):]
+                trimmed = trimmed[:len(trimmed) - DocProcessing.overlap(trimmed, other)]  # noqa: E501
+            if trimmed != text:
+                n_tokens = DocProcessing.count_tokens(trimmed)
+            if not trimmed.strip() or packed_tokens + n_tokens > max_tokens:
+                continue
+
+            seen.append(words)
+            by_source.setdefault(chunk.get(source_key), []).append(text)
+            packed.append({**chunk, text_key: trimmed})
+            packed_tokens += n_tokens
+
+        logger.debug(f"context packed from {raw_tokens} to {packed_tokens} tokens, {len(packed)} of {len(chunks)} chunks")  # noqa: E501
+        return packed, raw_tokens, packed_tokens
+
     @staticmethod
     def split_to_sentences(text: str):
         """
@@ -0,0 +1,77 @@
+# Yan Pan, 2023
+import numpy as np
+from hashlib import sha256
+from sqlite3 import connect
+
+from dependencies.logger import logger
+from settings import Configs
+
+
+class EmbeddingCache:
+    """
+    chunk vectors keyed by sha256 of (embedding deployment, text),
+    float32 in a local sqlite file (config_embedding_cache, empty disables)
+    re-uploading a document only embeds the chunks that changed
+    """
+
+    MAX_KEYS = 500  # per SELECT, below the sqlite variable limit
+
+    @staticmethod
+    def key(model: str, text: str) -> bytes:
+        return sha256(f"{model}\0{text}".encode()).digest()
+
+    @staticmethod
+    def __connect():
+        conn = connect(Configs().embedding_cache, timeout=5)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_embeddings "
+            "(key BLOB PRIMARY KEY, vector BLOB)"
+        )
+        return conn
+
+    @staticmethod
+    def get_many(model: str, texts: list) -> list:
+        """cached vector or None for each text"""
+        if not Configs().embedding_cache or not texts:
+            return [None for _ in texts]
+        keys = [EmbeddingCache.key(model, x) for x in texts]
+        rows = {}
+        try:
+            conn = EmbeddingCache.__connect()
+            try:
+                for i in range(0, len(keys), EmbeddingCache.MAX_KEYS):
+                    part = keys[i:i + EmbeddingCache.MAX_KEYS]
+                    rows.update(conn.execute(
+                        f"SELECT key, vector FROM chunk_embeddings WHERE key IN ({','.join('?' * len(part))})",  # noqa: E501
+                        part,
+                    ).fetchall())
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"embedding cache not readable: {e}")
+            return [None for _ in texts]
+        return [
+            np.frombuffer(rows[x], dtype=np.float32).tolist() if x in rows else None  # noqa: E501
+            for x in keys
+        ]
+
+    @staticmethod
+    def set_many(model: str, texts: list, vectors: list):
+        if not Configs().embedding_cache or not texts:
+            return None
+        try:
+            conn = EmbeddingCache.__connect()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO chunk_embeddings VALUES (?, ?)",
+                        [
+                            (EmbeddingCache.key(model, x), np.asarray(y, dtype=np.float32).tobytes())  # noqa: E501
+                            for x, y in zip(texts, vectors)
+                        ],
+                    )
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"embedding cache not writable: {e}")
+        return None
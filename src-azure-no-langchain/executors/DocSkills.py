@@ -46,6 +46,10 @@ class DocSkills:
             query=query,
             filter=self.__docIds_to_filer_str(docIds),
         )
+        search_results, raw_tokens, packed_tokens = DocProcessing.pack_context(
+            search_results, max_tokens=Configs().context_tokens
+        )
+        yield f"> [function] I packed the context to {packed_tokens} of {raw_tokens} tokens [packed-tokens={packed_tokens}] [raw-tokens={raw_tokens}]"  # noqa: E501
         context_text, counter = "", 0
         for one in search_results:
             source = one["SourceFileName"] + f" at {100*(one['PageNumber']+1)/one['TotalPages']:.0f}%"  # noqa: E501
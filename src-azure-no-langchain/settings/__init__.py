@@ -12,6 +12,8 @@ PROMPTS = PROMPTS.pop("prompts")
 
 class Configs(BaseSettings):
     max_request_tokens: int = 4000
+    context_tokens: int = 3000  # retrieved chunks in answer_question
+    embedding_cache: str = "embeddingCache.db"  # sqlite, empty disables
     string_trace_end: str = "--- END OF TRACING ---"
 
     sqlite_name: str = "sqlEmission.db"
@@ -0,0 +1,51 @@
+# Yan Pan, 2023
+# per-request LLM setup cost, before and after the pooled ClientRegistry
+# python -m benchmarks.bench_client_setup (from src/, no network needed)
+from os import environ
+from time import perf_counter
+
+
+def per_request_legacy(n: int) -> float:
+    """settings + callback + fresh ChatOpenAI for every request"""
+    from botSettings.settings import Settings
+    from langchain_community.callbacks import OpenAICallbackHandler
+    from langchain_openai import ChatOpenAI
+
+    start = perf_counter()
+    for _ in range(n):
+        settings = Settings()
+        callback = OpenAICallbackHandler()
+        ChatOpenAI(
+            streaming=False,
+            callbacks=[callback],
+            temperature=0.1,
+            model_name="gpt-4o",
+            openai_api_key=settings.OPENAI_KEY,
+        )
+    return (perf_counter() - start) / n
+
+
+def per_request_pooled(n: int) -> float:
+    """cached settings + shared client with per-request callback"""
+    from langchain_community.callbacks import OpenAICallbackHandler
+    from prompts.ClientRegistry import ClientRegistry
+
+    start = perf_counter()
+    for _ in range(n):
+        callback = OpenAICallbackHandler()
+        ClientRegistry.get_chat(
+            model_name="gpt-4o",
+            temperature=0.1,
+            callbacks=[callback],
+        )
+    return (perf_counter() - start) / n
+
+
+if __name__ == "__main__":
+    environ.setdefault("BOT_OPENAI_KEY", "FakeKeyIsHere")
+    n = 200
+    legacy = per_request_legacy(n)
+    pooled = per_request_pooled(n)
+    print(f"legacy per-request setup: {legacy * 1e3:.3f} ms")
+    print(f"pooled per-request setup: {pooled * 1e3:.3f} ms")
+    print(f"speed-up: {legacy / pooled:.1f}x (excludes TLS handshakes saved)")
@@ -0,0 +1,120 @@
+# Yan Pan, 2023
+# peak memory and throughput of log ingestion, streamed vs materialized
+# python -m benchmarks.bench_ingestion_pipeline [--mb 500] (from src/)
+# embeddings are fake (random vectors), the index is discarded: this
+# measures the load/split/embed/bulk plumbing, not the API or Elasticsearch
+import numpy as np
+from argparse import ArgumentParser
+from json import dumps
+from multiprocessing import get_context
+from os import makedirs
+from resource import getrusage, RUSAGE_SELF
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+
+class FakeEmbeddings:
+    def __init__(self, dim: int, latency_ms: float):
+        self.dim = dim
+        self.latency = latency_ms / 1e3
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        sleep(self.latency)
+        return np.random.default_rng(len(texts)).normal(size=(len(texts), self.dim)).tolist()  # noqa: E501
+
+
+def synthetic_logs(folder: str, mb: int, file_mb: int = 50) -> list[str]:
+    """fluentd-like json lines, file_mb per file"""
+    rng = np.random.default_rng(0)
+    levels = ["info", "info", "info", "warning", "error"]
+    files = []
+    for i in range((mb + file_mb - 1) // file_mb):
+        path = f"{folder}/app{i:03d}.log"
+        with open(path, "w") as f:
+            written = 0
+            while written < min(file_mb, mb - i * file_mb) * 2**20:
+                line = dumps({
+                    "level": levels[rng.integers(5)],
+                    "message": f"request {rng.integers(1e9)} took {rng.integers(1000)} ms on worker {rng.integers(8)}",  # noqa: E501
+                    "time": int(1.7e9 + written / 2**20 * 3600),  # 1 MB per hour
+                }) + "\n"
+                f.write(line)
+                written += len(line)
+        files.append(path)
+    return files
+
+
+def materialized(files: list[str], embedding, batch_size: int) -> int:
+    """all chunks and all vectors in lists, as before"""
+    from langchain_community.document_loaders import TextLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)  # noqa: E501
+    texts = []
+    for x in files:
+        texts.extend(splitter.split_documents(TextLoader(x).load()))
+    contents = [x.page_content for x in texts]
+    vectors = []
+    for start in range(0, len(contents), batch_size):
+        vectors.extend(embedding.embed_documents(contents[start:start + batch_size]))  # noqa: E501
+    return len(vectors)
+
+
+def streamed(files: list[str], embedding, batch_size: int) -> int:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from prompts.IngestionPipeline import IngestionPipeline
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)  # noqa: E501
+    chunks = IngestionPipeline.split(
+        (block for x in files for block in IngestionPipeline.file_blocks(x)),
+        splitter,
+    )
+    count = 0
+    for batch, vectors in IngestionPipeline.embed(chunks, embedding, batch_size=batch_size):  # noqa: E501
+        count += len(vectors)  # the bulk request would go here
+    return count
+
+
+def measure(mode: str, files: list[str], dim: int, latency_ms: float, batch_size: int, queue):  # noqa: E501
+    baseline = getrusage(RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    chunks = {"materialized": materialized, "streamed": streamed}[mode](
+        files, FakeEmbeddings(dim, latency_ms), batch_size
+    )
+    queue.put((chunks, perf_counter() - start, (getrusage(RUSAGE_SELF).ru_maxrss - baseline) / 2**10))  # noqa: E501
+
+
+def run(mode: str, files: list[str], args) -> tuple:
+    """in a fresh process, so that peak RSS is of this run only"""
+    context = get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(mode, files, args.dim, args.latency_ms, args.batch_size, queue))  # noqa: E501
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--mb", type=int, default=500)
+    parser.add_argument("--baseline-mb", type=int, default=50, help="materialized grows with the corpus, keep it small")  # noqa: E501
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="per embedding call")  # noqa: E501
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as folder:
+        corpora = {}
+        for mode, mb in [("materialized", args.baseline_mb), ("streamed", args.baseline_mb), ("streamed", args.mb)]:  # noqa: E501
+            if mb not in corpora:
+                makedirs(f"{folder}/{mb}")
+                corpora[mb] = synthetic_logs(f"{folder}/{mb}", mb)
+            files = corpora[mb]
+            chunks, seconds, peak = run(mode, files, args)
+            print(
+                f"{mode:>12} {mb:>5} MB: {chunks:>7} chunks, "
+                f"{chunks / seconds:8.0f} chunks/s, peak RSS +{peak:7.0f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Yan Pan, 2023
+# top-k latency, database="local" (mmap + numpy) vs Elasticsearch kNN
+# python -m benchmarks.bench_local_vectors [--dim 1536] (from src/)
+# the Elasticsearch part runs when BOT_ELASTICSEARCH_URL is reachable
+import numpy as np
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from prompts.LocalVectorStore import LocalVectorStore
+
+
+def synthetic(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return LocalVectorStore.normalize(rng.normal(size=(n, dim)))
+
+
+def timed(fn, repeat: int = 50) -> float:
+    fn()  # warm up, pages in the mmap
+    start = perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (perf_counter() - start) / repeat * 1e3
+
+
+def local_store(folder: str, vectors: np.ndarray) -> LocalVectorStore:
+    path = f"{folder}/bench-{len(vectors)}"
+    texts = [f"chunk {i}" for i in range(len(vectors))]
+    LocalVectorStore.write(path, vectors, texts, [{"i": i} for i in range(len(vectors))])  # noqa: E501
+    return LocalVectorStore(path=path, embedding=None)
+
+
+def elasticsearch_knn(vectors: np.ndarray, queries: np.ndarray, k: int):
+    """ms per query, None if Elasticsearch is not available"""
+    from elasticsearch import Elasticsearch, helpers
+    from botSettings.settings import get_settings
+    try:
+        es = Elasticsearch(get_settings().ELASTICSEARCH_URL)
+        es.info()
+    except Exception as e:
+        print("elasticsearch skipped:", e)
+        return None
+    index = f"bench-local-vectors-{len(vectors)}"
+    es.options(ignore_status=404).indices.delete(index=index)
+    es.indices.create(index=index, mappings={"properties": {
+        "vector": {"type": "dense_vector", "dims": vectors.shape[1], "index": True, "similarity": "cosine"},  # noqa: E501
+        "text": {"type": "text"},
+    }})
+    helpers.bulk(es, (
+        {"_index": index, "_id": i, "vector": x.tolist(), "text": f"chunk {i}"}  # noqa: E501
+        for i, x in enumerate(vectors)
+    ), chunk_size=500)
+    es.indices.refresh(index=index)
+    es.indices.forcemerge(index=index, max_num_segments=1)
+    try:
+        queue = iter(queries)
+        return timed(lambda: es.search(index=index, size=k, source=["text"], knn={  # noqa: E501
+            "field": "vector", "query_vector": next(queue).tolist(),
+            "k": k, "num_candidates": 100,
+        }), repeat=len(queries) - 1)
+    finally:
+        es.indices.delete(index=index)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--sizes", default="10000,100000")
+    parser.add_argument("-k", type=int, default=4)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as folder:
+        for n in [int(x) for x in args.sizes.split(",")]:
+            vectors = synthetic(n, args.dim)
+            queries = synthetic(51, args.dim, seed=1)
+            store = local_store(folder, vectors)
+            queue = iter(queries)
+            local = timed(lambda: store.similarity_search_by_vector(next(queue), args.k), repeat=50)  # noqa: E501
+            es = elasticsearch_knn(vectors, queries, args.k)
+            LocalVectorStore.close(store.path)
+            print(
+                f"chunks={n:>6} dim={args.dim}: local {local:7.2f} ms"
+                + (f", elasticsearch {es:7.2f} ms" if es is not None else "")
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# Yan Pan, 2023
+# embedded documents of log ingestion, chunks vs LogTemplates
+# python -m benchmarks.bench_log_templates [--mb 50] (from src/)
+# counts only, nothing is embedded
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.bench_ingestion_pipeline import synthetic_logs
+
+
+def main():
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from prompts.IngestionPipeline import IngestionPipeline
+    from prompts.LogTemplates import LogTemplates
+
+    parser = ArgumentParser()
+    parser.add_argument("--mb", type=int, default=50)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as folder:
+        files = synthetic_logs(folder, args.mb)
+
+        def blocks():
+            return (block for x in files for block in IngestionPipeline.file_blocks(x))  # noqa: E501
+
+        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)  # noqa: E501
+        for mode, documents in [
+            ("chunks", lambda: IngestionPipeline.split(blocks(), splitter)),
+            ("templates", lambda: LogTemplates().documents(blocks())),
+        ]:
+            start = perf_counter()
+            count, chars = 0, 0
+            for x in documents():
+                count += 1
+                chars += len(x.metadata.get("embed_text", x.page_content))
+            print(
+                f"{mode:>10} {args.mb:>4} MB: {count:>7} documents, "
+                f"{chars / 2**20:7.1f} MB embedded, {perf_counter() - start:6.1f} s"  # noqa: E501
+            )
+
+
+if __name__ == "__main__":
+    main()
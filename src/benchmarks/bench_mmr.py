@@ -0,0 +1,44 @@
+# Yan Pan, 2023
+# MMR reranking latency, vectorized numpy vs langchain's reference
+# python -m benchmarks.bench_mmr (from src/)
+import numpy as np
+from time import perf_counter
+
+from prompts.Reranking import Reranking
+
+
+def near_copies(n: int, dim: int = 1536, groups: int = 10, seed: int = 0):
+    """candidates in a few tight clusters, like rolling log chunks"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(groups, dim))
+    labels = rng.integers(0, groups, n)
+    vectors = centers[labels] + 0.05 * rng.normal(size=(n, dim))
+    query = centers[0] + 0.1 * rng.normal(size=dim)
+    return query, vectors.astype(np.float32), labels
+
+
+def timed(fn, repeat: int = 20) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (perf_counter() - start) / repeat * 1e3
+
+
+def main():
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance  # noqa: E501
+    for n in [100, 1000]:
+        query, vectors, labels = near_copies(n)
+        for k in [4, 10]:
+            ours = timed(lambda: Reranking.mmr(query, vectors, k, 0.5))
+            reference = timed(lambda: maximal_marginal_relevance(query, vectors, 0.5, k))  # noqa: E501
+            picked = Reranking.mmr(query, vectors, k, 0.5)
+            clusters = len(set(labels[picked]))
+            print(
+                f"candidates={n:>4} k={k:>2}: "
+                f"numpy {ours:6.2f} ms, langchain {reference:6.2f} ms, "
+                f"{clusters} distinct clusters in top-k"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# Yan Pan, 2023
+# frames and bytes per streamed answer, raw tokens vs coalesced SSE
+# python -m benchmarks.bench_stream_frames (from src/)
+from asyncio import run, sleep
+from time import perf_counter
+
+from prompts.Streaming import coalesce_tokens, sse_frame
+
+
+async def fake_tokens(n: int, interval_ms: float):
+    """a provider streaming n short tokens at a steady rate"""
+    for i in range(n):
+        await sleep(interval_ms / 1000)
+        yield f" tok{i % 10}"
+
+
+async def measure(n: int, interval_ms: float, max_tokens: int, max_ms: int):
+    frames, size, first = 0, 0, None
+    start = perf_counter()
+    if max_tokens <= 1:
+        chunks = fake_tokens(n, interval_ms)
+    else:
+        chunks = coalesce_tokens(fake_tokens(n, interval_ms), max_tokens, max_ms)  # noqa: E501
+    async for chunk in chunks:
+        first = first or perf_counter() - start
+        frames += 1
+        size += len(sse_frame(chunk).encode())
+    return frames, size, first
+
+
+async def main(n: int = 1000, interval_ms: float = 2):
+    print(f"{n} tokens, one every {interval_ms} ms")
+    for max_tokens, max_ms in [(1, 0), (8, 50), (16, 50), (32, 100)]:
+        frames, size, first = await measure(n, interval_ms, max_tokens, max_ms)  # noqa: E501
+        print(
+            f"flush N={max_tokens:>2} T={max_ms:>3}ms: "
+            f"{frames:>5} frames {size:>7} bytes "
+            f"ttft {first * 1e3:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    run(main())
@@ -1,4 +1,5 @@
 # YYYan, adjusted for pydantic settings
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 
 
@@ -9,8 +10,83 @@ class Settings(BaseSettings):
     AZ_OPENAI_VERSION: str = "2023-05-15"
     AZ_OPENAI_DEPLOYMENT: str = "gpt4"
     CHROMA_PATH: str = "/mnt/shared/chroma/"
+    LOCAL_VECTOR_PATH: str = "/mnt/shared/vectors/"  # database="local"
     UPLOAD_PATH: str = "/mnt/shared/upload/"
+    INGEST_MAX_JOBS: int = 2  # concurrent ingestion jobs per worker
+    INGEST_MAX_QUEUED: int = 16
+    INGEST_JOBS_KEPT: int = 1000  # newest job records, older are deleted
+    # streaming ingestion: chunks per embedding call / bulk request
+    INGEST_BATCH_SIZE: int = 64
+    INGEST_IN_FLIGHT: int = 4  # embedding calls at a time, per job
+    INGEST_BLOCK_CHARS: int = 200000  # text files are read in line blocks
+    # incremental log-{LOG_TAIL_COLLECTION} every N seconds, 0 disables
+    LOG_TAIL_INTERVAL: int = 0
+    LOG_TAIL_COLLECTION: str = "rolling"
+    LOG_TAIL_DAYS: int = 1  # retention of the tailed collection
+    # log template mining, one document per template and bucket seconds
+    LOG_TEMPLATE_SIMILARITY: float = 0.5
+    LOG_TEMPLATE_BUCKET: int = 3600
     ELASTICSEARCH_URL: str = "http://elasticsearch:9200"
+    # streaming output: flush every N tokens or T ms, whichever first
+    STREAM_FLUSH_TOKENS: int = 16
+    STREAM_FLUSH_MS: int = 50
+    STREAM_SSE_FRAMING: bool = True
+    SINGLE_FLIGHT: bool = True  # coalesce concurrent identical streams
+    # no first token after N ms: race the other backend, 0 disables
+    # a good value is the p90 time to first token
+    HEDGE_DELAY_MS: int = 0
+    # provider budget per model, RATE_LIMITS json overrides per model name
+    # e.g. {"gpt-4o": {"tpm": 30000, "rpm": 500}}
+    RATE_LIMIT_TPM: int = 150000
+    RATE_LIMIT_RPM: int = 500
+    RATE_LIMITS: str = ""
+    RATE_LIMIT_QUEUE_DEPTH: int = 64
+    RATE_LIMIT_RETRIES: int = 3
+    # model="auto": small model unless the prompt is long or complex
+    ROUTER_SMALL_MODEL: str = "gpt-4o-mini"
+    ROUTER_LARGE_MODEL: str = "gpt-4o"
+    ROUTER_MAX_SMALL_TOKENS: int = 300
+    ROUTER_MAX_SMALL_CODE_TOKENS: int = 1500
+    ROUTER_MAX_SMALL_COMPLEXITY: int = 1
+    # retrieval="mmr": diversity of the top-k, MMR_COLLECTIONS json by
+    # collection prefix, e.g. {"log-rolling": {"lambda": 0.3, "fetch_k": 50}}
+    MMR_LAMBDA: float = 0.5
+    MMR_FETCH_K: int = 20
+    MMR_COLLECTIONS: str = ""
+    TWO_TIER_DOCUMENTS: int = 5  # retrieval="two_tier": sources searched
+    # elasticsearch kNN, see KnnIndex; index type "" is the server default
+    # ES_KNN_COLLECTIONS json by collection prefix,
+    # e.g. {"log-": {"index_type": "int8_hnsw", "num_candidates": 50}}
+    ES_KNN_INDEX_TYPE: str = ""
+    ES_KNN_M: int = 16
+    ES_KNN_EF_CONSTRUCTION: int = 100
+    ES_KNN_NUM_CANDIDATES: int = 100
+    ES_KNN_COLLECTIONS: str = ""
+    # prompt tokens for retrieved context of the stuff chain, 0 disables
+    CONTEXT_TOKEN_BUDGET: int = 3000
+    MAP_CONCURRENCY: int = 4  # parallel map calls of map_reduce
+    # local caches; sqlite tier is shared by workers, empty path disables it
+    CACHE_PATH: str = "/mnt/shared/cache/"
+    RESPONSE_CACHE_SIZE: int = 512
+    RESPONSE_CACHE_TTL: int = 3600
+    COLLECTION_GENERATION_TTL: float = 2.0  # seconds a generation is reused
+    SEMANTIC_CACHE_SIZE: int = 256
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95
+    SEMANTIC_CACHE_PREFIXES: str = "about"
+    SEMANTIC_CACHE_FAQ: str = ""  # json file {collection: [questions]}
+    EMBEDDING_CACHE_SIZE: int = 2048  # question vectors
+    EMBEDDING_CACHE_PERSIST: bool = False  # sqlite tier, hashed keys only
+    CHUNK_EMBEDDING_CACHE: bool = True  # ingestion, CACHE_PATH/embeddings.db
+    RETRIEVAL_CACHE_SIZE: int = 1024  # retrieved document lists
 
     class Config:
         env_prefix = "BOT_"
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    process-wide settings, environment is read only once
+    use get_settings.cache_clear() to reload (e.g. in tests)
+    """
+    return Settings()
@@ -1,13 +1,34 @@
 # Yan Pan, 2023
 # router is used for easy-mount in parent app
+from asyncio import create_task
 from fastapi import FastAPI, Request
 
+from botSettings.settings import get_settings
+from prompts.DocumentQA import DocumentQA
+from prompts.VectorSpecialty import VectorSpecialty
 from router import router, router_open
 from routerProtected import router_admin_only
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def warm_up_caches():
+    """optional: answer known FAQs in background, see SEMANTIC_CACHE_FAQ"""
+    faq_file = get_settings().SEMANTIC_CACHE_FAQ
+    if faq_file:
+        app.state.warm_up = create_task(
+            DocumentQA.warm_up_semantic_cache(faq_file)
+        )
+
+
+@app.on_event("startup")
+async def schedule_log_tail():
+    """optional: incremental log ingestion, see LOG_TAIL_INTERVAL"""
+    if get_settings().LOG_TAIL_INTERVAL > 0:
+        app.state.log_tail = create_task(VectorSpecialty.schedule_log_tail())
+
+
 @app.get("/")
 def index(request: Request):
     return {"info": "hello world"}
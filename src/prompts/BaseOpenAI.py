@@ -2,16 +2,26 @@
 from asyncio import create_task, Event, Task
 from langchain.callbacks import AsyncIteratorCallbackHandler # noqa
 from typing import AsyncIterable, Awaitable
-from botSettings.settings import Settings
 from langchain_community.callbacks import OpenAICallbackHandler
 from langchain_core.outputs import LLMResult
-from langchain_openai import AzureChatOpenAI, ChatOpenAI
+
+from botSettings.settings import get_settings
+from prompts.ClientRegistry import ClientRegistry
+from prompts.CollectionGeneration import CollectionGeneration
+from prompts.Hedging import Hedging, Racer
+from prompts.ModelRouter import ModelRouter
+from prompts.RateLimiter import ProviderScheduler
+from prompts.ResponseCache import ResponseCache
+from prompts.SingleFlight import SingleFlight
+from prompts.Streaming import coalesce_tokens, sse_frame
 
 
 class BaseOpenAI:
     """
     base class that initialized chat or llm for langchain
     tracing: callable function that takes dict as input - record OpenAI usage
+    hedge: streams may race the other backend, see HEDGE_DELAY_MS
+    model_name="auto": chosen per request by route(), see ModelRouter
     """
 
     def __init__(
@@ -21,43 +31,44 @@ class BaseOpenAI:
         using_azure: bool = False,
         streaming: bool = False,
         trace_func: callable = print,
+        use_cache: bool = True,
+        priority: str = "",
+        hedge: bool = True,
         **kwargs,
     ):
-        settings = Settings()
         self.openai_callback = OpenAICallbackHandler()
         self.trace = trace_func  # callable
         self.database = "unspecified"
+        self.collection = ""  # vector collection, part of cache key
+        self.collections = []  # all collections read, see acache_key
         self.result = None # only available for async
+        self.use_cache = use_cache
+        self.cache_hit = False
+        self.answer = ""  # full text of the last streamed answer
+        self.usage_extra = {}  # subclass specific usage fields
+        # streams are interactive by default, see ProviderScheduler
+        self.priority = priority or ("interactive" if streaming else "analysis")  # noqa: E501
+        self.auto_model = model_name == ModelRouter.AUTO
+        if self.auto_model:
+            model_name = get_settings().ROUTER_SMALL_MODEL  # until routed
+        self.model_name = model_name
+        self.temperature = temperature
+        self.using_azure = using_azure
+        self.hedge = hedge and streaming
 
+        callbacks = [self.openai_callback]
         if streaming:
             self.async_callback = AsyncIteratorCallbackHandler()
-            llm_streaming_kwargs = {
-                "streaming": True,
-                "callbacks": [self.async_callback, self.openai_callback]
-            }
-        else:
-            llm_streaming_kwargs = {
-                "streaming": False,
-                "callbacks": [self.openai_callback]
-            }
+            callbacks = [self.async_callback, self.openai_callback]
 
-        if using_azure:
-            self.llm = AzureChatOpenAI(
-                **llm_streaming_kwargs,
-                temperature=temperature,
-                deployment_name=settings.AZ_OPENAI_DEPLOYMENT,
-                openai_api_type="azure",
-                openai_api_key=settings.AZ_OPENAI_KEY,
-                openai_api_base=settings.AZ_OPENAI_BASE,
-                openai_api_version=settings.AZ_OPENAI_VERSION,
-            )
-        else:
-            self.llm = ChatOpenAI(
-                **llm_streaming_kwargs,
-                temperature=temperature,
-                model_name=model_name,
-                openai_api_key=settings.OPENAI_KEY
-            )
+        # pooled client, callbacks are per-request
+        self.llm = ClientRegistry.get_chat(
+            model_name=model_name,
+            temperature=temperature,
+            streaming=streaming,
+            using_azure=using_azure,
+            callbacks=callbacks,
+        )
 
         return None
 
@@ -72,6 +83,8 @@ class BaseOpenAI:
                 "prompt_tokens": self.openai_callback.prompt_tokens,
                 "completion_tokens": self.openai_callback.completion_tokens,
                 "total_costs": self.openai_callback.total_cost,
+                "cache_hit": self.cache_hit,
+                **self.usage_extra,
             }
             self.trace(usage)
             return usage
@@ -79,6 +92,123 @@ class BaseOpenAI:
             print(e)
             return {}
 
+    def use_model(self, model_name: str, reason: str = ""):
+        """switch to another model, keeping the callbacks"""
+        self.model_name = model_name
+        self.llm = ClientRegistry.get_chat(
+            model_name=model_name,
+            temperature=self.temperature,
+            streaming=self.llm.streaming,
+            using_azure=self.using_azure,
+            callbacks=self.llm.callbacks,
+        )
+        self.usage_extra.update({"routed_model": model_name, "routing_reason": reason})  # noqa: E501
+
+    def route(self, text: str, kind: str = "question"):
+        """choose the model for this prompt, only for model_name="auto" """
+        if self.auto_model and not self.usage_extra.get("escalated"):
+            self.use_model(*ModelRouter.choose(text, kind))
+
+    def escalate(self, reason: str) -> bool:
+        """move an auto-routed request to the large model, once"""
+        large = get_settings().ROUTER_LARGE_MODEL
+        if not self.auto_model or self.model_name == large:
+            return False
+        self.use_model(large, f"{reason} on {self.model_name}")
+        self.usage_extra["escalated"] = True
+        return True
+
+    def cache_key(self, endpoint: str, **inputs) -> str:
+        """exact-match key, invalidated when the collection is rebuilt"""
+        generation = 0
+        if self.collection:
+            generation = CollectionGeneration.get(self.collection)
+        return ResponseCache.make_key(
+            endpoint=f"{self.__class__.__name__}.{endpoint}",
+            model=self.llm.model_name,
+            deployment=getattr(self.llm, "deployment_name", None),
+            temperature=self.llm.temperature,
+            database=self.database,
+            collection=self.collection,
+            generation=generation,
+            inputs=inputs,
+        )
+
+    async def acache_key(self, endpoint: str, **inputs) -> str:
+        """cache_key with the generations read in a worker thread"""
+        collections = [x for x in {self.collection, *self.collections} if x]
+        if collections:
+            await CollectionGeneration.aget_many(collections)
+        return self.cache_key(endpoint, **inputs)
+
+    def cache_get(self, key: str):
+        if not self.use_cache:
+            return None
+        cached = ResponseCache.get(key)
+        self.cache_hit = cached is not None
+        return cached
+
+    async def acache_get(self, key: str):
+        if not self.use_cache:
+            return None
+        cached = await ResponseCache.aget(key)
+        self.cache_hit = cached is not None
+        return cached
+
+    def cache_set(self, key: str, value: str):
+        if self.use_cache:
+            ResponseCache.set(key, value)
+
+    async def acache_set(self, key: str, value: str):
+        if self.use_cache:
+            await ResponseCache.aset(key, value)
+
+    @staticmethod
+    def budget_key(llm) -> str:
+        """model name for ProviderScheduler, the deployment on Azure"""
+        return getattr(llm, "deployment_name", None) or llm.model_name
+
+    def admit(self):
+        """raise RateLimitRejected now rather than time out later"""
+        ProviderScheduler.admit(self.budget_key(self.llm), self.priority)
+
+    def scheduled(
+        self,
+        make_call: callable,
+        tokens: int = 1000,
+        llm=None,
+    ) -> Awaitable:
+        """make_call() returns an awaitable, run within the model budget"""
+        return ProviderScheduler.run(
+            self.budget_key(llm or self.llm), make_call, tokens, self.priority
+        )
+
+    def scheduled_blocking(self, make_call: callable, tokens: int = 1000):
+        return ProviderScheduler.run_blocking(
+            self.budget_key(self.llm), make_call, tokens, self.priority
+        )
+
+    def hedging_enabled(self) -> bool:
+        """other backend must be configured, Azure uses AZ_OPENAI_DEPLOYMENT"""
+        settings = get_settings()
+        return (
+            self.hedge
+            and settings.HEDGE_DELAY_MS > 0
+            and settings.AZ_OPENAI_KEY != "missing"
+        )
+
+    def alternate_llm(self) -> tuple:
+        """(llm, callback) for the same request on the other backend"""
+        callback = AsyncIteratorCallbackHandler()
+        llm = ClientRegistry.get_chat(
+            model_name=self.model_name,
+            temperature=self.temperature,
+            streaming=True,
+            using_azure=not self.using_azure,
+            callbacks=[callback, self.openai_callback],
+        )
+        return llm, callback
+
     def validate_streaming(self):
         if self.llm.streaming:
             pass
@@ -94,21 +224,110 @@ class BaseOpenAI:
             print(f"Caught exception: {e}")
         finally:
             event.set()
+        return self.result
 
     def create_asyncio_wrapped_task(self, llm_result: LLMResult) -> Task:
         return create_task(
             self.wrap_done(llm_result, self.async_callback.done)
         )
 
-    async def __stream(self, llm_result: LLMResult) -> AsyncIterable[str]:
+    async def stream_tokens(
+        self,
+        llm_result: Awaitable,
+        cache_key: str = "",
+        is_disconnected: callable = None,
+        make_alternate: callable = None,
+    ) -> AsyncIterable[str]:
         """
-        Wrap the stream output.
+        Wrap the stream output, coalesced and framed for SSE.
         llm_result must be a async object, for example model.agenereate
+        with cache_key, a cached answer is replayed and llm_result discarded
+        is_disconnected: async callable, e.g. starlette request.is_disconnected
+        make_alternate(llm): llm_result on the other backend, for hedging
+        usage is collected when the stream ends, also when cancelled
         """
-        # task = create_task(self.wrap_done(
-        #     llm_result, self.async_callback.done
-        # ))
-        task = self.create_asyncio_wrapped_task(llm_result)
-        async for token in self.async_callback.aiter():
-            yield f"{token} "
-        await task
+        settings = get_settings()
+        frame = sse_frame if settings.STREAM_SSE_FRAMING else str
+
+        cached = await self.acache_get(cache_key) if cache_key else None
+        if cached is not None:
+            llm_result.close()  # coroutine never started
+            async for chunk in self.replay_stream(cached):
+                yield chunk
+            _ = self.collect_usage()
+            return
+
+        # identical in-flight requests share one upstream generation
+        flight, is_leader = SingleFlight.join(cache_key)
+        if is_leader:
+            flight.upstream = self.create_asyncio_wrapped_task(llm_result)
+            tokens = self.async_callback.aiter()
+            if make_alternate is not None and self.hedging_enabled():
+                tokens = self.hedged_tokens(flight, make_alternate)
+            flight.task = create_task(flight.pump(tokens))
+        else:
+            llm_result.close()  # coroutine never started
+            self.usage_extra["coalesced"] = True
+
+        chunks = coalesce_tokens(
+            flight.subscribe(),
+            max_tokens=settings.STREAM_FLUSH_TOKENS,
+            max_ms=settings.STREAM_FLUSH_MS,
+        )
+        streamed, completed = [], False
+        try:
+            async for chunk in chunks:
+                if is_disconnected is not None and await is_disconnected():
+                    break
+                streamed.append(chunk)
+                yield frame(chunk)
+            else:
+                completed = True
+        finally:
+            # no await here: a cancelled scope would cancel it again
+            flight.leave()
+            if not completed:
+                SingleFlight.disconnected()
+                self.usage_extra.update({
+                    "cancelled": True,
+                    "upstream_cancelled": flight.cancelled,
+                    "streamed_tokens": len(flight.tokens),
+                })
+                _ = self.collect_usage()
+        if not completed:
+            await chunks.aclose()
+            return
+
+        await flight.task
+        self.result = flight.result
+        if is_leader:
+            self.usage_extra["fanout"] = flight.joined
+
+        self.answer = "".join(streamed)
+        if is_leader and cache_key and self.result is not None:
+            await self.acache_set(cache_key, self.answer)
+        _ = self.collect_usage()
+
+    def hedged_tokens(self, flight, make_alternate: callable):
+        """race flight.upstream against the other backend, see Hedging"""
+        backends = ["openai", "azure"]
+        if self.using_azure:
+            backends.reverse()
+
+        def start_alternate() -> Racer:
+            llm, callback = self.alternate_llm()
+            task = create_task(self.wrap_done(make_alternate(llm), callback.done))  # noqa: E501
+            return Racer(backends[1], task, callback)
+
+        return Hedging.tokens(
+            flight,
+            Racer(backends[0], flight.upstream, self.async_callback),
+            start_alternate,
+            delay=get_settings().HEDGE_DELAY_MS / 1000,
+            usage=self.usage_extra,
+        )
+
+    async def replay_stream(self, text: str) -> AsyncIterable[str]:
+        """a cached answer, sent as one stream chunk"""
+        self.answer = text
+        yield sse_frame(text) if get_settings().STREAM_SSE_FRAMING else text
@@ -0,0 +1,150 @@
+# Yan Pan, 2023
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
+from threading import Lock
+from langchain_openai import AzureChatOpenAI, ChatOpenAI, OpenAIEmbeddings
+
+from botSettings.settings import get_settings
+from prompts.EmbeddingCache import CachedEmbeddings
+from prompts.IngestionJobs import IngestionJobs
+from prompts.RateLimiter import ProviderScheduler, ScheduledEmbeddings
+
+
+class ClientRegistry:
+    """
+    process-wide pool of LLM clients, one per (provider, model, temperature, streaming)
+    clients keep their http connection pool alive across requests.
+    get_chat returns a light-weight copy sharing the pooled http client,
+    so that per-request callbacks do not leak to other requests.
+    every 429 seen by a pooled client is reported to ProviderScheduler,
+    clients do not retry (max_retries=0): ProviderScheduler.run is the only
+    retry layer, within the priority queue and token budget
+    """
+
+    _chats: dict = {}
+    _embeddings: dict = {}
+    _elasticsearch = None
+    _lock = Lock()
+
+    @staticmethod
+    def http_clients(model: str) -> dict:
+        hook, ahook = ProviderScheduler.response_hooks(model)
+        return {
+            "http_client": DefaultHttpxClient(
+                event_hooks={"response": [hook]}
+            ),
+            "http_async_client": DefaultAsyncHttpxClient(
+                event_hooks={"response": [ahook]}
+            ),
+        }
+
+    @staticmethod
+    def __build_chat(
+        provider: str,
+        model_name: str,
+        temperature: float,
+        streaming: bool
+    ):
+        settings = get_settings()
+        http_clients = ClientRegistry.http_clients(model_name)
+        if provider == "azure":
+            return AzureChatOpenAI(
+                **http_clients,
+                streaming=streaming,
+                temperature=temperature,
+                deployment_name=model_name,
+                max_retries=0,
+                openai_api_type="azure",
+                openai_api_key=settings.AZ_OPENAI_KEY,
+                azure_endpoint=settings.AZ_OPENAI_BASE,
+                openai_api_version=settings.AZ_OPENAI_VERSION,
+            )
+        return ChatOpenAI(
+            **http_clients,
+            streaming=streaming,
+            temperature=temperature,
+            model_name=model_name,
+            max_retries=0,
+            openai_api_key=settings.OPENAI_KEY
+        )
+
+    @classmethod
+    def get_chat(
+        cls,
+        model_name: str = "gpt-4o",
+        temperature: float = 0.7,
+        streaming: bool = False,
+        using_azure: bool = False,
+        callbacks: list = None,
+    ):
+        """shared client with per-request callbacks attached"""
+        provider = "azure" if using_azure else "openai"
+        if using_azure:
+            model_name = get_settings().AZ_OPENAI_DEPLOYMENT
+        key = (provider, model_name, float(temperature), bool(streaming))
+
+        with cls._lock:
+            if key not in cls._chats:
+                cls._chats[key] = cls.__build_chat(*key)
+            base = cls._chats[key]
+
+        return cls.derive(base, callbacks=callbacks)
+
+    @staticmethod
+    def derive(llm, **fields):
+        """
+        shallow copy without validation, client/async_client are shared
+        e.g. derive(llm, streaming=False, callbacks=[...])
+        """
+        return llm.__class__.construct(
+            _fields_set=llm.__fields_set__,
+            **{**llm.__dict__, **fields},
+        )
+
+    @classmethod
+    def get_embeddings(
+        cls,
+        model: str = "text-embedding-ada-002",
+        priority: str = "interactive",
+    ):
+        """
+        shared embedding client, scheduled with the given priority.
+        query vectors are cached, see EmbeddingCache, chunk cache hits
+        count towards the running ingestion job
+        """
+        with cls._lock:
+            if model not in cls._embeddings:
+                cls._embeddings[model] = OpenAIEmbeddings(
+                    **cls.http_clients(model),
+                    model=model,
+                    max_retries=0,
+                    openai_api_key=get_settings().OPENAI_KEY,
+                )
+            scheduled = ScheduledEmbeddings(cls._embeddings[model], model, priority)  # noqa: E501
+            return CachedEmbeddings(
+                scheduled,
+                model,
+                on_record=lambda hits, saved: IngestionJobs.report(
+                    embeddings_cached=hits, embedding_calls_saved=saved
+                ),
+            )
+
+    @classmethod
+    def get_elasticsearch(cls):
+        """
+        shared connection, no connectivity check (unlike ElasticsearchStore)
+        so that constructing a store never blocks the event loop
+        """
+        from elasticsearch import Elasticsearch
+        with cls._lock:
+            if cls._elasticsearch is None:
+                cls._elasticsearch = Elasticsearch(
+                    hosts=[get_settings().ELASTICSEARCH_URL]
+                )
+            return cls._elasticsearch
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._chats.clear()
+            cls._embeddings.clear()
+            cls._elasticsearch = None
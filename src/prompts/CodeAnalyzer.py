@@ -15,7 +15,7 @@ class CodeAnalyzer(BaseOpenAI):
     class InputSchema(BaseModel):
         code: str
         temperature: float = 0.1
-        model: str = "gpt-4o"
+        model: str = "gpt-4o"  # or "auto", see ModelRouter
 
     class OutputSchema(BaseModel):
         language: Optional[str] = ""
@@ -46,38 +46,81 @@ class CodeAnalyzer(BaseOpenAI):
             ResponseSchema(name="security", description="check for security risks or bugs, reply OK if none")   # noqa
         ])
 
-    def analyze(self, code: str) -> dict[str, list]:
-        messages = self.template.format_messages(
+    @staticmethod
+    def estimate_tokens(code: str) -> int:
+        """rough budget: prompt (4 chars per token) and the review"""
+        return len(code) // 4 + 1000
+
+    def __messages(self, code: str):
+        return self.template.format_messages(
             code=code,
             format=self.parser.get_format_instructions()
         )
 
-        response = self.llm(messages)
-
+    def __parse(self, content: str) -> dict:
         try:
+            parsed = self.parser.parse(content)
             return {
-                **self.parser.parse(response.content),
+                **parsed,
                 "metrics": self.collect_usage()
             }
         except Exception as e:
             return {"exception": {
-                "content": response.content,
+                "content": content,
                 "exception": str(e)}
             }
 
-    async def analyze_stream(self, code: str):
+    def analyze(self, code: str) -> dict[str, list]:
+        self.route(code, kind="code")
+        key = self.cache_key("analyze", code=code)
+        content = self.cache_get(key)
+        if content is None:
+            content = self.scheduled_blocking(
+                lambda: self.llm(self.__messages(code)),
+                tokens=self.estimate_tokens(code),
+            ).content
+        parsed = self.__parse(content)
+        if "exception" not in parsed and not self.cache_hit:
+            self.cache_set(key, content)
+        if "exception" in parsed and self.escalate("parser failed"):
+            return self.analyze(code)
+        return parsed
+
+    async def aanalyze(self, code: str) -> dict[str, list]:
+        """async counterpart of analyze, waits on the event loop"""
+        self.route(code, kind="code")
+        key = await self.acache_key("analyze", code=code)
+        content = await self.acache_get(key)
+        if content is None:
+            response = await self.scheduled(
+                lambda: self.llm.ainvoke(self.__messages(code)),
+                tokens=self.estimate_tokens(code),
+            )
+            content = response.content
+        parsed = self.__parse(content)
+        if "exception" not in parsed and not self.cache_hit:
+            await self.acache_set(key, content)
+        if "exception" in parsed and self.escalate("parser failed"):
+            return await self.aanalyze(code)
+        return parsed
+
+    async def analyze_stream(self, code: str, is_disconnected=None):
         """
         stream the outputs, where json parser is no longer possible
         """
         self.validate_streaming()
+        self.route(code, kind="code")
 
         messages = self.template.format_messages(code=code, format="")
-        task = self.create_asyncio_wrapped_task(
-            self.llm.agenerate([messages])
+        key = await self.acache_key("analyze_stream", code=code)
+        tokens = self.estimate_tokens(code)
+        llm_result = self.scheduled(
+            lambda: self.llm.agenerate([messages]), tokens
         )
-
-        async for token in self.async_callback.aiter():
-            yield token
-
-        await task
-        _ = self.collect_usage()
+        make_alternate = lambda llm: self.scheduled(  # noqa: E731
+            lambda: llm.agenerate([messages]), tokens, llm=llm
+        )
+        async for chunk in self.stream_tokens(
+            llm_result, key, is_disconnected, make_alternate
+        ):
+            yield chunk
@@ -0,0 +1,90 @@
+# Yan Pan, 2023
+from asyncio import to_thread
+from threading import Lock
+from time import time
+
+from botSettings.settings import get_settings
+from prompts.SqliteStore import SqliteStore
+
+
+class CollectionGeneration:
+    """
+    a counter per vector collection, bumped whenever the collection changes
+    cache entries tagged with an older generation are stale.
+    stored in sqlite under CACHE_PATH so that all workers agree,
+    falls back to in-process counters if the path is not writable.
+    reads are kept in memory for COLLECTION_GENERATION_TTL seconds, a bump
+    in another worker is seen after at most that long
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS generations "
+        "(collection TEXT PRIMARY KEY, generation INTEGER)"
+    )
+
+    _local: dict = {}
+    _cached: dict = {}  # collection: (expires, generation)
+    _lock = Lock()
+
+    @staticmethod
+    def __execute(sql: str, params: tuple = ()):
+        return SqliteStore.execute("cache.db", CollectionGeneration.SCHEMA, sql, params)  # noqa: E501
+
+    @classmethod
+    def __cached(cls, collection: str):
+        """generation without I/O, or None"""
+        with cls._lock:
+            if not get_settings().CACHE_PATH:
+                return cls._local.get(collection, 0)
+            expires, generation = cls._cached.get(collection, (0, None))
+            return generation if expires > time() else None
+
+    @classmethod
+    def get(cls, collection: str) -> int:
+        generation = cls.__cached(collection)
+        if generation is not None:
+            return generation
+        try:
+            row = cls.__execute(
+                "SELECT generation FROM generations WHERE collection=?",
+                (collection,)
+            )
+            generation = row[0] if row else 0
+        except Exception as e:
+            print("collection generation not readable", e)
+            with cls._lock:
+                return cls._local.get(collection, 0)
+        with cls._lock:
+            ttl = get_settings().COLLECTION_GENERATION_TTL
+            cls._cached[collection] = (time() + ttl, generation)
+        return generation
+
+    @classmethod
+    async def aget_many(cls, collections: list[str]) -> list[int]:
+        """generations, read in a worker thread unless kept in memory"""
+        cached = [cls.__cached(x) for x in collections]
+        if None not in cached:
+            return cached
+        return await to_thread(lambda: [cls.get(x) for x in collections])
+
+    @classmethod
+    async def aget(cls, collection: str) -> int:
+        return (await cls.aget_many([collection]))[0]
+
+    @classmethod
+    def bump(cls, collection: str) -> int:
+        with cls._lock:
+            cls._local[collection] = cls._local.get(collection, 0) + 1
+            cls._cached.pop(collection, None)
+        if not get_settings().CACHE_PATH:
+            return cls.get(collection)
+        try:
+            cls.__execute(
+                "INSERT INTO generations VALUES (?, 1) "
+                "ON CONFLICT(collection) "
+                "DO UPDATE SET generation = generation + 1",
+                (collection,)
+            )
+        except Exception as e:
+            print("collection generation not writable", e)
+        return cls.get(collection)
@@ -0,0 +1,114 @@
+# Yan Pan, 2023
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from prompts.ModelRouter import ModelRouter
+
+
+class ContextPacker:
+    """
+    retrieved chunks in relevance order, packed into a token budget:
+    - text shared with an already packed chunk of the same source
+      (splitter overlap) is cut from the later chunk
+    - near-duplicates (word shingle jaccard) are dropped
+    - chunks that do not fit are skipped, smaller ones may still fit
+    token counts come from metadata["tokens"] when set at ingestion
+    """
+
+    MIN_OVERLAP = 20  # chars, shorter matches are coincidence
+    MAX_OVERLAP = 400  # chars, above the splitter chunk_overlap
+    DUPLICATE_SIMILARITY = 0.8
+
+    @staticmethod
+    def overlap(previous: str, text: str, min_chars: int = MIN_OVERLAP, max_chars: int = MAX_OVERLAP) -> int:  # noqa: E501
+        """length of the longest suffix of previous that starts text"""
+        for size in range(min(len(previous), len(text), max_chars), min_chars - 1, -1):  # noqa: E501
+            if previous.endswith(text[:size]):
+                return size
+        return 0
+
+    @staticmethod
+    def shingles(text: str, size: int = 3) -> set:
+        words = text.lower().split()
+        return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}  # noqa: E501
+
+    @classmethod
+    def trim(cls, text: str, packed: list[str]) -> str:
+        """cut overlaps with packed chunks, before and after the text"""
+        for other in packed:
+            cut = cls.overlap(other, text)
+            text = text[cut:]
+            cut = cls.overlap(text, other)
+            text = text[:len(text) - cut]
+        return text
+
+    @classmethod
+    def pack(
+        cls,
+        docs: list[Document],
+        budget: int,
+        source_key: str = "source",
+    ) -> tuple[list[Document], dict]:
+        """(packed docs, stats); budget <= 0 only deduplicates"""
+        packed, seen, by_source = [], [], {}
+        stats = {"raw_tokens": 0, "packed_tokens": 0, "raw_chunks": len(docs), "duplicates": 0, "overlaps": 0}  # noqa: E501
+        for doc in docs:
+            text = doc.page_content
+            tokens = doc.metadata.get("tokens") or ModelRouter.count_tokens(text)  # noqa: E501
+            stats["raw_tokens"] += tokens
+
+            shingles = cls.shingles(text)
+            if any(
+                len(shingles & x) / len(shingles | x) >= cls.DUPLICATE_SIMILARITY  # noqa: E501
+                for x in seen
+            ):
+                stats["duplicates"] += 1
+                continue
+
+            source = doc.metadata.get(source_key)
+            trimmed = cls.trim(text, by_source.get(source, []))
+            if trimmed != text:
+                stats["overlaps"] += 1
+                tokens = ModelRouter.count_tokens(trimmed)
+            if not trimmed.strip():
+                continue
+            if budget > 0 and stats["packed_tokens"] + tokens > budget:
+                continue
+
+            seen.append(shingles)
+            by_source.setdefault(source, []).append(text)
+            packed.append(Document(page_content=trimmed, metadata=doc.metadata))  # noqa: E501
+            stats["packed_tokens"] += tokens
+        stats["packed_chunks"] = len(packed)
+        return packed, stats
+
+
+class PackedRetriever(BaseRetriever):
+    """retriever wrapper applying ContextPacker, stats go to usage"""
+
+    retriever: BaseRetriever
+    budget: int = 3000
+    usage: dict = {}
+
+    def __record(self, stats: dict):
+        self.usage["context"] = stats
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})  # noqa: E501
+        packed, stats = ContextPacker.pack(docs, self.budget)
+        self.__record(stats)
+        return packed
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        docs = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})  # noqa: E501
+        packed, stats = ContextPacker.pack(docs, self.budget)
+        self.__record(stats)
+        return packed
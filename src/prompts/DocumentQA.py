@@ -1,11 +1,26 @@
 # Yan Pan, 2023
+from asyncio import gather, Semaphore
+from json import loads
 from langchain.chains import RetrievalQA, RetrievalQAWithSourcesChain
+from langchain.chains.question_answering import load_qa_chain
+from langchain.chains.question_answering.map_reduce_prompt import QUESTION_PROMPT_SELECTOR  # noqa: E501
 from langchain_community.vectorstores import Chroma, ElasticsearchStore
-from langchain_openai import OpenAIEmbeddings
+from langchain_core.documents import Document
 from pydantic import BaseModel
 
 from prompts.BaseOpenAI import BaseOpenAI
-from botSettings.settings import Settings
+from prompts.ClientRegistry import ClientRegistry
+from prompts.CollectionGeneration import CollectionGeneration
+from prompts.ContextPacker import ContextPacker, PackedRetriever
+from prompts.HybridRetriever import HybridRetriever
+from prompts.KnnIndex import KnnRetriever
+from prompts.LocalVectorStore import LocalVectorStore
+from prompts.ModelRouter import ModelRouter
+from prompts.Reranking import MmrRetriever, Reranking
+from prompts.RetrievalCache import CachedRetriever
+from prompts.SemanticCache import SemanticCache
+from prompts.TwoTierRetriever import DocumentPooling, TwoTierRetriever
+from botSettings.settings import get_settings
 
 
 class DocumentQA(BaseOpenAI):
@@ -14,15 +29,21 @@ class DocumentQA(BaseOpenAI):
     vector collection must exist- create it using VectorDB.create_from_file
     """
 
-    CHAIN_TYPES = ["stuff", "map_reduce", "refine"]
+    # auto: stuff if the retrieved context fits CONTEXT_TOKEN_BUDGET
+    CHAIN_TYPES = ["stuff", "map_reduce", "refine", "auto"]
+    # hybrid, two_tier: elasticsearch only, others fall back to vector
+    RETRIEVAL_MODES = ["vector", "hybrid", "mmr", "two_tier"]
+    ESTIMATED_TOKENS = 2000  # retrieved context and answer, for scheduling
 
     class InputSchema(BaseModel):
         question: str
         database: str = "elasticsearch"
         collection: str = "default"
         temperature: float = 0.1
-        model: str = "gpt-4o"
+        model: str = "gpt-4o"  # or "auto", see ModelRouter
         include_source: bool = False
+        retrieval: str = "vector"  # "hybrid" (BM25 + kNN), "mmr" (diverse), "two_tier" (documents, then chunks)  # noqa: E501
+        chain_type: str = "stuff"  # "auto": stuff if it fits, else map_reduce
 
     class OutputSchema(BaseModel):
         response: str
@@ -34,70 +55,287 @@ class DocumentQA(BaseOpenAI):
         db_type: str = "elasticsearch",
         chain_type: str = "stuff",
         include_source: bool = False,
+        retrieval: str = "vector",
         **kwargs
     ):
 
         if chain_type not in self.CHAIN_TYPES:
             raise ValueError(f"chain_type must be one of {self.CHAIN_TYPES}")
+        if retrieval not in self.RETRIEVAL_MODES:
+            raise ValueError(f"retrieval must be one of {self.RETRIEVAL_MODES}")  # noqa: E501
 
         super().__init__(**kwargs)
 
         # different chain type if source is required!
         self.include_source = include_source
-        ChainClass = RetrievalQAWithSourcesChain if include_source else RetrievalQA  # noqa: E501
-        self.qa = ChainClass.from_chain_type(
-            llm=self.llm,
-            chain_type=chain_type,
-            retriever=self.__configure_db(db_name, db_type),
-            callbacks=[self.openai_callback],
+        self.question_vector = None
+        self.chain_type = chain_type
+        self.retrieval = retrieval
+        retriever = self.configure_retriever(db_name, db_type)
+        self.retriever = CachedRetriever(
+            retriever=retriever,
+            embeddings=ClientRegistry.get_embeddings(),
+            collections=self.collections,
+            params={"database": self.database},
         )
+        self.qa = self.build_chain(self.llm)
 
         return None
 
-    def __configure_db(self, db_name: str, db_type: str):
-        settings = Settings()
-        embedding = OpenAIEmbeddings(openai_api_key=settings.OPENAI_KEY)
+    def build_chain(self, llm, callbacks: list = None):
+        """retrieval chain; auto is stuff here, see answer_documents
+        callbacks default to this request's usage callback"""
+        chain_type = "stuff" if self.chain_type == "auto" else self.chain_type
+        retriever = self.retriever
+        budget = get_settings().CONTEXT_TOKEN_BUDGET
+        if chain_type == "stuff" and budget > 0:
+            retriever = PackedRetriever(
+                retriever=retriever, budget=budget, usage=self.usage_extra
+            )
+        ChainClass = RetrievalQAWithSourcesChain if self.include_source else RetrievalQA  # noqa: E501
+        return ChainClass.from_chain_type(
+            llm=llm,
+            chain_type=chain_type,
+            retriever=retriever,
+            callbacks=[self.openai_callback] if callbacks is None else callbacks,  # noqa: E501
+        )
+
+    def concurrent_map(self) -> bool:
+        """async answers for auto and map_reduce use answer_documents"""
+        return self.chain_type in ["auto", "map_reduce"] and not self.include_source  # noqa: E501
+
+    async def __map(self, question: str, docs: list, llm) -> list:
+        """relevant extract of every chunk, MAP_CONCURRENCY calls at a time"""
+        semaphore = Semaphore(get_settings().MAP_CONCURRENCY)
+        # map outputs are not part of the stream
+        quiet = ClientRegistry.derive(
+            llm, streaming=False, callbacks=[self.openai_callback]
+        )
+        prompt = QUESTION_PROMPT_SELECTOR.get_prompt(quiet)
+
+        async def extract(doc: Document) -> Document:
+            messages = prompt.format_messages(
+                context=doc.page_content, question=question
+            )
+            async with semaphore:
+                message = await self.scheduled(
+                    lambda: quiet.ainvoke(messages),
+                    ModelRouter.count_tokens(doc.page_content) + 500,
+                    llm=llm,
+                )
+            return Document(page_content=message.content, metadata=doc.metadata)  # noqa: E501
+
+        return list(await gather(*[extract(x) for x in docs]))
+
+    async def answer_documents(self, question: str, llm=None) -> str:
+        """
+        retrieve, then stuff when the context fits CONTEXT_TOKEN_BUDGET,
+        otherwise map chunks concurrently and stuff the extracts (reduce)
+        """
+        llm = llm or self.llm
+        docs = await self.retriever.ainvoke(question)
+        docs, stats = ContextPacker.pack(docs, budget=0)  # deduplicate only
+        chain_type = self.chain_type
+        if chain_type == "auto":
+            fits = stats["packed_tokens"] <= get_settings().CONTEXT_TOKEN_BUDGET  # noqa: E501
+            chain_type = "stuff" if fits else "map_reduce"
+        self.usage_extra.update({"chain_type": chain_type, "context": stats})
+
+        if chain_type == "map_reduce":
+            docs = await self.__map(question, docs, llm)
+        combine = load_qa_chain(llm, chain_type="stuff", callbacks=[self.openai_callback])  # noqa: E501
+        tokens = sum(ModelRouter.count_tokens(x.page_content) for x in docs)
+        return await self.scheduled(
+            lambda: combine.arun(input_documents=docs, question=question),
+            tokens + 500,
+            llm=llm,
+        )
+
+    def use_model(self, model_name: str, reason: str = ""):
+        super().use_model(model_name, reason)
+        self.qa = self.build_chain(self.llm)
+
+    def cache_key(self, endpoint: str, **inputs) -> str:
+        return super().cache_key(
+            endpoint,
+            retrieval=self.retrieval,
+            chain_type=self.chain_type,
+            **inputs
+        )
+
+    def open_store(self, db_name: str, db_type: str):
+        """vector store of a collection, on the shared clients"""
+        settings = get_settings()
+        embedding = ClientRegistry.get_embeddings()
         if db_type.lower() == 'elasticsearch':
-            db = ElasticsearchStore(
+            self.database = "elasticsearch"
+            return ElasticsearchStore(
                 index_name=db_name,
                 embedding=embedding,
-                es_url=settings.ELASTICSEARCH_URL
+                es_connection=ClientRegistry.get_elasticsearch(),
             )
-            self.database = "elasticsearch"
-        else:
-            db = Chroma(
-                persist_directory=f"{settings.CHROMA_PATH}/{db_name}",
-                embedding_function=embedding,
+        if db_type.lower() == 'local':
+            self.database = "local"
+            return LocalVectorStore(
+                path=LocalVectorStore.collection_path(db_name),
+                embedding=embedding,
             )
-            self.database = "chroma"
+        self.database = "chroma"
+        return Chroma(
+            persist_directory=f"{settings.CHROMA_PATH}/{db_name}",
+            embedding_function=embedding,
+        )
+
+    def configure_retriever(self, db_name: str, db_type: str):
+        self.collection = db_name
+        self.collections = [db_name]
+        db = self.open_store(db_name, db_type)
+        if self.retrieval == "hybrid" and self.database == "elasticsearch":
+            self.usage_extra["retrieval"] = "hybrid"
+            return HybridRetriever(store=db)
+        if self.retrieval == "two_tier" and self.database == "elasticsearch":
+            self.usage_extra["retrieval"] = "two_tier"
+            return TwoTierRetriever(
+                documents=self.open_store(DocumentPooling.index_name(db_name), db_type),  # noqa: E501
+                chunks=db,
+                top_documents=get_settings().TWO_TIER_DOCUMENTS,
+            )
+        if self.retrieval == "mmr":
+            params = Reranking.params(db_name)
+            self.usage_extra["retrieval"] = "mmr"
+            return MmrRetriever(
+                store=db,
+                fetch_k=params["fetch_k"],
+                lambda_mult=params["lambda"],
+            )
+        if self.database == "elasticsearch":
+            return KnnRetriever(store=db)  # num_candidates read when searching
         return db.as_retriever()
 
+    async def __semantic_lookup(self, question: str):
+        """answer of a similar past question (about* collections), or None"""
+        self.question_vector = None
+        if not self.use_cache or self.include_source:
+            return None
+        if not SemanticCache.applies_to(self.collection):
+            return None
+        try:
+            vector = await ClientRegistry.get_embeddings().aembed_query(question)  # noqa: E501
+        except Exception as e:
+            print("semantic cache: question not embedded", e)
+            return None
+
+        self.question_vector = SemanticCache.normalize(vector)
+        answer, similarity = SemanticCache.lookup(
+            self.collection, self.llm.model_name, self.question_vector,
+            generation=await CollectionGeneration.aget(self.collection),
+        )
+        if answer is not None:
+            self.cache_hit = True
+            self.usage_extra["semantic_similarity"] = round(similarity, 4)
+        return answer
+
+    async def __semantic_store(self, question: str, answer: str):
+        if self.question_vector is not None:
+            SemanticCache.store(
+                self.collection, self.llm.model_name,
+                question, self.question_vector, answer,
+                generation=await CollectionGeneration.aget(self.collection),
+            )
+
     def ask(self, question: str) -> str:
+        self.route(question)
+        key = self.cache_key("ask", question=question)
+        response = self.cache_get(key)
+        if response is None:
+            response = self.scheduled_blocking(
+                lambda: self.qa.run(question), self.ESTIMATED_TOKENS
+            )
+            self.cache_set(key, response)
+        return {
+            "response": response,
+            "metrics": self.collect_usage()
+        }
 
-        response = self.qa.run(question)
+    async def aask(self, question: str) -> dict:
+        """async counterpart of ask, waits on the event loop (no thread)"""
+        self.route(question)
+        key = await self.acache_key("ask", question=question)
+        response = await self.acache_get(key)
+        if response is None:
+            response = await self.__semantic_lookup(question)
+        if response is None and self.concurrent_map():
+            response = await self.answer_documents(question)
+            await self.acache_set(key, response)
+            await self.__semantic_store(question, response)
+        elif response is None:
+            outputs = await self.scheduled(
+                lambda: self.qa.ainvoke({self.qa.input_keys[0]: question}),
+                self.ESTIMATED_TOKENS,
+            )
+            response = outputs[self.qa.output_keys[0]]
+            await self.acache_set(key, response)
+            await self.__semantic_store(question, response)
         return {
             "response": response,
             "metrics": self.collect_usage()
         }
 
-    async def ask_stream(self, question: str):
+    async def ask_stream(self, question: str, is_disconnected=None):
         self.validate_streaming()
+        self.route(question)
 
-        if self.include_source:
-            task = self.create_asyncio_wrapped_task(
-                self.qa.acall({"question": question}, return_only_outputs=False)  # noqa: E501
-            )
-        else:
-            task = self.create_asyncio_wrapped_task(
-                self.qa.arun(question)
-            )
+        answer = await self.__semantic_lookup(question)
+        if answer is not None:
+            async for chunk in self.replay_stream(answer):
+                yield chunk
+            _ = self.collect_usage()
+            return
+
+        def generate(llm=None):
+            if self.concurrent_map():
+                return self.answer_documents(question, llm)
+            qa = self.qa if llm is None else self.build_chain(llm)
+            if self.include_source:
+                make_call = lambda: qa.acall({"question": question}, return_only_outputs=False)  # noqa: E501, E731
+            else:
+                make_call = lambda: qa.arun(question)  # noqa: E731
+            return self.scheduled(make_call, self.ESTIMATED_TOKENS, llm=llm)
+
+        key = await self.acache_key(
+            "ask_stream", question=question, include_source=self.include_source
+        )
+        async for chunk in self.stream_tokens(
+            generate(),
+            key,
+            is_disconnected,
+            make_alternate=generate,
+        ):
+            yield chunk
 
-        async for token in self.async_callback.aiter():
-            yield token
+        if not self.cache_hit and self.result is not None:
+            await self.__semantic_store(question, self.answer)
 
-        await task
-        print(self.result)
-        print(type(self.result))
-        _ = self.collect_usage()
+    @staticmethod
+    async def warm_up_semantic_cache(faq_file: str):
+        """
+        ask known questions once, e.g. at startup, answers fill the caches
+        faq_file is json {collection: [question, ...]}
+        """
+        with open(faq_file) as f:
+            faq = loads(f.read())
+        defaults = DocumentQA.InputSchema(question="")
+        for collection, questions in faq.items():
+            for question in questions:
+                try:
+                    agent = DocumentQA(
+                        db_name=collection,
+                        priority="bulk",
+                        temperature=defaults.temperature,
+                        model_name=defaults.model,
+                    )
+                    await agent.aask(question)
+                except Exception as e:
+                    print(f"warm-up failed {collection}: {question}", e)
 
 # %%
@@ -1,48 +1,160 @@
 # Yan Pan, 2023
-
-from langchain.agents import initialize_agent
-from langchain.agents import AgentType
+from asyncio import create_task, wait
+from langchain.agents import AgentType, initialize_agent
 from langchain_core.tools import Tool
+from threading import Lock
 
+from prompts.ClientRegistry import ClientRegistry
+from prompts.CollectionGeneration import CollectionGeneration
 from prompts.DocumentQA import DocumentQA
+from prompts.FederatedRetriever import FederatedRetriever
 
 
-class DocumentQAMultiple():
-
-    def __init__(self):
-        QA1 = DocumentQA(db_name="log-rolling", db_type="elasticsearch")
-        QA2 = DocumentQA(db_name="codebase-default", db_type="elasticsearch")
+class DocumentQAMultiple(DocumentQA):
+    """
+    questions across several collections, logs and code base by default
+    federated: all collections retrieved concurrently and merged by score,
+        answered (and streamed) like DocumentQA
+    agent: one tool per collection, agent and tools are built once
+    """
 
-        tools = [
-            Tool(
-                name="Logging",
-                func=QA2.qa.run,
-                description="""
+    COLLECTIONS = ["log-rolling", "codebase-default"]
+    TOOLS = {
+        "log-rolling": ("Logging", """
 You may find the logs (debug info, warning, info, errors) here.
 Each line contains a json object,
 and the last field ('time') contains a unix format time tag.
 If your answer would need time,
 please translate the unix time to human readable short date time.
-                """.replace("\n", " "),
-            ),
-            Tool(
-                name="Codebase",
-                func=QA2.qa.run,
-                description="""
+        """.replace("\n", " ")),
+        "codebase-default": ("Codebase", """
 The code base can be find here.
 If question about why a certain warning/error occurred,
 it is useful to find relevant code piece and perform analysis.
-                """.replace("\n", " "),
-            ),
-        ]
+        """.replace("\n", " ")),
+    }
+
+    class InputSchema(DocumentQA.InputSchema):
+        collection: str = "default"  # comma separated, default COLLECTIONS
+        # the shared agent (gpt-4o, temperature 0.1, vector retrieval of
+        # TOOLS): model, temperature, retrieval, chain_type and collection
+        # of the request are not applied to it
+        use_agent: bool = False
+
+    DISCONNECT_POLL = 0.5  # seconds between disconnect checks of the agent
+
+    _agent = None
+    _lock = Lock()
+
+    def __init__(
+        self,
+        collections: list[str] = None,
+        db_type: str = "elasticsearch",
+        **kwargs
+    ):
+        super().__init__(
+            db_name=",".join(collections or self.COLLECTIONS),
+            db_type=db_type,
+            **kwargs
+        )
+
+    def configure_retriever(self, db_name: str, db_type: str):
+        self.collection = db_name
+        self.collections = db_name.split(",")
+        stores = {x: self.open_store(x, db_type) for x in self.collections}
+        return FederatedRetriever(
+            stores=stores,
+            embeddings=ClientRegistry.get_embeddings(),
+        )
+
+    def cache_key(self, endpoint: str, **inputs) -> str:
+        return super().cache_key(
+            endpoint,
+            generations=[CollectionGeneration.get(x) for x in self.collections],  # noqa: E501
+            **inputs
+        )
 
-        self.agent = initialize_agent(
+    @staticmethod
+    def __build_agent():
+        tools = []
+        # shared by all requests: usage is counted by run-time callbacks only
+        llm = ClientRegistry.get_chat(temperature=0.1)
+        for collection, (name, description) in DocumentQAMultiple.TOOLS.items():  # noqa: E501
+            qa = DocumentQA(
+                db_name=collection, chain_type="stuff", temperature=0.1
+            ).build_chain(llm, callbacks=[])
+            tools.append(Tool(
+                name=name,
+                description=description,
+                func=lambda q, callbacks=None, qa=qa: qa.run(q, callbacks=callbacks),  # noqa: E501
+                coroutine=lambda q, callbacks=None, qa=qa: qa.arun(q, callbacks=callbacks),  # noqa: E501
+            ))
+        return initialize_agent(
             tools=tools,
-            llm=QA1.llm,
-            agent=AgentType.SELF_ASK_WITH_SEARCH,
-            verbose=True,
-            # return_intermediate_steps=True
+            llm=llm,
+            agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+            handle_parsing_errors=True,  # unparsable steps go back to the llm
+        )
+
+    @classmethod
+    def agent(cls):
+        """built on first use, shared by all requests"""
+        with cls._lock:
+            if cls._agent is None:
+                cls._agent = cls.__build_agent()
+            return cls._agent
+
+    def ask_agent(self, question: str) -> dict:
+        outputs = self.scheduled_blocking(
+            lambda: self.agent().invoke(
+                {"input": question}, config={"callbacks": [self.openai_callback]}  # noqa: E501
+            ),
+            self.ESTIMATED_TOKENS * len(self.TOOLS),
+        )
+        return {
+            "response": outputs["output"],
+            "metrics": self.collect_usage()
+        }
+
+    async def aask_agent(self, question: str) -> dict:
+        outputs = await self.scheduled(
+            lambda: self.agent().ainvoke(
+                {"input": question}, config={"callbacks": [self.openai_callback]}  # noqa: E501
+            ),
+            self.ESTIMATED_TOKENS * len(self.TOOLS),
         )
+        return {
+            "response": outputs["output"],
+            "metrics": self.collect_usage()
+        }
 
-    def ask(self, question):
-        return self.agent.run(question)
+    async def agent_stream(self, question: str, is_disconnected=None):
+        """
+        the agent answer as one chunk, intermediate steps are not sent.
+        the agent is cancelled when the client disconnects, an agent error
+        ends the stream without an answer (usage is still collected)
+        is_disconnected: async callable, e.g. starlette request.is_disconnected
+        """
+        task = create_task(self.aask_agent(question))
+        try:
+            while not task.done():
+                await wait([task], timeout=self.DISCONNECT_POLL)
+                if is_disconnected is not None and await is_disconnected():
+                    break
+        finally:
+            cancelled = not task.done()  # disconnected, or stream cancelled
+            if cancelled:
+                task.cancel()
+                self.usage_extra["cancelled"] = True
+                _ = self.collect_usage()
+        if cancelled:
+            return
+        try:
+            result = task.result()
+        except Exception as e:  # the response has started, as wrap_done
+            print(f"Caught exception: {e}")
+            self.usage_extra["error"] = str(e)
+            _ = self.collect_usage()
+            return
+        async for chunk in self.replay_stream(result["response"]):
+            yield chunk
@@ -0,0 +1,307 @@
+# Yan Pan, 2023
+import numpy as np
+from asyncio import to_thread
+from collections import OrderedDict
+from hashlib import sha256
+from langchain_core.embeddings import Embeddings
+from threading import Lock
+
+from botSettings.settings import get_settings
+from prompts.SqliteStore import SqliteStore
+
+
+class EmbeddingCache:
+    """
+    query vectors keyed by sha256 of (embedding model, normalized text),
+    the question text itself is not kept
+    tier 1: in-memory LRU, bounded by EMBEDDING_CACHE_SIZE (0 disables)
+    tier 2: sqlite under CACHE_PATH if EMBEDDING_CACHE_PERSIST (off by default)
+    async code uses aget/aset, the sqlite tier runs in a worker thread
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS query_vectors "
+        "(key TEXT PRIMARY KEY, vector BLOB)"
+    )
+
+    _memory: OrderedDict = OrderedDict()
+    _lock = Lock()
+    _stats = {"hits_memory": 0, "hits_disk": 0, "misses": 0}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    @classmethod
+    def key(cls, model: str, text: str) -> str:
+        return sha256(f"{model}\0{cls.normalize(text)}".encode()).hexdigest()
+
+    @staticmethod
+    def __execute(sql: str, params: tuple = ()):
+        return SqliteStore.execute("cache.db", EmbeddingCache.SCHEMA, sql, params)  # noqa: E501
+
+    @staticmethod
+    def __persistent() -> bool:
+        settings = get_settings()
+        return bool(settings.CACHE_PATH) and settings.EMBEDDING_CACHE_PERSIST
+
+    @classmethod
+    def __remember(cls, key: str, vector: list[float]):
+        with cls._lock:
+            cls._memory[key] = vector
+            cls._memory.move_to_end(key)
+            while len(cls._memory) > get_settings().EMBEDDING_CACHE_SIZE:
+                cls._memory.popitem(last=False)
+
+    @classmethod
+    def __memory_get(cls, key: str):
+        with cls._lock:
+            vector = cls._memory.get(key)
+            if vector is not None:
+                cls._memory.move_to_end(key)
+                cls._stats["hits_memory"] += 1
+        return vector
+
+    @classmethod
+    def __disk_get(cls, key: str):
+        try:
+            row = cls.__execute(
+                "SELECT vector FROM query_vectors WHERE key=?", (key,)
+            )
+        except Exception as e:
+            print("embedding cache disk tier not readable", e)
+            return None
+        if row:
+            vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+            cls.__remember(key, vector)
+            with cls._lock:
+                cls._stats["hits_disk"] += 1
+            return vector
+        return None
+
+    @classmethod
+    def __disk_set(cls, key: str, vector: list[float]):
+        try:
+            cls.__execute(
+                "INSERT OR REPLACE INTO query_vectors VALUES (?, ?)",
+                (key, np.asarray(vector, dtype=np.float32).tobytes())
+            )
+        except Exception as e:
+            print("embedding cache disk tier not writable", e)
+
+    @classmethod
+    def __miss(cls):
+        with cls._lock:
+            cls._stats["misses"] += 1
+        return None
+
+    @classmethod
+    def get(cls, model: str, text: str):
+        """cached vector or None"""
+        if get_settings().EMBEDDING_CACHE_SIZE <= 0:
+            return None
+        key = cls.key(model, text)
+        vector = cls.__memory_get(key)
+        if vector is None and cls.__persistent():
+            vector = cls.__disk_get(key)
+        return cls.__miss() if vector is None else vector
+
+    @classmethod
+    async def aget(cls, model: str, text: str):
+        """get, without blocking the event loop"""
+        if get_settings().EMBEDDING_CACHE_SIZE <= 0:
+            return None
+        key = cls.key(model, text)
+        vector = cls.__memory_get(key)
+        if vector is None and cls.__persistent():
+            vector = await to_thread(cls.__disk_get, key)
+        return cls.__miss() if vector is None else vector
+
+    @classmethod
+    def set(cls, model: str, text: str, vector: list[float]):
+        if get_settings().EMBEDDING_CACHE_SIZE <= 0:
+            return None
+        key = cls.key(model, text)
+        cls.__remember(key, vector)
+        if cls.__persistent():
+            cls.__disk_set(key, vector)
+        return None
+
+    @classmethod
+    async def aset(cls, model: str, text: str, vector: list[float]):
+        """set, without blocking the event loop"""
+        if get_settings().EMBEDDING_CACHE_SIZE <= 0:
+            return None
+        key = cls.key(model, text)
+        cls.__remember(key, vector)
+        if cls.__persistent():
+            await to_thread(cls.__disk_set, key, vector)
+        return None
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            lookups = sum(cls._stats.values())
+            hits = cls._stats["hits_memory"] + cls._stats["hits_disk"]
+            return {
+                **cls._stats,
+                "size": len(cls._memory),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._memory.clear()
+
+
+class ChunkEmbeddingCache:
+    """
+    document (chunk) vectors keyed by sha256 of (embedding model, text),
+    float32 in sqlite CACHE_PATH/embeddings.db. a rebuilt collection only
+    embeds the chunks that changed. CHUNK_EMBEDDING_CACHE=False disables
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS chunk_embeddings "
+        "(key BLOB PRIMARY KEY, vector BLOB)"
+    )
+    MAX_KEYS = 500  # per SELECT, below the sqlite variable limit
+
+    _lock = Lock()
+    _stats = {"hits": 0, "misses": 0, "calls_saved": 0}
+
+    @staticmethod
+    def key(model: str, text: str) -> bytes:
+        return sha256(f"{model}\0{text}".encode()).digest()
+
+    @staticmethod
+    def enabled() -> bool:
+        settings = get_settings()
+        return bool(settings.CACHE_PATH) and settings.CHUNK_EMBEDDING_CACHE
+
+    @classmethod
+    def get_many(cls, model: str, texts: list[str]) -> list:
+        """vector or None for each text"""
+        if not cls.enabled() or not texts:
+            return [None for _ in texts]
+        keys = [cls.key(model, x) for x in texts]
+        rows = {}
+        try:
+            for i in range(0, len(keys), cls.MAX_KEYS):
+                part = keys[i:i + cls.MAX_KEYS]
+                rows.update(SqliteStore.execute(
+                    "embeddings.db", cls.SCHEMA,
+                    f"SELECT key, vector FROM chunk_embeddings WHERE key IN ({','.join('?' * len(part))})",  # noqa: E501
+                    part, fetch_all=True,
+                ))
+        except Exception as e:
+            print("chunk embedding cache not readable", e)
+            return [None for _ in texts]
+        return [
+            np.frombuffer(rows[x], dtype=np.float32).tolist() if x in rows else None  # noqa: E501
+            for x in keys
+        ]
+
+    @classmethod
+    def set_many(cls, model: str, texts: list[str], vectors: list):
+        if not cls.enabled() or not texts:
+            return None
+        try:
+            SqliteStore.execute(
+                "embeddings.db", cls.SCHEMA,
+                "INSERT OR IGNORE INTO chunk_embeddings VALUES (?, ?)",
+                [
+                    (cls.key(model, x), np.asarray(y, dtype=np.float32).tobytes())  # noqa: E501
+                    for x, y in zip(texts, vectors)
+                ],
+                many=True,
+            )
+        except Exception as e:
+            print("chunk embedding cache not writable", e)
+        return None
+
+    @classmethod
+    def record(cls, hits: int, misses: int, calls_saved: int):
+        """one embed_documents call: cached texts, embedded texts and the
+        embedding API calls avoided"""
+        with cls._lock:
+            cls._stats["hits"] += hits
+            cls._stats["misses"] += misses
+            cls._stats["calls_saved"] += calls_saved
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            lookups = cls._stats["hits"] + cls._stats["misses"]
+            return {
+                **cls._stats,
+                "hit_rate": cls._stats["hits"] / lookups if lookups else 0.0,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    embeddings with cached queries (EmbeddingCache) and documents
+    (ChunkEmbeddingCache), handed to the vector stores so that every
+    retriever and every ingestion shares the caches
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model: str,
+        on_record: callable = None,
+    ):
+        self.embeddings = embeddings
+        self.model = model
+        # on_record(hits, calls_saved) per embed_documents, e.g. job progress
+        self.on_record = on_record
+
+    def api_calls(self, texts: int) -> int:
+        """embedding requests for a number of texts, batched when wrapped
+        in ScheduledEmbeddings (BATCH_SIZE), one request otherwise"""
+        batch = getattr(self.embeddings, "BATCH_SIZE", 0) or max(texts, 1)
+        return -(-texts // batch)
+
+    def __record(self, texts: int, missing: int):
+        hits, saved = texts - missing, self.api_calls(texts) - self.api_calls(missing)  # noqa: E501
+        ChunkEmbeddingCache.record(hits, missing, saved)
+        if self.on_record is not None:
+            self.on_record(hits, saved)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = ChunkEmbeddingCache.get_many(self.model, texts)
+        missing = [i for i, x in enumerate(vectors) if x is None]
+        if missing:
+            embedded = self.embeddings.embed_documents([texts[i] for i in missing])  # noqa: E501
+            ChunkEmbeddingCache.set_many(self.model, [texts[i] for i in missing], embedded)  # noqa: E501
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+        self.__record(len(texts), len(missing))
+        return vectors
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = await to_thread(ChunkEmbeddingCache.get_many, self.model, texts)  # noqa: E501
+        missing = [i for i, x in enumerate(vectors) if x is None]
+        if missing:
+            embedded = await self.embeddings.aembed_documents([texts[i] for i in missing])  # noqa: E501
+            await to_thread(ChunkEmbeddingCache.set_many, self.model, [texts[i] for i in missing], embedded)  # noqa: E501
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+        self.__record(len(texts), len(missing))
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = EmbeddingCache.get(self.model, text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            EmbeddingCache.set(self.model, text, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        vector = await EmbeddingCache.aget(self.model, text)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await EmbeddingCache.aset(self.model, text, vector)
+        return vector
@@ -0,0 +1,73 @@
+# Yan Pan, 2023
+from asyncio import gather, to_thread
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from prompts.KnnIndex import KnnIndex
+
+
+class FederatedRetriever(BaseRetriever):
+    """
+    one question, several collections queried concurrently.
+    the question is embedded once, hits are merged by relevance score
+    (normalized by each store) and tagged with metadata.collection
+    """
+
+    stores: dict  # collection name: VectorStore
+    embeddings: Embeddings
+    k: int = 4  # per collection and in total
+    search_kwargs: dict = {}  # collection: store specific, fetch_k is KnnIndex
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def search(self, collection: str, vector: list[float]) -> list[tuple]:
+        store = self.stores[collection]
+        try:
+            hits = store.similarity_search_by_vector_with_relevance_scores(
+                vector, k=self.k,
+                **KnnIndex.search_kwargs(store, self.k),
+                **self.search_kwargs.get(collection, {}),
+            )
+        except Exception as e:
+            print(f"federated search skipped {collection}", e)
+            return []
+        relevance = store._select_relevance_score_fn()
+        return [
+            (Document(
+                page_content=doc.page_content,
+                metadata={**doc.metadata, "collection": collection},
+            ), relevance(score))
+            for doc, score in hits
+        ]
+
+    def merge(self, results: list[list[tuple]]) -> list[Document]:
+        hits = sorted(
+            [x for result in results for x in result],
+            key=lambda x: x[1],
+            reverse=True,
+        )
+        return [doc for doc, _ in hits[:self.k]]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector = self.embeddings.embed_query(query)
+        with ThreadPoolExecutor(max_workers=len(self.stores) or 1) as pool:
+            results = pool.map(lambda x: self.search(x, vector), self.stores)
+            return self.merge(list(results))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector = await self.embeddings.aembed_query(query)
+        results = await gather(
+            *[to_thread(self.search, x, vector) for x in self.stores]
+        )
+        return self.merge(results)
@@ -0,0 +1,85 @@
+# Yan Pan, 2023
+from asyncio import create_task, FIRST_COMPLETED, Task, wait
+from typing import AsyncIterator
+
+
+class Racer:
+    """one backend generating into its own AsyncIteratorCallbackHandler"""
+
+    def __init__(self, backend: str, task: Task, callback):
+        self.backend = backend
+        self.task = task
+        self.callback = callback
+        self.first = create_task(self.__first_token())
+
+    async def __first_token(self):
+        """None if generation ended without any token"""
+        async for token in self.callback.aiter():
+            return token
+        return None
+
+    def has_token(self) -> bool:
+        return self.first.done() and self.first.result() is not None
+
+
+class Hedging:
+    """
+    hedged streams: when the first token is late, the same request is sent
+    to the other backend (OpenAI <-> Azure OpenAI). the first backend to
+    stream wins, the other generation is cancelled
+    """
+
+    _stats = {"requests": 0, "hedged": 0, "wins": {}}
+
+    @classmethod
+    async def tokens(
+        cls,
+        flight,
+        primary: Racer,
+        start_alternate: callable,
+        delay: float,
+        usage: dict,
+    ) -> AsyncIterator[str]:
+        """
+        tokens of the winner; primary is flight.upstream, already running.
+        start_alternate() returns a running Racer, called after delay.
+        flight.upstream becomes the winner, usage gets hedged and winner
+        """
+        cls._stats["requests"] += 1
+        racers = [primary]
+        done, _ = await wait({primary.first}, timeout=delay)
+        if not done:
+            alternate = start_alternate()
+            racers.append(alternate)
+            flight.racing.append(alternate.task)
+            cls._stats["hedged"] += 1
+            pending = {primary.first, alternate.first}
+            while pending and not any(x.has_token() for x in racers):
+                _, pending = await wait(pending, return_when=FIRST_COMPLETED)
+
+        # primary wins ties, also when no backend produced a token
+        winner = next((x for x in racers if x.has_token()), primary)
+        for racer in racers:
+            if racer is not winner and not racer.task.done():
+                racer.task.cancel()
+        flight.upstream, flight.racing = winner.task, []
+        usage["hedged"] = len(racers) > 1
+        if usage["hedged"]:
+            usage["hedge_winner"] = winner.backend
+            wins = cls._stats["wins"]
+            wins[winner.backend] = wins.get(winner.backend, 0) + 1
+
+        if not winner.has_token():
+            return
+        yield winner.first.result()
+        async for token in winner.callback.aiter():
+            yield token
+
+    @classmethod
+    def stats(cls) -> dict:
+        requests, hedged = cls._stats["requests"], cls._stats["hedged"]
+        return {
+            **cls._stats,
+            "wins": dict(cls._stats["wins"]),
+            "hedge_rate": hedged / requests if requests else 0.0,
+        }
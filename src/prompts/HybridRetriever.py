@@ -0,0 +1,90 @@
+# Yan Pan, 2023
+from asyncio import gather, to_thread
+from concurrent.futures import ThreadPoolExecutor
+from langchain_community.vectorstores import ElasticsearchStore
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from prompts.KnnIndex import KnnIndex
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    BM25 and kNN against the same Elasticsearch index, run concurrently
+    and fused by reciprocal rank: score = sum of 1 / (rrf_k + rank).
+    exact identifiers (error codes, function names) are found by BM25,
+    paraphrases by kNN. fusion is client side, no license required
+    """
+
+    store: ElasticsearchStore
+    k: int = 4
+    fetch_k: int = 20  # candidates from each query
+    rrf_k: int = 60
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __search(self, body: dict) -> list[dict]:
+        store = self.store
+        response = store.client.search(
+            index=store.index_name,
+            **body,
+            size=self.fetch_k,
+            source=[store.query_field, "metadata"],
+        )
+        return response["hits"]["hits"]
+
+    def bm25(self, query: str) -> list[dict]:
+        return self.__search(
+            {"query": {"match": {self.store.query_field: query}}}
+        )
+
+    def knn(self, vector: list[float]) -> list[dict]:
+        return self.__search({"knn": {
+            "field": self.store.vector_query_field,
+            "query_vector": vector,
+            "k": self.fetch_k,
+            "num_candidates": KnnIndex.num_candidates(self.store, self.fetch_k),  # noqa: E501
+        }})
+
+    def fuse(self, *rankings: list[dict]) -> list[Document]:
+        scores, hits = {}, {}
+        for ranking in rankings:
+            for rank, hit in enumerate(ranking, start=1):
+                scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + 1 / (self.rrf_k + rank)  # noqa: E501
+                hits[hit["_id"]] = hit
+        best = sorted(scores, key=scores.get, reverse=True)[:self.k]
+        return [
+            Document(
+                page_content=hits[x]["_source"].get(self.store.query_field, ""),  # noqa: E501
+                metadata={
+                    **hits[x]["_source"].get("metadata", {}),
+                    "rrf_score": scores[x],
+                },
+            )
+            for x in best
+        ]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            lexical = pool.submit(self.bm25, query)
+            semantic = pool.submit(
+                lambda: self.knn(self.store.embedding.embed_query(query))
+            )
+            return self.fuse(lexical.result(), semantic.result())
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        async def semantic():
+            vector = await self.store.embedding.aembed_query(query)
+            return await to_thread(self.knn, vector)
+
+        lexical, semantic = await gather(to_thread(self.bm25, query), semantic())  # noqa: E501
+        return self.fuse(lexical, semantic)
@@ -0,0 +1,245 @@
+# Yan Pan, 2023
+from asyncio import iscoroutinefunction, run, to_thread
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from json import dumps, loads
+from os import getpid, kill
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+from botSettings.settings import get_settings
+from prompts.SqliteStore import SqliteStore
+
+
+class IngestionRejected(Exception):
+    """too many ingestion jobs queued"""
+
+
+class IngestionJobs:
+    """
+    vector collections are built in the background: endpoints enqueue a job
+    and return its id, a bounded thread pool (INGEST_MAX_JOBS per worker)
+    loads, splits and embeds off the event loop.
+    job records (counters, elapsed, error) are in sqlite under CACHE_PATH
+    so that any worker can report them, in-process if the path is not set.
+    ingestion code adds progress with IngestionJobs.report(...)
+    blocking (sqlite), async endpoints use asubmit
+    the newest INGEST_JOBS_KEPT records are kept, finished jobs leave the
+    process memory once written. records left queued/running by a worker
+    that exited are failed when the pool starts (pids of this host)
+    """
+
+    COUNTERS = [
+        "documents", "chunks", "embeddings",
+        "log_lines",  # LogTemplates
+        "embeddings_cached", "embedding_calls_saved",  # ChunkEmbeddingCache
+    ]
+    SAVE_INTERVAL = 1.0  # seconds between progress writes
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS ingestion_jobs "
+        "(id TEXT PRIMARY KEY, created REAL, record TEXT)"
+    )
+
+    _pool = None
+    _local: dict = {}
+    _lock = Lock()
+    _current: ContextVar = ContextVar("ingestion_job", default=None)
+
+    @staticmethod
+    def __execute(sql: str, params: tuple = (), fetch_all: bool = False):
+        return SqliteStore.execute(
+            "cache.db", IngestionJobs.SCHEMA, sql, params, fetch_all=fetch_all
+        )
+
+    @classmethod
+    def save(cls, job: dict):
+        settings = get_settings()
+        finished = job["status"] in ["done", "failed"]
+        with cls._lock:
+            cls._local[job["id"]] = dict(job)
+        if settings.CACHE_PATH:
+            try:
+                cls.__execute(
+                    "INSERT OR REPLACE INTO ingestion_jobs VALUES (?, ?, ?)",
+                    (job["id"], job["created"], dumps(job, default=str)),
+                )
+                if finished:
+                    cls.__execute(
+                        "DELETE FROM ingestion_jobs WHERE id NOT IN "
+                        "(SELECT id FROM ingestion_jobs ORDER BY created DESC LIMIT ?)",  # noqa: E501
+                        (settings.INGEST_JOBS_KEPT,),
+                    )
+                    with cls._lock:
+                        cls._local.pop(job["id"], None)
+            except Exception as e:
+                print("ingestion job not writable", e)
+        if finished:
+            cls.__trim_local(settings.INGEST_JOBS_KEPT)
+        return None
+
+    @classmethod
+    def __trim_local(cls, kept: int):
+        """in-process records, when not written: newest finished ones"""
+        with cls._lock:
+            finished = sorted(
+                (x for x in cls._local.values() if x["status"] in ["done", "failed"]),  # noqa: E501
+                key=lambda x: x["created"],
+            )
+            for x in finished[:max(len(finished) - kept, 0)]:
+                del cls._local[x["id"]]
+
+    @staticmethod
+    def __view(job: dict) -> dict:
+        end = job.get("finished") or time()
+        started = job.get("started")
+        embedded = job.get("embeddings", 0)
+        return {
+            **{k: v for k, v in job.items() if k != "saved"},
+            "elapsed": round(end - started, 3) if started else 0.0,
+            "embedding_cache_hit_rate": job.get("embeddings_cached", 0) / embedded if embedded else 0.0,  # noqa: E501
+        }
+
+    @classmethod
+    def get(cls, job_id: str):
+        """job record or None"""
+        job = None
+        if get_settings().CACHE_PATH:
+            try:
+                row = cls.__execute(
+                    "SELECT record FROM ingestion_jobs WHERE id=?", (job_id,)
+                )
+                job = loads(row[0]) if row else None
+            except Exception as e:
+                print("ingestion job not readable", e)
+        if job is None:
+            with cls._lock:
+                job = cls._local.get(job_id)
+        return cls.__view(job) if job else None
+
+    @classmethod
+    def recent(cls, limit: int = 20) -> list[dict]:
+        jobs = []
+        if get_settings().CACHE_PATH:
+            try:
+                rows = cls.__execute(
+                    "SELECT record FROM ingestion_jobs ORDER BY created DESC LIMIT ?",  # noqa: E501
+                    (limit,), fetch_all=True,
+                )
+                jobs = [loads(x[0]) for x in rows]
+            except Exception as e:
+                print("ingestion jobs not readable", e)
+        if not jobs:
+            with cls._lock:
+                jobs = sorted(cls._local.values(), key=lambda x: x["created"], reverse=True)[:limit]  # noqa: E501
+        return [cls.__view(x) for x in jobs]
+
+    @classmethod
+    def pool(cls) -> ThreadPoolExecutor:
+        with cls._lock:
+            if cls._pool is not None:
+                return cls._pool
+            cls._pool = ThreadPoolExecutor(
+                max_workers=max(get_settings().INGEST_MAX_JOBS, 1),
+                thread_name_prefix="ingestion",
+            )
+        cls.__fail_orphans()
+        return cls._pool
+
+    @staticmethod
+    def __alive(pid: int) -> bool:
+        try:
+            kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:  # exists, not ours to signal
+            return True
+        return True
+
+    @classmethod
+    def __fail_orphans(cls):
+        """queued/running records of workers that exited are failed"""
+        if not get_settings().CACHE_PATH:
+            return None
+        try:
+            rows = cls.__execute("SELECT record FROM ingestion_jobs", fetch_all=True)  # noqa: E501
+        except Exception as e:
+            print("ingestion jobs not readable", e)
+            return None
+        for job in [loads(x[0]) for x in rows]:
+            if job["status"] not in ["queued", "running"]:
+                continue
+            if job["worker"] == getpid() or cls.__alive(job["worker"]):
+                continue
+            job.update({
+                "status": "failed",
+                "error": f"worker {job['worker']} exited",
+                "finished": time(),
+            })
+            cls.save(job)
+        return None
+
+    @classmethod
+    def submit(cls, kind: str, collection: str, func, **params) -> dict:
+        """queued job record; func(**params) may be a coroutine function"""
+        with cls._lock:
+            waiting = sum(
+                x["status"] in ["queued", "running"] and x["worker"] == getpid()  # noqa: E501
+                for x in cls._local.values()
+            )
+        if waiting >= get_settings().INGEST_MAX_QUEUED:
+            raise IngestionRejected(f"{waiting} ingestion jobs waiting, retry later")  # noqa: E501
+        job = {
+            "id": uuid4().hex,
+            "kind": kind,
+            "collection": collection,
+            "status": "queued",
+            "worker": getpid(),
+            "created": time(),
+            "started": None,
+            "finished": None,
+            "error": None,
+            "result": None,
+            **{x: 0 for x in cls.COUNTERS},
+        }
+        cls.save(job)
+        queued = cls.__view(job)
+        cls.pool().submit(cls.__run, job, func, params)
+        return queued
+
+    @classmethod
+    async def asubmit(cls, kind: str, collection: str, func, **params) -> dict:  # noqa: E501
+        """submit, the job record is written in a worker thread"""
+        return await to_thread(cls.submit, kind, collection, func, **params)
+
+    @classmethod
+    def __run(cls, job: dict, func, params: dict):
+        job.update({"status": "running", "started": time(), "saved": 0.0})
+        cls.save(job)
+        token = cls._current.set(job)
+        try:
+            result = run(func(**params)) if iscoroutinefunction(func) else func(**params)  # noqa: E501
+            job.update({"status": "done", "result": result})
+        except Exception as e:
+            print(f"ingestion job {job['id']} failed", e)
+            job.update({"status": "failed", "error": str(e)})
+        finally:
+            cls._current.reset(token)
+            job["finished"] = time()
+            cls.save(job)
+
+    @classmethod
+    def report(cls, **counts):
+        """add to the counters of the running job, no-op outside jobs"""
+        job = cls._current.get()
+        if job is None:
+            return None
+        with cls._lock:  # reported from embedding threads too
+            for k, v in counts.items():
+                job[k] = job.get(k, 0) + v
+            due = time() - job["saved"] >= cls.SAVE_INTERVAL
+            if due:
+                job["saved"] = time()
+        if due:
+            cls.save(job)
+        return None
@@ -0,0 +1,83 @@
+# Yan Pan, 2023
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from itertools import islice
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from typing import Iterable, Iterator
+
+from botSettings.settings import get_settings
+from prompts.IngestionJobs import IngestionJobs
+from prompts.ModelRouter import ModelRouter
+
+
+class IngestionPipeline:
+    """
+    load -> split -> embed -> index as generators, nothing is materialized:
+    files are read in blocks of lines, chunks are embedded in batches of
+    INGEST_BATCH_SIZE with at most INGEST_IN_FLIGHT batches at the API,
+    and each embedded batch goes to the index (e.g. one bulk request).
+    peak memory is set by the batch size, not the corpus
+    """
+
+    @staticmethod
+    def file_blocks(path: str, block_chars: int = 0) -> Iterator[Document]:  # noqa: E501
+        """a text file as documents of whole lines, about block_chars each"""
+        block_chars = block_chars or get_settings().INGEST_BLOCK_CHARS
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            lines, size, offset = [], 0, 0
+            for line in f:
+                lines.append(line)
+                size += len(line)
+                if size >= block_chars:
+                    yield Document(page_content="".join(lines), metadata={"source": path, "offset": offset})  # noqa: E501
+                    lines, offset, size = [], offset + size, 0
+            if lines:
+                yield Document(page_content="".join(lines), metadata={"source": path, "offset": offset})  # noqa: E501
+
+    @staticmethod
+    def split(documents: Iterable[Document], splitter) -> Iterator[Document]:  # noqa: E501
+        """chunks with metadata["tokens"] (ContextPacker), one document at a time"""  # noqa: E501
+        for document in documents:
+            chunks = splitter.split_documents([document])
+            for chunk in chunks:
+                chunk.metadata["tokens"] = ModelRouter.count_tokens(chunk.page_content)  # noqa: E501
+            IngestionJobs.report(documents=1, chunks=len(chunks))
+            yield from chunks
+
+    @staticmethod
+    def batches(items: Iterable, size: int) -> Iterator[list]:
+        items = iter(items)
+        while batch := list(islice(items, size)):
+            yield batch
+
+    @classmethod
+    def embed(
+        cls,
+        chunks: Iterable[Document],
+        embedding: Embeddings,
+        batch_size: int = 0,
+        in_flight: int = 0,
+    ) -> Iterator[tuple[list[Document], list]]:
+        """(chunks, vectors) per batch, in order; the next batch is read
+        only when one of the in-flight batches is done"""
+        settings = get_settings()
+        batch_size = batch_size or settings.INGEST_BATCH_SIZE
+        in_flight = max(in_flight or settings.INGEST_IN_FLIGHT, 1)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=in_flight) as pool:
+            for batch in cls.batches(chunks, batch_size):
+                # metadata embed_text: embedded instead, e.g. LogTemplates
+                texts = [x.metadata.get("embed_text", x.page_content) for x in batch]  # noqa: E501
+                pending.append((batch, pool.submit(copy_context().run, embedding.embed_documents, texts)))  # noqa: E501
+                if len(pending) >= in_flight:
+                    yield cls.__done(*pending.popleft())
+            while pending:
+                yield cls.__done(*pending.popleft())
+
+    @staticmethod
+    def __done(batch: list[Document], future) -> tuple[list[Document], list]:
+        vectors = future.result()
+        IngestionJobs.report(embeddings=len(vectors))
+        return batch, vectors
@@ -0,0 +1,159 @@
+# Yan Pan, 2023
+from asyncio import to_thread
+from json import loads
+from langchain_community.vectorstores import ElasticsearchStore
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from threading import Lock
+from time import time
+
+from botSettings.settings import get_settings
+from prompts.CollectionGeneration import CollectionGeneration
+
+
+class KnnIndex:
+    """
+    kNN options of an Elasticsearch collection
+    index_type, m, ef_construction: the dense_vector index_options, fixed
+        when the index is created (int8/int4/bbq quantize the HNSW copy of
+        the vectors, float vectors stay on disk for rescoring)
+    num_candidates: per shard HNSW candidates of a query, kept in the
+        index _meta and read by the retrievers
+    defaults ES_KNN_*, ES_KNN_COLLECTIONS json overrides by name prefix
+    """
+
+    INDEX_TYPES = [
+        "hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw",
+        "flat", "int8_flat", "int4_flat", "bbq_flat",
+    ]
+    OPTIONS = ["index_type", "m", "ef_construction", "num_candidates"]
+
+    FAILURE_TTL = 30.0  # seconds until an unreadable mapping is retried
+
+    _params: dict = {}  # index: (generation, expires, params)
+    _lock = Lock()
+
+    @classmethod
+    def options(cls, collection: str, **overrides) -> dict:
+        """settings, then prefix overrides, then explicit (non-empty) values"""  # noqa: E501
+        settings = get_settings()
+        options = {
+            "index_type": settings.ES_KNN_INDEX_TYPE,
+            "m": settings.ES_KNN_M,
+            "ef_construction": settings.ES_KNN_EF_CONSTRUCTION,
+            "num_candidates": settings.ES_KNN_NUM_CANDIDATES,
+        }
+        try:
+            by_prefix = loads(settings.ES_KNN_COLLECTIONS or "{}")
+        except Exception as e:
+            print("ES_KNN_COLLECTIONS is not valid json", e)
+            by_prefix = {}
+        for prefix in sorted(by_prefix, key=len):  # longest prefix wins
+            if collection.startswith(prefix):
+                options.update(by_prefix[prefix])
+        options.update({k: v for k, v in overrides.items() if k in cls.OPTIONS and v})  # noqa: E501
+        if options["index_type"] and options["index_type"] not in cls.INDEX_TYPES:  # noqa: E501
+            raise ValueError(f"index_type must be one of {cls.INDEX_TYPES}")
+        return options
+
+    @staticmethod
+    def mappings(options: dict, vector_field: str = "vector") -> dict:
+        """
+        mappings as ElasticsearchStore creates them, plus index_options and
+        _meta; dims are taken from the first document
+        """
+        vector = {"type": "dense_vector", "index": True, "similarity": "cosine"}  # noqa: E501
+        index_type = options["index_type"]
+        if index_type:
+            vector["index_options"] = {"type": index_type}
+            if index_type.endswith("hnsw"):
+                vector["index_options"].update({
+                    "m": options["m"],
+                    "ef_construction": options["ef_construction"],
+                })
+        return {
+            "_meta": {"knn": options},
+            "properties": {vector_field: vector},
+        }
+
+    @classmethod
+    def create(cls, client, index: str, options: dict, quiet: bool = False) -> bool:  # noqa: E501
+        """False if the index exists, its options are kept
+        quiet: the index is expected to exist (appending), no message"""
+        if client.indices.exists(index=index):
+            if not quiet:
+                print(f"{index} exists, knn options unchanged")
+            return False
+        client.indices.create(index=index, mappings=cls.mappings(options))
+        return True
+
+    @classmethod
+    def params(cls, client, index: str) -> dict:
+        """options in the index _meta, cached per collection generation;
+        defaults are cached for FAILURE_TTL seconds if the mapping is not
+        readable. blocking: call it where the search runs (worker thread)"""
+        generation = CollectionGeneration.get(index)
+        with cls._lock:
+            cached = cls._params.get(index)
+            if cached is not None and cached[0] == generation and cached[1] > time():  # noqa: E501
+                return cached[2]
+        params = cls.options(index)
+        expires = float("inf")
+        try:
+            mapping = client.indices.get_mapping(index=index)
+            for x in mapping.values():
+                params.update(x["mappings"].get("_meta", {}).get("knn", {}))
+        except Exception as e:
+            print(f"knn options of {index} not read, using defaults", e)
+            expires = time() + cls.FAILURE_TTL
+        with cls._lock:
+            cls._params[index] = (generation, expires, params)
+        return params
+
+    @classmethod
+    def num_candidates(cls, store, k: int) -> int:
+        """num_candidates of an ElasticsearchStore query for k hits"""
+        return max(cls.params(store.client, store.index_name)["num_candidates"], k)  # noqa: E501
+
+    @classmethod
+    def search_kwargs(cls, store, k: int) -> dict:
+        """fetch_k of similarity_search* for k hits, empty for other stores"""
+        if not isinstance(store, ElasticsearchStore):
+            return {}
+        return {"fetch_k": cls.num_candidates(store, k)}
+
+
+class KnnRetriever(BaseRetriever):
+    """
+    similarity search of a vector store, with the num_candidates of the
+    collection (KnnIndex) looked up at search time, in a worker thread
+    for async callers. as store.as_retriever() otherwise
+    """
+
+    store: VectorStore
+    k: int = 4
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def search(self, vector: list[float]) -> list[Document]:
+        hits = self.store.similarity_search_by_vector_with_relevance_scores(
+            vector, k=self.k, **KnnIndex.search_kwargs(self.store, self.k)
+        )
+        return [doc for doc, _ in hits]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        return self.search(self.store.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector = await self.store.embeddings.aembed_query(query)
+        return await to_thread(self.search, vector)
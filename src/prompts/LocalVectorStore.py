@@ -0,0 +1,233 @@
+# Yan Pan, 2023
+import numpy as np
+import os
+from array import array
+from json import dumps, loads
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from shutil import rmtree
+from threading import Lock
+from uuid import uuid4
+
+from botSettings.settings import get_settings
+
+
+class LocalVectorStore(VectorStore):
+    """
+    in-process exact search for small collections, database="local"
+    {LOCAL_VECTOR_PATH}/{collection}/
+        vectors.npy  float32 (n, dim), rows normalized, memory-mapped
+        docs.jsonl   one {"text", "metadata"} per row
+        offsets.npy  int64 byte offset of each row in docs.jsonl
+    top-k is one matrix-vector product; the pages of vectors.npy are shared
+    by all workers through the OS page cache, only top-k rows of docs.jsonl
+    are read. a rebuild writes a new folder and swaps it in, open indices
+    keep reading the old files until they notice the change. the docs file
+    is closed by garbage collection once no search holds the old index
+    """
+
+    _indices: dict = {}  # folder: (version, vectors, offsets, docs file)
+    _lock = Lock()
+
+    def __init__(self, path: str, embedding: Embeddings):
+        self.path = path
+        self.embedding = embedding
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    @staticmethod
+    def collection_path(collection_name: str) -> str:
+        return f"{get_settings().LOCAL_VECTOR_PATH}/{collection_name}"
+
+    @staticmethod
+    def normalize(vectors) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)  # noqa: E501
+
+    class Writer:
+        """
+        builds a collection batch by batch in a new folder with bounded
+        memory: rows go to a raw float32 file and docs.jsonl, vectors.npy
+        is assembled on close and the folder swapped in
+        """
+
+        COPY_ROWS = 65536
+
+        def __init__(self, path: str):
+            self.path = path.rstrip("/")
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.building = f"{self.path}.{uuid4().hex}.tmp"
+            os.makedirs(self.building)
+            self.docs = open(f"{self.building}/docs.jsonl", "wb")
+            self.raw = open(f"{self.building}/vectors.f32", "wb")
+            self.offsets = array("q")
+            self.dim = 0
+
+        def add(self, texts: list[str], vectors, metadatas: list[dict] = None):  # noqa: E501
+            if not len(texts):
+                return None
+            vectors = LocalVectorStore.normalize(vectors)
+            self.dim = vectors.shape[1]
+            self.raw.write(vectors.tobytes())
+            for text, metadata in zip(texts, metadatas or [{} for _ in texts]):  # noqa: E501
+                self.offsets.append(self.docs.tell())
+                self.docs.write(dumps({"text": text, "metadata": metadata}, default=str).encode() + b"\n")  # noqa: E501
+            return None
+
+        def close(self):
+            self.docs.close()
+            self.raw.close()
+            rows = len(self.offsets)
+            np.save(f"{self.building}/offsets.npy", np.frombuffer(self.offsets, dtype=np.int64) if rows else np.zeros(0, dtype=np.int64))  # noqa: E501
+            if not rows:
+                np.save(f"{self.building}/vectors.npy", np.zeros((0, 0), dtype=np.float32))  # noqa: E501
+            else:
+                raw = np.memmap(f"{self.building}/vectors.f32", dtype=np.float32, mode="r", shape=(rows, self.dim))  # noqa: E501
+                out = np.lib.format.open_memmap(f"{self.building}/vectors.npy", mode="w+", dtype=np.float32, shape=(rows, self.dim))  # noqa: E501
+                for start in range(0, rows, self.COPY_ROWS):
+                    out[start:start + self.COPY_ROWS] = raw[start:start + self.COPY_ROWS]  # noqa: E501
+                out.flush()
+                del out, raw
+            os.remove(f"{self.building}/vectors.f32")
+
+            retired = f"{self.path}.{uuid4().hex}.old"
+            if os.path.exists(self.path):
+                os.rename(self.path, retired)
+            os.rename(self.building, self.path)
+            rmtree(retired, ignore_errors=True)
+
+        def abort(self):
+            self.docs.close()
+            self.raw.close()
+            rmtree(self.building, ignore_errors=True)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, error_type, error, traceback):
+            self.close() if error_type is None else self.abort()
+
+    @classmethod
+    def write(cls, path: str, vectors, texts: list[str], metadatas: list[dict]):  # noqa: E501
+        """write a complete index to a new folder, then swap it in"""
+        with cls.Writer(path) as writer:
+            writer.add(texts, vectors, metadatas)
+
+    @classmethod
+    def open(cls, path: str) -> tuple:
+        """(vectors, offsets, docs file) of the current index, reopened after a rebuild"""  # noqa: E501
+        try:
+            stat = os.stat(f"{path}/vectors.npy")
+            version = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            version = None  # being swapped, or deleted
+        with cls._lock:
+            index = cls._indices.get(path)
+            if index is not None and (version is None or index[0] == version):  # noqa: E501
+                return index[1:]
+            if version is None:
+                raise FileNotFoundError(f"no local collection at {path}")
+            # the replaced index stays open for searches still holding it
+            index = (
+                version,
+                np.load(f"{path}/vectors.npy", mmap_mode="r"),
+                np.load(f"{path}/offsets.npy"),
+                open(f"{path}/docs.jsonl", "rb", buffering=0),
+            )
+            cls._indices[path] = index
+            return index[1:]
+
+    @classmethod
+    def close(cls, path: str):
+        """forget the index, its files close when the last search ends"""
+        with cls._lock:
+            cls._indices.pop(path, None)
+
+    def documents(self, rows, index: tuple = None) -> list[Document]:
+        """rows of the index (open()), the current one by default"""
+        _, offsets, file = index or self.open(self.path)
+        fd = file.fileno()  # file is referenced until the rows are read
+        docs = []
+        for row in rows:
+            start = int(offsets[row])
+            end = int(offsets[row + 1]) if row + 1 < len(offsets) else os.fstat(fd).st_size  # noqa: E501
+            record = loads(os.pread(fd, end - start, start))
+            docs.append(Document(page_content=record["text"], metadata=record["metadata"]))  # noqa: E501
+        return docs
+
+    def top_k(self, embedding: list[float], k: int, index: tuple = None) -> tuple[np.ndarray, np.ndarray]:  # noqa: E501
+        """(rows, cosine similarities), best first"""
+        vectors, _, _ = index or self.open(self.path)
+        if not len(vectors):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)  # noqa: E501
+        scores = vectors @ self.normalize(embedding)[0]
+        k = min(k, len(scores))
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        return rows, scores[rows]
+
+    def candidates(self, embedding: list[float], k: int) -> tuple[list[Document], np.ndarray]:  # noqa: E501
+        """top-k documents with their vectors, for MmrRetriever"""
+        index = self.open(self.path)  # rows and documents of one version
+        rows, _ = self.top_k(embedding, k, index)
+        return self.documents(rows, index), np.asarray(index[0][rows])
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self, embedding: list[float], k: int = 4, **kwargs
+    ) -> list[tuple[Document, float]]:
+        """relevance is (1 + cosine) / 2, same scale as Elasticsearch"""
+        index = self.open(self.path)  # rows and documents of one version
+        rows, scores = self.top_k(embedding, k, index)
+        return list(zip(self.documents(rows, index), ((1 + scores) / 2).tolist()))  # noqa: E501
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs) -> list[Document]:  # noqa: E501
+        return [doc for doc, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k)]  # noqa: E501
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> list[tuple[Document, float]]:  # noqa: E501
+        return self.similarity_search_by_vector_with_relevance_scores(
+            self.embedding.embed_query(query), k
+        )
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> list[Document]:  # noqa: E501
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)  # noqa: E501
+
+    def _select_relevance_score_fn(self):
+        return lambda score: score  # already relevance
+
+    def add_texts(self, texts, metadatas: list[dict] = None, **kwargs) -> list[str]:  # noqa: E501
+        """appends by rewriting the collection, meant for small collections"""
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self.normalize(self.embedding.embed_documents(texts))
+        added = len(texts)
+        try:
+            index = self.open(self.path)
+            old_vectors = index[0]
+            if not len(old_vectors):
+                raise FileNotFoundError("empty collection")
+            old_docs = self.documents(range(len(old_vectors)), index)
+            vectors = np.vstack([np.asarray(old_vectors), vectors])
+            texts = [x.page_content for x in old_docs] + texts
+            metadatas = [x.metadata for x in old_docs] + metadatas
+        except FileNotFoundError:
+            pass
+        self.write(self.path, vectors, texts, metadatas)
+        return [str(i) for i in range(len(texts) - added, len(texts))]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] = None,
+        path: str = None,
+        **kwargs
+    ) -> "LocalVectorStore":
+        """builds (replaces) the collection at path"""
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = embedding.embed_documents(texts) if texts else []
+        cls.write(path, vectors, texts, metadatas)
+        return cls(path=path, embedding=embedding)
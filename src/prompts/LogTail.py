@@ -0,0 +1,138 @@
+# Yan Pan, 2023
+from datetime import datetime, timedelta
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+from glob import glob
+from json import dump, load
+from langchain_core.documents import Document
+from os import makedirs, replace, stat
+from time import time
+from typing import Iterator
+
+from botSettings.settings import get_settings
+
+
+class LogTail:
+    """
+    incremental log ingestion: byte offset and inode per file in a
+    checkpoint (CACHE_PATH/log-tail/{collection}.json), only complete lines
+    after the offset are read. a new inode or a shorter file is read from
+    the start, a renamed file (same inode) keeps its offset.
+    one run at a time per collection (file lock), the checkpoint is saved
+    by the caller once the lines are indexed
+        with LogTail("log-rolling") as tail:
+            if tail.locked:
+                tail.update(LogTail.matched(days=1))
+                ... tail.blocks() ...
+                tail.save()
+    """
+
+    FOLDER = "/mnt/shared/fluentd"
+
+    def __init__(self, collection_name: str):
+        cache_path = get_settings().CACHE_PATH
+        if not cache_path:
+            raise ValueError("incremental logs need CACHE_PATH for the checkpoint")  # noqa: E501
+        makedirs(f"{cache_path}/log-tail", exist_ok=True)
+        self.path = f"{cache_path}/log-tail/{collection_name}.json"
+        self.files = {}  # path: {"inode": int, "offset": int}
+        self.state = {}  # of the caller, saved with the offsets
+        self.dropped = []  # checkpointed files no longer matched
+        self.fresh = True  # no checkpoint yet
+        self.locked = False
+        self.__lock = None
+
+    @classmethod
+    def matched(cls, days: int = 1) -> list[str]:
+        """buffering logs modified within days, dated logs of the last days"""
+        folder = cls.FOLDER
+        now = datetime.now()
+        cutoff = now.timestamp() - days * 86400
+        matched = []
+        for x in glob(f"{folder}/*/*.log"):
+            try:
+                if stat(x).st_mtime >= cutoff:
+                    matched.append(x)
+            except OSError:
+                pass  # flushed meanwhile
+        for i in range(days):
+            matched += glob(f"{folder}/*{now - timedelta(days=i):%Y%m%d}.log")
+        return matched
+
+    def __enter__(self):
+        self.__lock = open(f"{self.path}.lock", "w")
+        try:
+            flock(self.__lock, LOCK_EX | LOCK_NB)
+            self.locked = True
+        except BlockingIOError:
+            print(f"log tail {self.path} busy, skipped")
+            return self
+        try:
+            with open(self.path, "r") as f:
+                checkpoint = load(f)
+            self.files, self.state = checkpoint["files"], checkpoint.get("state", {})  # noqa: E501
+            self.fresh = False
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("log tail checkpoint not readable, starting over", e)
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if self.locked:
+            flock(self.__lock, LOCK_UN)
+        self.__lock.close()
+        self.locked = False
+
+    def save(self):
+        with open(f"{self.path}.tmp", "w") as f:
+            dump({"updated": time(), "files": self.files, "state": self.state}, f)  # noqa: E501
+        replace(f"{self.path}.tmp", self.path)
+        self.fresh = False
+
+    def update(self, paths: list[str]):
+        """state of the matched files, rotations start over"""
+        paths = set(paths)
+        by_inode = {v["inode"]: k for k, v in self.files.items()}
+        files = {}
+        for path in sorted(paths):
+            try:
+                info = stat(path)
+            except OSError:
+                continue
+            state = self.files.get(path)
+            renamed = by_inode.get(info.st_ino)
+            if state is None and renamed is not None and renamed not in paths:
+                state = self.files[renamed]
+            if state is None or state["inode"] != info.st_ino or info.st_size < state["offset"]:  # noqa: E501
+                state = {"inode": info.st_ino, "offset": 0}
+            files[path] = dict(state)
+        self.dropped = [x for x in self.files if x not in files]
+        self.files = files
+        return self
+
+    def blocks(self, block_bytes: int = 0) -> Iterator[Document]:
+        """new complete lines as documents of about block_bytes each,
+        metadata time is the file mtime (for expiry); offsets advance as
+        blocks are consumed"""
+        block_bytes = block_bytes or get_settings().INGEST_BLOCK_CHARS
+        for path, state in self.files.items():
+            try:
+                f = open(path, "rb")
+            except OSError as e:
+                print(f"log tail: {path} not readable", e)
+                continue
+            with f:
+                mtime = stat(f.fileno()).st_mtime
+                f.seek(state["offset"])
+                pending = b""
+                while block := f.read(block_bytes):
+                    block = pending + block
+                    end = block.rfind(b"\n") + 1
+                    pending = block[end:]
+                    if not end:
+                        continue  # a partial line, read once complete
+                    yield Document(
+                        page_content=block[:end].decode("utf-8", errors="replace"),  # noqa: E501
+                        metadata={"source": path, "offset": state["offset"], "time": mtime},  # noqa: E501
+                    )
+                    state["offset"] += end
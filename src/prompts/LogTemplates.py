@@ -0,0 +1,154 @@
+# Yan Pan, 2023
+from datetime import datetime
+from hashlib import sha256
+from langchain_core.documents import Document
+from re import compile
+from time import time
+from typing import Iterable, Iterator
+
+from botSettings.settings import get_settings
+from prompts.IngestionJobs import IngestionJobs
+from prompts.ModelRouter import ModelRouter
+
+
+class LogTemplates:
+    """
+    Drain-style template mining of log lines before embedding: tokens with
+    digits (ids, times, durations) are masked as <*>, lines are grouped by
+    token count and leading tokens, then joined to the most similar
+    template of the group when at least LOG_TEMPLATE_SIMILARITY of the
+    tokens are equal, differing tokens become <*>.
+    one document per template and LOG_TEMPLATE_BUCKET seconds,
+    with count, first and last time, and an example line.
+    only template and example are embedded (metadata embed_text), so the
+    counts of a bucket are updated without a new embedding.
+    state() / LogTemplates(state) keep templates across incremental runs
+    """
+
+    DEPTH = 2  # leading tokens of the group key
+    WILDCARD = "<*>"
+    EXAMPLE_CHARS = 500
+    ISO_TIME = compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}")
+    EPOCH_TIME = compile(r'"time":\s*(\d{10})')
+
+    def __init__(self, state: dict = None, similarity: float = 0.0, bucket: int = 0):  # noqa: E501
+        settings = get_settings()
+        self.similarity = similarity or settings.LOG_TEMPLATE_SIMILARITY
+        self.bucket = bucket or settings.LOG_TEMPLATE_BUCKET
+        state = state or {}
+        self.templates = [x.split(" ") for x in state.get("templates", [])]
+        self.buckets = {  # (template id, bucket start): stats
+            (x["template"], x["bucket"]): x for x in state.get("buckets", [])
+        }
+        self.groups = {}  # group key: template ids
+        for i, tokens in enumerate(self.templates):
+            self.groups.setdefault(self.key(tokens), []).append(i)
+        self.touched = set()
+
+    def state(self, since: float = 0.0) -> dict:
+        """json serializable, buckets last seen before since are dropped"""
+        return {
+            "templates": [" ".join(x) for x in self.templates],
+            "buckets": [x for x in self.buckets.values() if x["last"] >= since],  # noqa: E501
+        }
+
+    @classmethod
+    def key(cls, tokens: list[str]) -> tuple:
+        return (len(tokens),) + tuple(tokens[:cls.DEPTH])
+
+    @classmethod
+    def tokens(cls, line: str) -> list[str]:
+        return [cls.WILDCARD if any(c.isdigit() for c in x) else x for x in line.split()]  # noqa: E501
+
+    @classmethod
+    def timestamp(cls, line: str, default: float) -> float:
+        """ISO date time or json "time" epoch of the line, else default"""
+        found = cls.ISO_TIME.search(line)
+        if found:
+            try:
+                return datetime.fromisoformat(found.group(0).replace(" ", "T")).timestamp()  # noqa: E501
+            except ValueError:
+                pass
+        found = cls.EPOCH_TIME.search(line)
+        return float(found.group(1)) if found else default
+
+    def match(self, tokens: list[str]) -> int:
+        """template id of the tokens, the template is generalized or new"""
+        group = self.groups.setdefault(self.key(tokens), [])
+        best, score = None, -1.0
+        for i in group:
+            template = self.templates[i]
+            same = sum(a == b for a, b in zip(template, tokens) if a != self.WILDCARD)  # noqa: E501
+            if same / len(tokens) > score:
+                best, score = i, same / len(tokens)
+        if best is not None and score >= self.similarity:
+            self.templates[best] = [
+                a if a == b else self.WILDCARD
+                for a, b in zip(self.templates[best], tokens)
+            ]
+            return best
+        self.templates.append(list(tokens))
+        group.append(len(self.templates) - 1)
+        return len(self.templates) - 1
+
+    def add(self, line: str, source: str = "", default_time: float = 0.0):
+        tokens = self.tokens(line)
+        if not tokens:
+            return None
+        template = self.match(tokens)
+        at = self.timestamp(line, default_time or time())
+        start = int(at // self.bucket * self.bucket)
+        stats = self.buckets.setdefault((template, start), {
+            "template": template,
+            "bucket": start,
+            "count": 0,
+            "first": at,
+            "last": at,
+            "example": line.strip()[:self.EXAMPLE_CHARS],
+            "source": source,
+        })
+        stats["count"] += 1
+        stats["first"] = min(stats["first"], at)
+        stats["last"] = max(stats["last"], at)
+        self.touched.add((template, start))
+        return None
+
+    def document(self, stats: dict) -> Document:
+        template = " ".join(self.templates[stats["template"]])
+        first = datetime.fromtimestamp(stats["first"])
+        last = datetime.fromtimestamp(stats["last"])
+        page_content = (
+            f"log template seen {stats['count']} times "
+            f"from {first:%Y-%m-%d %H:%M:%S} to {last:%Y-%m-%d %H:%M:%S}:\n"
+            f"{template}\nexample: {stats['example']}"
+        )
+        return Document(page_content=page_content, metadata={
+            "source": stats["source"],
+            "id": sha256(f"{stats['template']}:{stats['bucket']}".encode()).hexdigest(),  # noqa: E501
+            "embed_text": f"{template}\n{stats['example']}",
+            "template": template,
+            "count": stats["count"],
+            "first": stats["first"],
+            "last": stats["last"],
+            "time": stats["last"],  # expiry, as LogTail
+            "tokens": ModelRouter.count_tokens(page_content),
+        })
+
+    def documents(self, blocks: Iterable[Document]) -> Iterator[Document]:
+        """
+        template documents of the buckets touched by the blocks (documents
+        of whole lines, e.g. IngestionPipeline.file_blocks or LogTail);
+        yielded once all blocks are read
+        """
+        lines = 0
+        for block in blocks:
+            source = str(block.metadata.get("source", ""))
+            default_time = block.metadata.get("time") or time()
+            for line in block.page_content.splitlines():
+                self.add(line, source, default_time)
+                lines += 1
+            IngestionJobs.report(documents=1)
+        IngestionJobs.report(log_lines=lines, chunks=len(self.touched))
+        for x in sorted(self.touched):
+            yield self.document(self.buckets[x])
+        self.touched = set()
@@ -0,0 +1,80 @@
+# Yan Pan, 2023
+import re
+from functools import lru_cache
+
+from botSettings.settings import get_settings
+
+
+class ModelRouter:
+    """
+    model="auto": a small fast model for short and simple prompts,
+    the large model otherwise. the reason is reported in usage,
+    thresholds are ROUTER_* settings
+    """
+
+    AUTO = "auto"
+    # words that usually ask for reasoning rather than lookup
+    QUESTION_HINTS = re.compile(
+        r"\b(why|how|compare|explain|difference|analy[sz]e|evaluate|pros|cons|step|plan|summari[sz]e|versus|vs)\b",  # noqa: E501
+        re.IGNORECASE,
+    )
+    # code that deserves a careful security review
+    CODE_HINTS = re.compile(
+        r"\b(eval|exec|subprocess|system|pickle|sql|password|secret|token|crypt\w*|socket|thread\w*|async)\b",  # noqa: E501
+        re.IGNORECASE,
+    )
+
+    @staticmethod
+    @lru_cache(maxsize=4)
+    def __encoding(model: str):
+        """None if tiktoken cannot load it, not retried"""
+        from tiktoken import encoding_for_model, get_encoding
+        try:
+            try:
+                return encoding_for_model(model)
+            except KeyError:
+                return get_encoding("cl100k_base")
+        except Exception as e:
+            print("tiktoken encoding not available", e)
+            return None
+
+    @staticmethod
+    def count_tokens(text: str, model: str = "gpt-4o") -> int:
+        """tiktoken count, or 4 chars per token if no encoding is available"""
+        encoding = ModelRouter.__encoding(model)
+        if encoding is None:
+            return len(text) // 4 + 1
+        return len(encoding.encode(text))
+
+    @classmethod
+    def complexity(cls, text: str, kind: str = "question") -> int:
+        """cheap score, 0 is trivial"""
+        if kind == "code":
+            lines = [x for x in text.splitlines() if x.strip()]
+            depth = max([len(x) - len(x.lstrip()) for x in lines] or [0])
+            return (
+                len(lines) // 40
+                + depth // 12
+                + len(set(cls.CODE_HINTS.findall(text)))
+            )
+        return (
+            len(set(x.lower() for x in cls.QUESTION_HINTS.findall(text)))
+            + max(text.count("?") - 1, 0)
+            + text.count("\n") // 3
+        )
+
+    @classmethod
+    def choose(cls, text: str, kind: str = "question") -> tuple[str, str]:
+        """(model name, reason)"""
+        settings = get_settings()
+        max_tokens = settings.ROUTER_MAX_SMALL_TOKENS
+        if kind == "code":
+            max_tokens = settings.ROUTER_MAX_SMALL_CODE_TOKENS
+        tokens = cls.count_tokens(text, settings.ROUTER_LARGE_MODEL)
+        score = cls.complexity(text, kind)
+
+        if tokens > max_tokens:
+            return settings.ROUTER_LARGE_MODEL, f"{kind} tokens {tokens} > {max_tokens}"  # noqa: E501
+        if score > settings.ROUTER_MAX_SMALL_COMPLEXITY:
+            return settings.ROUTER_LARGE_MODEL, f"{kind} complexity {score} > {settings.ROUTER_MAX_SMALL_COMPLEXITY}"  # noqa: E501
+        return settings.ROUTER_SMALL_MODEL, f"{kind} tokens {tokens}, complexity {score}"  # noqa: E501
@@ -0,0 +1,302 @@
+# Yan Pan, 2023
+from asyncio import sleep
+from json import loads
+from langchain_core.embeddings import Embeddings
+from threading import Lock
+from time import monotonic, sleep as sleep_blocking
+
+from botSettings.settings import get_settings
+
+
+class RateLimitRejected(Exception):
+    """queue for the model is full; caller should answer 429"""
+
+    def __init__(self, model: str, retry_after: float = 1.0):
+        super().__init__(f"too many pending requests for {model}")
+        self.retry_after = retry_after
+
+
+class ProviderScheduler:
+    """
+    shared budget of requests and tokens per minute for each model.
+    - token buckets refill continuously, RATE_LIMITS overrides defaults
+    - a 429 blocks the model until Retry-After and halves the budget,
+      which recovers slowly on success (additive increase)
+    - lower priority waits while higher priority requests are queued
+    - queue depth is bounded, excess requests are rejected at once
+    """
+
+    PRIORITIES = {"interactive": 0, "analysis": 1, "bulk": 2}
+    POLL_SECONDS = 0.05
+
+    _models: dict = {}
+    _lock = Lock()
+
+    @staticmethod
+    def __limits(model: str) -> dict:
+        settings = get_settings()
+        limits = {"tpm": settings.RATE_LIMIT_TPM, "rpm": settings.RATE_LIMIT_RPM}  # noqa: E501
+        try:
+            limits.update(loads(settings.RATE_LIMITS or "{}").get(model, {}))
+        except Exception as e:
+            print("RATE_LIMITS is not valid json", e)
+        return limits
+
+    @classmethod
+    def __state(cls, model: str) -> dict:
+        """caller holds the lock"""
+        if model not in cls._models:
+            limits = cls.__limits(model)
+            cls._models[model] = {
+                **limits,
+                "tokens": float(limits["tpm"]),
+                "requests": float(limits["rpm"]),
+                "scale": 1.0,
+                "updated": monotonic(),
+                "blocked_until": 0.0,
+                "waiting": [0] * len(cls.PRIORITIES),
+                "rejected": 0,
+                "throttled": 0,
+            }
+        state = cls._models[model]
+        now = monotonic()
+        elapsed, state["updated"] = now - state["updated"], now
+        for bucket, limit in [("tokens", "tpm"), ("requests", "rpm")]:
+            capacity = state[limit] * state["scale"]
+            state[bucket] = min(capacity, state[bucket] + elapsed * capacity / 60)  # noqa: E501
+        return state
+
+    @classmethod
+    def admit(cls, model: str, priority: str = "interactive"):
+        """reject early when the queue for this priority is full"""
+        level = cls.PRIORITIES[priority]
+        with cls._lock:
+            state = cls.__state(model)
+            if sum(state["waiting"][:level + 1]) >= get_settings().RATE_LIMIT_QUEUE_DEPTH:  # noqa: E501
+                state["rejected"] += 1
+                retry_after = max(state["blocked_until"] - monotonic(), 1.0)
+                raise RateLimitRejected(model, retry_after)
+
+    @classmethod
+    def __try_acquire(cls, model: str, tokens: int, level: int) -> float:
+        """0 when acquired, otherwise seconds to wait; caller holds the lock"""
+        state = cls.__state(model)
+        now = monotonic()
+        if state["blocked_until"] > now:
+            return state["blocked_until"] - now
+        if any(state["waiting"][:level]):
+            return cls.POLL_SECONDS
+
+        tokens = min(tokens, state["tpm"] * state["scale"])
+        if state["tokens"] >= tokens and state["requests"] >= 1:
+            state["tokens"] -= tokens
+            state["requests"] -= 1
+            return 0
+        rate_tokens = state["tpm"] * state["scale"] / 60
+        rate_requests = state["rpm"] * state["scale"] / 60
+        return max(
+            (tokens - state["tokens"]) / rate_tokens,
+            (1 - state["requests"]) / rate_requests,
+            cls.POLL_SECONDS,
+        )
+
+    @classmethod
+    def __enqueue(cls, model: str, level: int, delta: int):
+        with cls._lock:
+            cls.__state(model)["waiting"][level] += delta
+
+    @classmethod
+    async def acquire(cls, model: str, tokens: int, priority: str):
+        """wait for the budget, admission is checked once by the caller"""
+        level = cls.PRIORITIES[priority]
+        cls.__enqueue(model, level, 1)
+        try:
+            while True:
+                with cls._lock:
+                    wait = cls.__try_acquire(model, tokens, level)
+                if not wait:
+                    return None
+                await sleep(wait)
+        finally:
+            cls.__enqueue(model, level, -1)
+
+    @classmethod
+    def acquire_blocking(cls, model: str, tokens: int, priority: str):
+        """same as acquire, for code running in worker threads"""
+        level = cls.PRIORITIES[priority]
+        cls.__enqueue(model, level, 1)
+        try:
+            while True:
+                with cls._lock:
+                    wait = cls.__try_acquire(model, tokens, level)
+                if not wait:
+                    return None
+                sleep_blocking(wait)
+        finally:
+            cls.__enqueue(model, level, -1)
+
+    @staticmethod
+    def retry_after(response) -> float:
+        """seconds to back off if response is a 429, else None"""
+        if getattr(response, "status_code", None) != 429:
+            return None
+        try:
+            return float(response.headers.get("retry-after"))
+        except Exception:
+            return 1.0
+
+    @classmethod
+    def response_hooks(cls, model: str) -> tuple:
+        """
+        httpx event hooks (sync, async) reporting every 429 of a model,
+        including those retried internally by the openai client
+        """
+        def hook(response):
+            retry_after = cls.retry_after(response)
+            if retry_after is not None:
+                cls.report(model, retry_after)
+
+        async def ahook(response):
+            hook(response)
+
+        return hook, ahook
+
+    @classmethod
+    def report(cls, model: str, retry_after: float = None):
+        """feedback after a call: None for success, seconds for a 429"""
+        with cls._lock:
+            state = cls.__state(model)
+            if retry_after is None:
+                state["scale"] = min(1.0, state["scale"] + 0.05)
+                return None
+            state["throttled"] += 1
+            if state["blocked_until"] <= monotonic():  # once per episode
+                state["scale"] = max(0.1, state["scale"] / 2)
+            state["blocked_until"] = max(
+                state["blocked_until"], monotonic() + retry_after
+            )
+            state["tokens"] = min(state["tokens"], 0)
+
+    @classmethod
+    async def run(
+        cls,
+        model: str,
+        make_call: callable,
+        tokens: int = 1000,
+        priority: str = "interactive",
+    ):
+        """await make_call() within budget, retrying on 429;
+        admitted once, a retry is not rejected after waiting its turn"""
+        cls.admit(model, priority)
+        retries = get_settings().RATE_LIMIT_RETRIES
+        for attempt in range(retries + 1):
+            await cls.acquire(model, tokens, priority)
+            try:
+                result = await make_call()
+                cls.report(model)
+                return result
+            except Exception as e:
+                retry_after = cls.retry_after(getattr(e, "response", None))
+                if retry_after is None or attempt == retries:
+                    raise e
+                cls.report(model, retry_after)
+
+    @classmethod
+    def run_blocking(
+        cls,
+        model: str,
+        make_call: callable,
+        tokens: int = 1000,
+        priority: str = "bulk",
+    ):
+        """same as run, for code running in worker threads"""
+        cls.admit(model, priority)
+        retries = get_settings().RATE_LIMIT_RETRIES
+        for attempt in range(retries + 1):
+            cls.acquire_blocking(model, tokens, priority)
+            try:
+                result = make_call()
+                cls.report(model)
+                return result
+            except Exception as e:
+                retry_after = cls.retry_after(getattr(e, "response", None))
+                if retry_after is None or attempt == retries:
+                    raise e
+                cls.report(model, retry_after)
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {
+                model: {
+                    "scale": round(x["scale"], 2),
+                    "waiting": dict(zip(cls.PRIORITIES, x["waiting"])),
+                    "rejected": x["rejected"],
+                    "throttled": x["throttled"],
+                    "blocked_for": max(0.0, x["blocked_until"] - monotonic()),
+                }
+                for model, x in cls._models.items()
+            }
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._models.clear()
+
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    embeddings within the provider budget, in batches so that
+    bulk ingestion yields to interactive requests between batches
+    """
+
+    BATCH_SIZE = 256
+
+    def __init__(self, embeddings: Embeddings, model: str, priority: str):
+        self.embeddings = embeddings
+        self.model = model
+        self.priority = priority
+
+    @staticmethod
+    def estimate_tokens(texts: list[str]) -> int:
+        return sum(len(x) for x in texts) // 4 + 1
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.BATCH_SIZE):
+            batch = texts[i:i + self.BATCH_SIZE]
+            vectors.extend(ProviderScheduler.run_blocking(
+                self.model,
+                lambda: self.embeddings.embed_documents(batch),
+                tokens=self.estimate_tokens(batch),
+                priority=self.priority,
+            ))
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return ProviderScheduler.run_blocking(
+            self.model,
+            lambda: self.embeddings.embed_query(text),
+            tokens=self.estimate_tokens([text]),
+            priority=self.priority,
+        )
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.BATCH_SIZE):
+            batch = texts[i:i + self.BATCH_SIZE]
+            vectors.extend(await ProviderScheduler.run(
+                self.model,
+                lambda: self.embeddings.aembed_documents(batch),
+                tokens=self.estimate_tokens(batch),
+                priority=self.priority,
+            ))
+        return vectors
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await ProviderScheduler.run(
+            self.model,
+            lambda: self.embeddings.aembed_query(text),
+            tokens=self.estimate_tokens([text]),
+            priority=self.priority,
+        )
@@ -0,0 +1,124 @@
+# Yan Pan, 2023
+import numpy as np
+from asyncio import to_thread
+from json import loads
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+from botSettings.settings import get_settings
+from prompts.KnnIndex import KnnIndex
+
+
+class Reranking:
+    """in-process reranking of retrieved candidates"""
+
+    @staticmethod
+    def mmr(
+        query: np.ndarray,
+        vectors: np.ndarray,
+        k: int = 4,
+        lambda_mult: float = 0.5,
+    ) -> list[int]:
+        """
+        maximal marginal relevance: indices of k diverse candidates.
+        score = lambda * sim(query) - (1 - lambda) * max sim(selected)
+        one matrix-vector product per selected item
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(vectors):
+            return []
+        vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)  # noqa: E501
+        query = np.asarray(query, dtype=np.float32)
+        relevance = vectors @ (query / (np.linalg.norm(query) + 1e-12))
+
+        selected = []
+        redundancy = np.zeros(len(vectors), dtype=np.float32)
+        for _ in range(min(k, len(vectors))):
+            scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+            scores[selected] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            redundancy = np.maximum(redundancy, vectors @ vectors[best])
+        return selected
+
+    @staticmethod
+    def params(collection: str) -> dict:
+        """lambda and fetch_k, MMR_COLLECTIONS overrides by name prefix"""
+        settings = get_settings()
+        params = {"lambda": settings.MMR_LAMBDA, "fetch_k": settings.MMR_FETCH_K}  # noqa: E501
+        try:
+            overrides = loads(settings.MMR_COLLECTIONS or "{}")
+        except Exception as e:
+            print("MMR_COLLECTIONS is not valid json", e)
+            overrides = {}
+        for prefix in sorted(overrides, key=len):  # longest prefix wins
+            if collection.startswith(prefix):
+                params.update(overrides[prefix])
+        return params
+
+
+class MmrRetriever(BaseRetriever):
+    """
+    over-fetches fetch_k candidates with their vectors from the store
+    (Elasticsearch, local or Chroma) and keeps a diverse top-k, see Reranking.mmr
+    """
+
+    store: VectorStore
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def candidates(self, vector: list[float]) -> tuple[list[Document], list]:
+        store = self.store
+        if hasattr(store, "candidates"):  # LocalVectorStore
+            return store.candidates(vector, self.fetch_k)
+        if hasattr(store, "vector_query_field"):  # ElasticsearchStore
+            response = store.client.search(
+                index=store.index_name,
+                knn={
+                    "field": store.vector_query_field,
+                    "query_vector": vector,
+                    "k": self.fetch_k,
+                    "num_candidates": KnnIndex.num_candidates(self.store, self.fetch_k),  # noqa: E501
+                },
+                size=self.fetch_k,
+                source=[store.query_field, store.vector_query_field, "metadata"],  # noqa: E501
+            )
+            hits = [x["_source"] for x in response["hits"]["hits"]]
+            return [
+                Document(page_content=x.get(store.query_field, ""), metadata=x.get("metadata", {}))  # noqa: E501
+                for x in hits
+            ], [x[store.vector_query_field] for x in hits]
+
+        results = store._collection.query(  # Chroma
+            query_embeddings=[vector],
+            n_results=self.fetch_k,
+            include=["documents", "metadatas", "embeddings"],
+        )
+        return [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(results["documents"][0], results["metadatas"][0])  # noqa: E501
+        ], results["embeddings"][0]
+
+    def rerank(self, vector: list[float]) -> list[Document]:
+        docs, vectors = self.candidates(vector)
+        return [docs[i] for i in Reranking.mmr(vector, vectors, self.k, self.lambda_mult)]  # noqa: E501
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        return self.rerank(self.store.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector = await self.store.embeddings.aembed_query(query)
+        return await to_thread(self.rerank, vector)
@@ -0,0 +1,154 @@
+# Yan Pan, 2023
+from asyncio import to_thread
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps
+from threading import Lock
+from time import time
+
+from botSettings.settings import get_settings
+from prompts.SqliteStore import SqliteStore
+
+
+class ResponseCache:
+    """
+    exact-match cache of LLM answers (plain text)
+    tier 1: in-memory LRU with TTL, bounded by RESPONSE_CACHE_SIZE
+    tier 2: sqlite file under CACHE_PATH, shared by workers
+    RESPONSE_CACHE_SIZE=0 disables the cache
+    async code uses aget/aset, the sqlite tier runs in a worker thread
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS responses "
+        "(key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+    )
+
+    _memory: OrderedDict = OrderedDict()
+    _lock = Lock()
+    _stats = {"hits_memory": 0, "hits_disk": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(**kwargs) -> str:
+        """hash of endpoint, model, temperature, inputs and generation"""
+        raw = dumps(kwargs, sort_keys=True, default=str)
+        return sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def __execute(sql: str, params: tuple = ()):
+        return SqliteStore.execute("cache.db", ResponseCache.SCHEMA, sql, params)  # noqa: E501
+
+    @classmethod
+    def __remember(cls, key: str, value: str, expires: float):
+        with cls._lock:
+            cls._memory[key] = (expires, value)
+            cls._memory.move_to_end(key)
+            while len(cls._memory) > get_settings().RESPONSE_CACHE_SIZE:
+                cls._memory.popitem(last=False)
+
+    @classmethod
+    def __memory_get(cls, key: str):
+        with cls._lock:
+            expires, value = cls._memory.get(key, (0, None))
+            if value is not None and expires > time():
+                cls._memory.move_to_end(key)
+                cls._stats["hits_memory"] += 1
+                return value
+            cls._memory.pop(key, None)
+        return None
+
+    @classmethod
+    def __disk_get(cls, key: str):
+        try:
+            row = cls.__execute(
+                "SELECT value, expires FROM responses "
+                "WHERE key=? AND expires>?",
+                (key, time())
+            )
+        except Exception as e:
+            print("response cache disk tier not readable", e)
+            return None
+        if row:
+            cls.__remember(key, row[0], row[1])
+            with cls._lock:
+                cls._stats["hits_disk"] += 1
+            return row[0]
+        return None
+
+    @classmethod
+    def __disk_set(cls, key: str, value: str, expires: float):
+        try:
+            cls.__execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, value, expires)
+            )
+            cls.__execute("DELETE FROM responses WHERE expires<?", (time(),))  # noqa: E501
+        except Exception as e:
+            print("response cache disk tier not writable", e)
+
+    @classmethod
+    def __miss(cls):
+        with cls._lock:
+            cls._stats["misses"] += 1
+        return None
+
+    @classmethod
+    def get(cls, key: str):
+        """cached text or None"""
+        settings = get_settings()
+        if settings.RESPONSE_CACHE_SIZE <= 0:
+            return None
+        value = cls.__memory_get(key)
+        if value is None and settings.CACHE_PATH:
+            value = cls.__disk_get(key)
+        return cls.__miss() if value is None else value
+
+    @classmethod
+    async def aget(cls, key: str):
+        """get, without blocking the event loop"""
+        settings = get_settings()
+        if settings.RESPONSE_CACHE_SIZE <= 0:
+            return None
+        value = cls.__memory_get(key)
+        if value is None and settings.CACHE_PATH:
+            value = await to_thread(cls.__disk_get, key)
+        return cls.__miss() if value is None else value
+
+    @classmethod
+    def set(cls, key: str, value: str):
+        settings = get_settings()
+        if settings.RESPONSE_CACHE_SIZE <= 0 or not value:
+            return None
+        expires = time() + settings.RESPONSE_CACHE_TTL
+        cls.__remember(key, value, expires)
+        if settings.CACHE_PATH:
+            cls.__disk_set(key, value, expires)
+        return None
+
+    @classmethod
+    async def aset(cls, key: str, value: str):
+        """set, without blocking the event loop"""
+        settings = get_settings()
+        if settings.RESPONSE_CACHE_SIZE <= 0 or not value:
+            return None
+        expires = time() + settings.RESPONSE_CACHE_TTL
+        cls.__remember(key, value, expires)
+        if settings.CACHE_PATH:
+            await to_thread(cls.__disk_set, key, value, expires)
+        return None
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            lookups = sum(cls._stats.values())
+            hits = cls._stats["hits_memory"] + cls._stats["hits_disk"]
+            return {
+                **cls._stats,
+                "size": len(cls._memory),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._memory.clear()
@@ -0,0 +1,140 @@
+# Yan Pan, 2023
+import numpy as np
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from threading import Lock
+
+from botSettings.settings import get_settings
+from prompts.CollectionGeneration import CollectionGeneration
+
+
+class RetrievalCache:
+    """
+    retrieved documents keyed by (collections, query vector hash, k, filters)
+    each entry is tagged with the collection generations, an entry of an
+    older generation is a miss. in-memory LRU, RETRIEVAL_CACHE_SIZE=0 disables
+    """
+
+    _memory: OrderedDict = OrderedDict()
+    _lock = Lock()
+    _stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(collections: list[str], vector: list[float], params: dict) -> str:  # noqa: E501
+        digest = sha256(np.asarray(vector, dtype=np.float32).tobytes())
+        digest.update(dumps([collections, params], sort_keys=True, default=str).encode())  # noqa: E501
+        return digest.hexdigest()
+
+    @staticmethod
+    def generations(collections: list[str]) -> list[int]:
+        return [CollectionGeneration.get(x) for x in collections]
+
+    @staticmethod
+    async def agenerations(collections: list[str]) -> list[int]:
+        """generations, without blocking the event loop"""
+        return await CollectionGeneration.aget_many(collections)
+
+    @classmethod
+    def get(cls, key: str, generations: list[int]):
+        """documents or None"""
+        if get_settings().RETRIEVAL_CACHE_SIZE <= 0:
+            return None
+        with cls._lock:
+            cached = cls._memory.get(key)
+            if cached is not None and cached[0] != generations:
+                del cls._memory[key]
+                cls._stats["stale"] += 1
+                cached = None
+            if cached is None:
+                cls._stats["misses"] += 1
+                return None
+            cls._memory.move_to_end(key)
+            cls._stats["hits"] += 1
+        return [Document(page_content=x.page_content, metadata=dict(x.metadata)) for x in cached[1]]  # noqa: E501
+
+    @classmethod
+    def set(cls, key: str, generations: list[int], docs: list[Document]):
+        max_size = get_settings().RETRIEVAL_CACHE_SIZE
+        if max_size <= 0:
+            return None
+        with cls._lock:
+            cls._memory[key] = (generations, docs)
+            cls._memory.move_to_end(key)
+            while len(cls._memory) > max_size:
+                cls._memory.popitem(last=False)
+                cls._stats["evictions"] += 1
+        return None
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            lookups = cls._stats["hits"] + cls._stats["misses"]
+            return {
+                **cls._stats,
+                "size": len(cls._memory),
+                "hit_rate": cls._stats["hits"] / lookups if lookups else 0.0,
+            }
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._memory.clear()
+
+
+class CachedRetriever(BaseRetriever):
+    """
+    retriever wrapper using RetrievalCache; the query vector comes from
+    the (cached) embeddings, the wrapped retriever reuses it
+    """
+
+    retriever: BaseRetriever
+    embeddings: Embeddings
+    collections: list[str]
+    params: dict = {}  # retrieval mode etc., part of the key
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __params(self) -> dict:
+        inner = self.retriever
+        return {
+            **self.params,
+            "retriever": inner.__class__.__name__,
+            **{
+                x: getattr(inner, x) for x in
+                ["k", "fetch_k", "lambda_mult", "search_type", "search_kwargs"]
+                if hasattr(inner, x)
+            },
+        }
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector = self.embeddings.embed_query(query)
+        key = RetrievalCache.make_key(self.collections, vector, self.__params())  # noqa: E501
+        generations = RetrievalCache.generations(self.collections)
+        docs = RetrievalCache.get(key, generations)
+        if docs is None:
+            docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})  # noqa: E501
+            RetrievalCache.set(key, generations, docs)
+        return docs
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector = await self.embeddings.aembed_query(query)
+        key = RetrievalCache.make_key(self.collections, vector, self.__params())  # noqa: E501
+        generations = await RetrievalCache.agenerations(self.collections)
+        docs = RetrievalCache.get(key, generations)
+        if docs is None:
+            docs = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})  # noqa: E501
+            RetrievalCache.set(key, generations, docs)
+        return docs
@@ -0,0 +1,125 @@
+# Yan Pan, 2023
+import numpy as np
+from threading import Lock
+from time import time
+
+from botSettings.settings import get_settings
+from prompts.CollectionGeneration import CollectionGeneration
+
+
+class SemanticCache:
+    """
+    in-process cache of answers, looked up by question similarity.
+    one small index per (collection, model); an index is dropped when the
+    collection generation changes. least recently used entries are evicted
+    beyond SEMANTIC_CACHE_SIZE. intended for small public collections (about*)
+    """
+
+    _indices: dict = {}
+    _lock = Lock()
+    _stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @staticmethod
+    def applies_to(collection: str) -> bool:
+        settings = get_settings()
+        return settings.SEMANTIC_CACHE_SIZE > 0 and any(
+            collection.startswith(x)
+            for x in settings.SEMANTIC_CACHE_PREFIXES.split(",")
+        )
+
+    @classmethod
+    def __index(cls, collection: str, model: str, generation: int) -> dict:
+        """caller holds the lock"""
+        index = cls._indices.get((collection, model))
+        if index is not None and index["generation"] != generation:
+            cls._stats["invalidations"] += 1
+            index = None
+        if index is None:
+            index = {
+                "generation": generation,
+                "vectors": np.zeros((0, 0), dtype=np.float32),
+                "questions": [],
+                "answers": [],
+                "used": [],
+            }
+            cls._indices[(collection, model)] = index
+        return index
+
+    @staticmethod
+    def normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    @classmethod
+    def lookup(
+        cls,
+        collection: str,
+        model: str,
+        vector: np.ndarray,
+        generation: int = None,
+    ):
+        """(answer, similarity) of the closest past question, or (None, score)
+        async callers pass the generation (CollectionGeneration.aget)"""
+        threshold = get_settings().SEMANTIC_CACHE_THRESHOLD
+        if generation is None:
+            generation = CollectionGeneration.get(collection)
+        with cls._lock:
+            index = cls.__index(collection, model, generation)
+            if not len(index["answers"]):
+                cls._stats["misses"] += 1
+                return None, 0.0
+            scores = index["vectors"] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                cls._stats["misses"] += 1
+                return None, float(scores[best])
+            index["used"][best] = time()
+            cls._stats["hits"] += 1
+            return index["answers"][best], float(scores[best])
+
+    @classmethod
+    def store(
+        cls,
+        collection: str,
+        model: str,
+        question: str,
+        vector: np.ndarray,
+        answer: str,
+        generation: int = None,
+    ):
+        if not answer:
+            return None
+        max_size = get_settings().SEMANTIC_CACHE_SIZE
+        if generation is None:
+            generation = CollectionGeneration.get(collection)
+        with cls._lock:
+            index = cls.__index(collection, model, generation)
+            if question in index["questions"]:
+                return None
+            if len(index["answers"]) >= max_size:
+                oldest = int(np.argmin(index["used"]))
+                index["vectors"] = np.delete(index["vectors"], oldest, axis=0)
+                for field in ["questions", "answers", "used"]:
+                    index[field].pop(oldest)
+                cls._stats["evictions"] += 1
+            vectors = index["vectors"].reshape(-1, vector.shape[0])
+            index["vectors"] = np.vstack([vectors, vector[None, :]])
+            index["questions"].append(question)
+            index["answers"].append(answer)
+            index["used"].append(time())
+        return None
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            lookups = cls._stats["hits"] + cls._stats["misses"]
+            return {
+                **cls._stats,
+                "size": sum(len(x["answers"]) for x in cls._indices.values()),
+                "hit_rate": cls._stats["hits"] / lookups if lookups else 0.0,
+            }
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._indices.clear()
@@ -0,0 +1,122 @@
+# Yan Pan, 2023
+from asyncio import Event
+from typing import AsyncIterable, AsyncIterator
+
+from botSettings.settings import get_settings
+
+
+class Flight:
+    """
+    one upstream token stream with a replay buffer.
+    every subscriber receives the full stream from the first token,
+    independent of when it joined or how fast the others read
+    """
+
+    def __init__(self, key: str = ""):
+        self.key = key
+        self.tokens = []
+        self.result = None
+        self.done = False
+        self.joined = 0
+        self.subscribers = 0
+        self.upstream = None  # the generation task
+        self.racing = []  # hedged generations, until one wins
+        self.task = None  # the pump task
+        self.cancelled = False
+        self.__updated = Event()
+
+    def push(self, token: str):
+        self.tokens.append(token)
+        self.__updated.set()
+        self.__updated = Event()
+
+    async def pump(self, tokens: AsyncIterable[str]):
+        """read upstream tokens into the buffer, then the final result"""
+        try:
+            async for token in tokens:
+                self.push(token)
+            self.result = await self.upstream
+        finally:
+            self.done = True
+            self.__updated.set()
+            SingleFlight.release(self)
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """read the buffer from the start; call leave() when done reading"""
+        position = 0
+        while True:
+            if position < len(self.tokens):
+                position += 1
+                yield self.tokens[position - 1]
+            elif self.done:
+                return
+            else:
+                await self.__updated.wait()
+
+    def leave(self):
+        """
+        synchronous on purpose, safe inside a cancelled scope.
+        the last subscriber leaving an unfinished flight cancels generation
+        """
+        self.subscribers -= 1
+        if self.subscribers > 0 or self.done:
+            return None
+        self.cancelled = True
+        SingleFlight.cancelled()
+        # the pump then drains and finishes by itself
+        tasks = [self.upstream or self.task] + self.racing
+        for task in tasks:
+            if task is not None and not task.done():
+                task.cancel()
+        SingleFlight.release(self)
+
+
+class SingleFlight:
+    """
+    request coalescing for streams: concurrent identical requests (same key)
+    attach to the in-flight generation instead of starting their own.
+    generation is cancelled once every subscriber has disconnected
+    """
+
+    _flights: dict = {}
+    _stats = {"leaders": 0, "followers": 0, "disconnected": 0, "upstream_cancelled": 0}  # noqa: E501
+
+    @classmethod
+    def join(cls, key: str) -> tuple[Flight, bool]:
+        """the flight to read from, and whether the caller must start it"""
+        enabled = bool(key) and get_settings().SINGLE_FLIGHT
+        flight = cls._flights.get(key) if enabled else None
+        if flight is not None and not flight.done:
+            cls._stats["followers"] += 1
+            flight.joined += 1
+            flight.subscribers += 1
+            return flight, False
+
+        flight = Flight(key)
+        flight.joined, flight.subscribers = 1, 1
+        if enabled:
+            cls._flights[key] = flight
+            cls._stats["leaders"] += 1
+        return flight, True
+
+    @classmethod
+    def release(cls, flight: Flight):
+        if cls._flights.get(flight.key) is flight:
+            del cls._flights[flight.key]
+
+    @classmethod
+    def disconnected(cls):
+        cls._stats["disconnected"] += 1
+
+    @classmethod
+    def cancelled(cls):
+        cls._stats["upstream_cancelled"] += 1
+
+    @classmethod
+    def stats(cls) -> dict:
+        leaders, followers = cls._stats["leaders"], cls._stats["followers"]
+        return {
+            **cls._stats,
+            "in_flight": len(cls._flights),
+            "coalescing_ratio": (leaders + followers) / leaders if leaders else 1.0,  # noqa: E501
+        }
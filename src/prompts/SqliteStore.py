@@ -0,0 +1,62 @@
+# Yan Pan, 2023
+from os import getpid, makedirs
+from sqlite3 import connect
+from threading import local
+
+from botSettings.settings import get_settings
+
+
+class SqliteStore:
+    """
+    sqlite files under CACHE_PATH, shared by the caches and job records.
+    one connection per thread and file (sqlite connections stay in the
+    thread that opened them), each table is created once per connection.
+    blocking: async code calls it through asyncio.to_thread
+    """
+
+    _local = local()
+
+    @classmethod
+    def connection(cls, filename: str, schema: str):
+        state = cls._local.__dict__
+        if state.get("pid") != getpid():  # not inherited by forked workers
+            state.update(pid=getpid(), connections={})
+        cache_path = get_settings().CACHE_PATH
+        path = f"{cache_path}/{filename}"
+        if path not in state["connections"]:
+            makedirs(cache_path, exist_ok=True)
+            state["connections"][path] = (connect(path, timeout=5), set())
+        conn, tables = state["connections"][path]
+        if schema not in tables:
+            with conn:
+                conn.execute(schema)
+            tables.add(schema)
+        return conn
+
+    @classmethod
+    def close(cls, filename: str):
+        """connection of this thread, e.g. after an error"""
+        path = f"{get_settings().CACHE_PATH}/{filename}"
+        conn, _ = cls._local.__dict__.get("connections", {}).pop(path, (None, None))  # noqa: E501
+        if conn is not None:
+            conn.close()
+
+    @classmethod
+    def execute(
+        cls,
+        filename: str,
+        schema: str,
+        sql: str,
+        params=(),
+        fetch_all: bool = False,
+        many: bool = False,
+    ):
+        """one statement in a transaction, fetchone (or fetchall) result"""
+        try:
+            conn = cls.connection(filename, schema)
+            with conn:
+                cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)  # noqa: E501
+                return cursor.fetchall() if fetch_all else cursor.fetchone()
+        except Exception:
+            cls.close(filename)  # reconnect on the next call
+            raise
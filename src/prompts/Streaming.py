@@ -0,0 +1,65 @@
+# Yan Pan, 2023
+from asyncio import ensure_future, get_running_loop, wait
+from typing import AsyncIterable, AsyncIterator
+
+
+def sse_frame(text: str) -> str:
+    """one server-sent event, multi-line text becomes multiple data lines"""
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+
+async def coalesce_tokens(
+    tokens: AsyncIterable[str],
+    max_tokens: int = 16,
+    max_ms: int = 50,
+) -> AsyncIterator[str]:
+    """
+    merge small tokens into larger chunks.
+    flush when max_tokens are buffered or max_ms passed since the oldest
+    buffered token, whichever comes first.
+    the first non-empty token is never delayed (time-to-first-token).
+    """
+    loop = get_running_loop()
+    iterator = tokens.__aiter__()
+    buffer, deadline, is_first = [], None, True
+    # keep one pending __anext__; cancelling it would close the generator
+    pending = ensure_future(iterator.__anext__())
+    try:
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - loop.time(), 0)
+            done, _ = await wait({pending}, timeout=timeout)
+
+            if not done:
+                yield "".join(buffer)
+                buffer, deadline = [], None
+                continue
+
+            try:
+                token = pending.result()
+            except StopAsyncIteration:
+                break
+            pending = ensure_future(iterator.__anext__())
+
+            if not token:
+                continue
+            if is_first:
+                is_first = False
+                yield token
+                continue
+
+            buffer.append(token)
+            if deadline is None:
+                deadline = loop.time() + max_ms / 1000
+            if len(buffer) >= max_tokens:
+                yield "".join(buffer)
+                buffer, deadline = [], None
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if not pending.done():
+            pending.cancel()
+        elif not pending.cancelled():
+            pending.exception()  # retrieved, e.g. StopAsyncIteration
@@ -0,0 +1,137 @@
+# Yan Pan, 2023
+import numpy as np
+from asyncio import to_thread
+from elasticsearch.helpers import scan
+from hashlib import sha256
+from langchain_community.vectorstores import ElasticsearchStore
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from prompts.KnnIndex import KnnIndex
+from prompts.ModelRouter import ModelRouter
+
+
+class DocumentPooling:
+    """
+    one vector per source document: the chunk vectors weighted by chunk
+    tokens (as Dependencies.embed_text of the azure variant), summed and
+    normalized. stored next to the chunks as {collection}--documents.
+    sums are kept per source so that chunks can be added in batches,
+    incremental appends re-pool the touched sources (from_index)
+    """
+
+    SUFFIX = "--documents"
+
+    @staticmethod
+    def index_name(collection_name: str) -> str:
+        return f"{collection_name}{DocumentPooling.SUFFIX}"
+
+    @staticmethod
+    def id(source: str) -> str:
+        """one entry per source, re-ingested sources are replaced"""
+        return sha256(source.encode()).hexdigest()
+
+    @staticmethod
+    def add(pooled: dict, chunks: list[Document], vectors: list) -> dict:
+        """running token-weighted sums per source, batch by batch"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)  # noqa: E501
+        for chunk, vector in zip(chunks, vectors):
+            source = str(chunk.metadata.get("source", ""))
+            tokens = chunk.metadata.get("tokens") or ModelRouter.count_tokens(chunk.page_content)  # noqa: E501
+            total, count, weighted, head = pooled.get(source, (0, 0, 0.0, chunk.page_content[:200]))  # noqa: E501
+            pooled[source] = (total + tokens, count + 1, weighted + tokens * vector, head)  # noqa: E501
+        return pooled
+
+    @staticmethod
+    def from_hits(hits, text_field: str = "text", vector_field: str = "vector") -> dict:  # noqa: E501
+        """running sums of Elasticsearch chunk hits (_source with text,
+        vector and metadata), e.g. all chunks of the appended sources"""
+        pooled, chunks, vectors = {}, [], []
+        for hit in hits:
+            source = hit["_source"]
+            chunks.append(Document(
+                page_content=source.get(text_field, ""),
+                metadata=source.get("metadata", {}),
+            ))
+            vectors.append(source[vector_field])
+            if len(chunks) >= 1000:
+                DocumentPooling.add(pooled, chunks, vectors)
+                chunks, vectors = [], []
+        if chunks:
+            DocumentPooling.add(pooled, chunks, vectors)
+        return pooled
+
+    @staticmethod
+    def from_index(client, index: str, sources: list[str]) -> dict:
+        """running sums of the sources, re-pooled from all their chunks;
+        appends and expiry change a source without its earlier vectors"""
+        hits = scan(
+            client,
+            index=index,
+            query={"query": {"terms": {"metadata.source.keyword": sources}}},
+            _source=["text", "vector", "metadata"],
+        )
+        return DocumentPooling.from_hits(hits)
+
+    @staticmethod
+    def documents(pooled: dict) -> tuple[list, list, list]:
+        """(texts, pooled vectors, metadatas), one per metadata.source"""
+        texts, vectors, metadatas = [], [], []
+        for source, (total, count, weighted, head) in pooled.items():
+            texts.append(f"{source}\n{head}")
+            vectors.append((weighted / (np.linalg.norm(weighted) + 1e-12)).tolist())  # noqa: E501
+            metadatas.append({"source": source, "chunks": count, "tokens": total})  # noqa: E501
+        return texts, vectors, metadatas
+
+
+class TwoTierRetriever(BaseRetriever):
+    """
+    broad questions on large collections: the closest source documents
+    first (small pooled index), then chunks of those documents only.
+    collections without the documents index are searched directly
+    """
+
+    documents: ElasticsearchStore  # DocumentPooling index
+    chunks: ElasticsearchStore
+    k: int = 4
+    top_documents: int = 5
+    search_kwargs: dict = {}  # of the chunk search, fetch_k is KnnIndex
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def sources(self, vector: list[float]) -> list[str]:
+        try:
+            hits = self.documents.similarity_search_by_vector_with_relevance_scores(  # noqa: E501
+                vector, k=self.top_documents
+            )
+        except Exception as e:
+            print(f"two tier: no documents index {self.documents.index_name}", e)  # noqa: E501
+            return []
+        return [doc.metadata["source"] for doc, _ in hits]
+
+    def search(self, vector: list[float]) -> list[Document]:
+        sources = self.sources(vector)
+        within = [{"terms": {"metadata.source.keyword": sources}}] if sources else []  # noqa: E501
+        hits = self.chunks.similarity_search_by_vector_with_relevance_scores(
+            vector, k=self.k, filter=within,
+            **KnnIndex.search_kwargs(self.chunks, self.k),
+            **self.search_kwargs,
+        )
+        return [doc for doc, _ in hits]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        return self.search(self.chunks.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector = await self.chunks.embeddings.aembed_query(query)
+        return await to_thread(self.search, vector)
@@ -1,12 +1,20 @@
 # Yan Pan, 2023
-from datetime import datetime
-from glob import glob
-from langchain_community.document_loaders import TextLoader
+from asyncio import sleep, to_thread
+from itertools import chain
 from langchain_community.document_loaders.generic import GenericLoader
 from langchain_community.document_loaders.parsers.language.language_parser import LanguageParser
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pydantic import BaseModel
-
+from time import time
+
+from botSettings.settings import get_settings
+from prompts.ClientRegistry import ClientRegistry
+from prompts.CollectionGeneration import CollectionGeneration
+from prompts.IngestionJobs import IngestionJobs, IngestionRejected
+from prompts.IngestionPipeline import IngestionPipeline
+from prompts.LogTail import LogTail
+from prompts.LogTemplates import LogTemplates
+from prompts.TwoTierRetriever import DocumentPooling
 from prompts.VectorStorage import VectorStorage
 
 
@@ -24,21 +32,34 @@ class VectorSpecialty(VectorStorage):
         language: str = "python"
         suffix: str = ".py"
         database: str = "elasticsearch"
+        index_options: dict = {}  # elasticsearch, see KnnIndex.OPTIONS
 
     class InputLoadLogSchema(BaseModel):
         collection_name: str = "rolling"
         days: int = 1
         database: str = "elasticsearch"
+        index_options: dict = {}  # elasticsearch, see KnnIndex.OPTIONS
+        incremental: bool = False  # elasticsearch, see tail_logs_db
+        templates: bool = True  # see LogTemplates, False embeds all chunks
 
     @staticmethod
     async def create_logs_db(
         name: str = "logs",
         database: str = "elasticsearch",
         days: int = 1,
+        index_options: dict = {},
+        incremental: bool = False,
+        templates: bool = True,
         **kwargs,
     ):
         """automatic rolling: existing vector db will be removed"""
 
+        if incremental:
+            return VectorSpecialty.tail_logs_db(
+                name=name, database=database, days=days,
+                index_options=index_options, templates=templates,
+            )
+
         try:
             await VectorStorage.delete_persistent_collection(
                 collection_name=name, database=database
@@ -46,19 +67,19 @@ class VectorSpecialty(VectorStorage):
         except Exception as e:
             print("create_logs_db: not deleted", e)
 
-        int_today = int(f"{datetime.now():%Y%m%d}")
-        # buffering logs (today) + matched previous days
-        matched_logs = glob("/mnt/shared/fluentd/*/*.log")
-        for i in range(days):
-            matched_logs += glob(f"/mnt/shared/fluentd/*{int_today - i}.log")
+        # buffering logs (recent) + matched previous days
+        matched_logs = LogTail.matched(days)
 
         splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=100,
         )
-        texts = []
-        for x in matched_logs:
-            texts.extend(splitter.split_documents(TextLoader(x).load()))
+        # streamed, see IngestionPipeline
+        blocks = (block for x in matched_logs for block in IngestionPipeline.file_blocks(x))  # noqa: E501
+        if templates:
+            texts = LogTemplates().documents(blocks)
+        else:
+            texts = IngestionPipeline.split(blocks, splitter)
 
         params = {
             "source_file": "",
@@ -69,11 +90,112 @@ class VectorSpecialty(VectorStorage):
 
         if database.lower() == "chroma":
             VectorStorage.chroma_create_persistent_collection(**params)
+        elif database.lower() == "local":
+            VectorStorage.local_create_persistent_collection(**params)
         else:
-            VectorStorage.elasticsearch_create_persistent_index(**params)
+            VectorStorage.elasticsearch_create_persistent_index(
+                index_options=index_options, **params
+            )
 
         return matched_logs
 
+    @staticmethod
+    def tail_logs_db(
+        name: str = "logs",
+        database: str = "elasticsearch",
+        days: int = 1,
+        index_options: dict = {},
+        templates: bool = True,
+        **kwargs,
+    ):
+        """
+        incremental rolling: lines added since the last run are appended,
+        documents older than days are expired, see LogTail.
+        without a checkpoint the collection is rebuilt
+        """
+        if database.lower() != "elasticsearch":
+            raise ValueError("incremental logs are elasticsearch only")
+
+        with LogTail(name) as tail:
+            if not tail.locked:
+                return {"status": "skipped", "message": "previous run in progress"}  # noqa: E501
+            client = ClientRegistry.get_elasticsearch()
+            tail.update(LogTail.matched(days))
+            expired, cutoff = 0, time() - days * 86400
+            if tail.fresh:
+                client.indices.delete(index=name, ignore_unavailable=True)
+                client.indices.delete(index=DocumentPooling.index_name(name), ignore_unavailable=True)  # noqa: E501
+            else:
+                expired = client.delete_by_query(
+                    index=name,
+                    query={"range": {"metadata.time": {"lt": cutoff}}},
+                    conflicts="proceed",
+                    refresh=True,
+                    ignore_unavailable=True,
+                ).get("deleted", 0)
+                if tail.dropped:
+                    client.delete_by_query(
+                        index=DocumentPooling.index_name(name),
+                        query={"terms": {"metadata.source.keyword": tail.dropped}},  # noqa: E501
+                        conflicts="proceed",
+                        ignore_unavailable=True,
+                    )
+
+            splitter = RecursiveCharacterTextSplitter(
+                chunk_size=1000,
+                chunk_overlap=100,
+            )
+            if templates:  # counts of touched buckets replace the previous
+                miner = LogTemplates(tail.state.get("templates"))
+                texts = miner.documents(tail.blocks())
+            else:
+                texts = IngestionPipeline.split(tail.blocks(), splitter)
+            first = next(texts, None)
+            if first is not None:
+                VectorStorage.elasticsearch_create_persistent_index(
+                    source_file="",
+                    collection_name=name,
+                    predefined_texts=chain([first], texts),
+                    index_options=index_options,
+                    append=not tail.fresh,
+                )
+            elif expired or tail.fresh:
+                CollectionGeneration.bump(name)
+            if expired:  # pooled vectors still include the expired chunks
+                VectorStorage.elasticsearch_pool_sources(name, list(tail.files))  # noqa: E501
+            if templates:
+                tail.state["templates"] = miner.state(since=cutoff)
+            tail.save()  # only once the lines are indexed
+
+        return {
+            "status": "done",
+            "files": list(tail.files),
+            "bytes": sum(x["offset"] for x in tail.files.values()),
+            "expired": expired,
+        }
+
+    @staticmethod
+    async def schedule_log_tail():
+        """
+        background: tail_logs_db of log-{LOG_TAIL_COLLECTION} as an ingestion
+        job every LOG_TAIL_INTERVAL seconds, unless the previous one is busy
+        """
+        settings = get_settings()
+        name = f"log-{settings.LOG_TAIL_COLLECTION}"
+        job = None
+        while True:
+            if job is not None:
+                job = await to_thread(IngestionJobs.get, job["id"])
+            if job is None or job.get("status") not in ["queued", "running"]:  # noqa: E501
+                try:
+                    job = await IngestionJobs.asubmit(
+                        "log", name, VectorSpecialty.tail_logs_db,
+                        name=name, days=settings.LOG_TAIL_DAYS,
+                    )
+                except IngestionRejected as e:
+                    print("log tail not scheduled", e)
+            await sleep(settings.LOG_TAIL_INTERVAL)
+
     @staticmethod
     def create_codebase_db(
         name: str = "codebase",
@@ -81,6 +203,7 @@ class VectorSpecialty(VectorStorage):
         path: str = "/app",
         language: str = "python",
         suffix: str = ".py",
+        index_options: dict = {},
         **kwargs,
     ):
         loader = GenericLoader.from_filesystem(
@@ -89,14 +212,21 @@ class VectorSpecialty(VectorStorage):
             suffixes=suffix.split(","),
             parser=LanguageParser(language=language, parser_threshold=500)
         )
-        documents = loader.load()
-        docs_loaded = [x.metadata.get('source', '?') for x in documents]
-
-        texts = RecursiveCharacterTextSplitter.from_language(
-            language=language,
-            chunk_size=2000,
-            chunk_overlap=200
-        ).split_documents(documents)
+        docs_loaded = []
+
+        def documents():
+            for x in loader.lazy_load():
+                docs_loaded.append(x.metadata.get('source', '?'))
+                yield x
+
+        texts = IngestionPipeline.split(
+            documents(),
+            RecursiveCharacterTextSplitter.from_language(
+                language=language,
+                chunk_size=2000,
+                chunk_overlap=200
+            ),
+        )
 
         params = {
             "source_file": "",
@@ -107,7 +237,11 @@ class VectorSpecialty(VectorStorage):
 
         if database.lower() == "chroma":
             VectorStorage.chroma_create_persistent_collection(**params)
+        elif database.lower() == "local":
+            VectorStorage.local_create_persistent_collection(**params)
         else:
-            VectorStorage.elasticsearch_create_persistent_index(**params)
+            VectorStorage.elasticsearch_create_persistent_index(
+                index_options=index_options, **params
+            )
 
         return docs_loaded
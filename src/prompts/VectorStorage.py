@@ -1,15 +1,22 @@
 # Yan Pan, 2023
 from glob import glob
 from httpx import AsyncClient
-from langchain_openai import OpenAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma, ElasticsearchStore
 
 from os import system
 from pydantic import BaseModel
+from uuid import uuid4
 
 # Loaders are imported only when necessary
-from botSettings.settings import Settings
+from botSettings.settings import get_settings
+from prompts.ClientRegistry import ClientRegistry
+from prompts.CollectionGeneration import CollectionGeneration
+from prompts.IngestionJobs import IngestionJobs
+from prompts.IngestionPipeline import IngestionPipeline
+from prompts.KnnIndex import KnnIndex
+from prompts.LocalVectorStore import LocalVectorStore
+from prompts.TwoTierRetriever import DocumentPooling
 
 
 class VectorStorage:
@@ -22,6 +29,7 @@ class VectorStorage:
         collection_name: str
         is_web_url: bool = False
         database: str = "elasticsearch"
+        index_options: dict = {}  # elasticsearch, see KnnIndex.OPTIONS
 
     class InputDelSchema(BaseModel):
         collection_name: str
@@ -32,7 +40,7 @@ class VectorStorage:
 
     @staticmethod
     def delete_filesystem_file(filename):
-        upload_dir = Settings().UPLOAD_PATH
+        upload_dir = get_settings().UPLOAD_PATH
         if upload_dir not in filename:
             filename = f"{upload_dir}/{filename}"
         system(f'rm -f "{filename}"')
@@ -43,16 +51,23 @@ class VectorStorage:
         collection_name: str,
         database: str
     ):
-        settings = Settings()
+        settings = get_settings()
         message = {"message": f"deleted {collection_name} from {database}"}
+        CollectionGeneration.bump(collection_name)
         try:
             if database.lower() == "chroma":
                 collection_dir = f"{settings.CHROMA_PATH}/{collection_name}"
                 system(f"rm -rf {collection_dir}")
                 return {"status": "deleted", "database": "chroma", **message}
+            if database.lower() == "local":
+                collection_dir = LocalVectorStore.collection_path(collection_name)  # noqa: E501
+                LocalVectorStore.close(collection_dir)
+                system(f'rm -rf "{collection_dir}"')
+                return {"status": "deleted", "database": "local", **message}
 
             async with AsyncClient() as client:
-                res = await client.delete(url=f"{Settings().ELASTICSEARCH_URL}/{collection_name}")  # noqa: E501
+                res = await client.delete(url=f"{get_settings().ELASTICSEARCH_URL}/{collection_name}")  # noqa: E501
+                await client.delete(url=f"{get_settings().ELASTICSEARCH_URL}/{DocumentPooling.index_name(collection_name)}")  # noqa: E501
             if res.status_code > 299:
                 raise Exception(f"Elastic Search not available {res.text}")
             return {"status": "deleted", "database": "elasticsearch", **message}  # noqa: E501
@@ -67,17 +82,19 @@ class VectorStorage:
     async def list_vector_db_set():
         try:
             async with AsyncClient() as client:
-                res = await client.get(url=f"{Settings().ELASTICSEARCH_URL}/_aliases")  # noqa: E501
+                res = await client.get(url=f"{get_settings().ELASTICSEARCH_URL}/_aliases")  # noqa: E501
             if res.status_code > 299:
                 raise Exception(f"Elastic Search not available {res.text}")
             indices = [
                 k for k, _ in res.json().items()
                 if (not k.startswith(".")) and ("fluentd" not in k)
+                and not k.endswith(DocumentPooling.SUFFIX)
             ]
         except Exception as e:
             raise Exception(f"Elastic Search not available {e}")
         return {
-            "chroma": [x.split("/")[-1] for x in glob(f"{Settings().CHROMA_PATH}/*")],  # noqa: E501
+            "chroma": [x.split("/")[-1] for x in glob(f"{get_settings().CHROMA_PATH}/*")],  # noqa: E501
+            "local": [x.split("/")[-2] for x in glob(f"{get_settings().LOCAL_VECTOR_PATH}/*/vectors.npy")],  # noqa: E501
             "elasticsearch": indices,
         }
 
@@ -86,8 +103,16 @@ class VectorStorage:
         source_file: str,
         is_web_url: bool = False
     ):
-        """used by chroma/elasticsearch_create_..."""
-        file_dir = Settings().UPLOAD_PATH
+        """all chunks as a list, see iter_documents"""
+        return list(VectorStorage.iter_documents(source_file, is_web_url))
+
+    @staticmethod
+    def iter_documents(
+        source_file: str,
+        is_web_url: bool = False
+    ):
+        """chunks of a file, loaded and split lazily; used by *_create_..."""
+        file_dir = get_settings().UPLOAD_PATH
         if (not is_web_url) and (file_dir not in source_file):
             source_file = f"{file_dir}/{source_file}"
         source_file_ext = source_file.split(".")[-1].lower()
@@ -100,7 +125,7 @@ class VectorStorage:
 
         elif source_file_ext in ["html", "htm"]:
             from langchain_community.document_loaders import BSHTMLLoader
-            loader = BSHTMLLoader(file_path=source_file),
+            loader = BSHTMLLoader(file_path=source_file)
 
         elif source_file_ext in ["csv"]:
             from langchain_community.document_loaders import UnstructuredCSVLoader
@@ -118,20 +143,30 @@ class VectorStorage:
             from langchain_community.document_loaders import UnstructuredMarkdownLoader
             loader = UnstructuredMarkdownLoader(source_file)
 
-        elif source_file_ext in ["txt"]:
-            from langchain_community.document_loaders import TextLoader
-            loader = TextLoader(source_file)
+        elif source_file_ext in ["txt", "log"]:
+            loader = None  # blocks of lines, see IngestionPipeline
 
         else:
             raise ValueError("Unsupported file type")
 
-        documents = loader.load()
-        texts = RecursiveCharacterTextSplitter(
+        documents = IngestionPipeline.file_blocks(source_file) if loader is None else loader.lazy_load()  # noqa: E501
+        splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=100,
-        ).split_documents(documents)
+            add_start_index=True,
+        )
+        return IngestionPipeline.split(documents, splitter)
 
-        return texts
+    @staticmethod
+    def chunks(
+        source_file: str,
+        is_web_url: bool = False,
+        predefined_texts=None,
+    ):
+        """predefined_texts (list or generator of chunks) or chunks of the file"""  # noqa: E501
+        if predefined_texts is None or (isinstance(predefined_texts, list) and not predefined_texts):  # noqa: E501
+            return VectorStorage.iter_documents(source_file, is_web_url)
+        return iter(predefined_texts)
 
     @staticmethod
     def chroma_create_persistent_collection(
@@ -146,16 +181,17 @@ class VectorStorage:
         collection_name is also the folder name
         if predefined_texts is provided, will skip document loader and splitter
         """
-        settings = Settings()
-        cond = bool(predefined_texts is not None and len(predefined_texts))
-        docs = predefined_texts if cond else VectorStorage.prepare_documents(source_file, is_web_url)  # noqa: E501
+        settings = get_settings()
+        docs = list(VectorStorage.chunks(source_file, is_web_url, predefined_texts))  # noqa: E501
         vector_db = Chroma.from_documents(
             documents=docs,
-            embedding=OpenAIEmbeddings(openai_api_key=settings.OPENAI_KEY),
+            embedding=ClientRegistry.get_embeddings(priority="bulk"),
             persist_directory=f"{settings.CHROMA_PATH}/{collection_name}",
         )
         vector_db.persist()
         del vector_db
+        IngestionJobs.report(embeddings=len(docs))
+        CollectionGeneration.bump(collection_name)
 
         return None
 
@@ -165,16 +201,95 @@ class VectorStorage:
         collection_name: str,
         is_web_url: bool = False,
         predefined_texts: list = [],
+        index_options: dict = {},
+        append: bool = False,
     ):
-        """similar to chroma_create_persistent_collection"""
-        settings = Settings()
-        cond = bool(predefined_texts is not None and len(predefined_texts))
-        docs = predefined_texts if cond else VectorStorage.prepare_documents(source_file, is_web_url)  # noqa: E501
-        es = ElasticsearchStore.from_documents(
-            documents=docs,
+        """
+        similar to chroma_create_persistent_collection
+        index_options (KnnIndex) apply when the index is new
+        the pooled vector of each source goes to the DocumentPooling index,
+        append: sources may have earlier chunks, they are re-pooled
+        """
+        docs = VectorStorage.chunks(source_file, is_web_url, predefined_texts)
+        KnnIndex.create(
+            ClientRegistry.get_elasticsearch(),
+            collection_name,
+            KnnIndex.options(collection_name, **index_options),
+            quiet=append,
+        )
+        embedding = ClientRegistry.get_embeddings(priority="bulk")
+        es = ElasticsearchStore(
             index_name=collection_name,
-            embedding=OpenAIEmbeddings(openai_api_key=settings.OPENAI_KEY),
-            es_url=settings.ELASTICSEARCH_URL,
+            embedding=embedding,
+            es_connection=ClientRegistry.get_elasticsearch(),
         )
+        pooled = {}
+        for batch, vectors in IngestionPipeline.embed(docs, embedding):
+            es.add_embeddings(  # one bulk request per batch
+                list(zip([x.page_content for x in batch], vectors)),
+                metadatas=[x.metadata for x in batch],
+                ids=[x.metadata.get("id") or uuid4().hex for x in batch],  # same id replaces  # noqa: E501
+                refresh_indices=False,
+                bulk_kwargs={"chunk_size": len(batch)},
+            )
+            DocumentPooling.add(pooled, batch, vectors)
         es.client.indices.refresh(index=collection_name)
+
+        if append:
+            VectorStorage.elasticsearch_pool_sources(collection_name, list(pooled))  # noqa: E501
+        else:
+            VectorStorage.elasticsearch_add_pooled(collection_name, pooled)
+        CollectionGeneration.bump(collection_name)
+        return None
+
+    @staticmethod
+    def elasticsearch_add_pooled(collection_name: str, pooled: dict):
+        """pooled vectors to the DocumentPooling index, one per source"""
+        texts, vectors, metadatas = DocumentPooling.documents(pooled)
+        if texts:
+            ElasticsearchStore(
+                index_name=DocumentPooling.index_name(collection_name),
+                embedding=ClientRegistry.get_embeddings(priority="bulk"),
+                es_connection=ClientRegistry.get_elasticsearch(),
+            ).add_embeddings(
+                list(zip(texts, vectors)),
+                metadatas=metadatas,
+                ids=[DocumentPooling.id(x["source"]) for x in metadatas],  # re-ingested sources replace  # noqa: E501
+            )
+        return None
+
+    @staticmethod
+    def elasticsearch_pool_sources(collection_name: str, sources: list[str]):  # noqa: E501
+        """re-pool the sources from all their chunks in the index, sources
+        without chunks (expired) leave the DocumentPooling index"""
+        if not sources:
+            return None
+        client = ClientRegistry.get_elasticsearch()
+        pooled = DocumentPooling.from_index(client, collection_name, sources)
+        VectorStorage.elasticsearch_add_pooled(collection_name, pooled)
+        emptied = [x for x in sources if x not in pooled]
+        if emptied:
+            client.delete_by_query(
+                index=DocumentPooling.index_name(collection_name),
+                query={"terms": {"metadata.source.keyword": emptied}},
+                conflicts="proceed",
+                ignore_unavailable=True,
+            )
+        return None
+
+    @staticmethod
+    def local_create_persistent_collection(
+        source_file: str,
+        collection_name: str,
+        is_web_url: bool = False,
+        predefined_texts: list = [],
+    ):
+        """similar to chroma_create_persistent_collection, see LocalVectorStore"""  # noqa: E501
+        docs = VectorStorage.chunks(source_file, is_web_url, predefined_texts)
+        embedding = ClientRegistry.get_embeddings(priority="bulk")
+        path = LocalVectorStore.collection_path(collection_name)
+        with LocalVectorStore.Writer(path) as writer:
+            for batch, vectors in IngestionPipeline.embed(docs, embedding):
+                writer.add([x.page_content for x in batch], vectors, [x.metadata for x in batch])  # noqa: E501
+        CollectionGeneration.bump(collection_name)
         return None
@@ -5,6 +5,8 @@ from fastapi.responses import StreamingResponse
 from prompts.CodeAnalyzer import CodeAnalyzer
 from prompts.DocumentQA import DocumentQA
 from prompts.DocumentQAMultiple import DocumentQAMultiple
+from prompts.IngestionJobs import IngestionJobs, IngestionRejected
+from prompts.RateLimiter import RateLimitRejected
 from prompts.VectorStorage import VectorStorage
 
 
@@ -28,12 +30,28 @@ def get_trace_callable(request: Request):
     return trace_func if callable(trace_func) else print
 
 
+def admit_or_429(agent):
+    """
+    reject when the provider queue is full,
+    for streams this must happen before the response starts
+    """
+    try:
+        agent.admit()
+    except RateLimitRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": f"{e.retry_after:.0f}"}
+        )
+    return agent
+
+
 @router.post(
     "/chat-document",
     tags=["LLM Structured Answer"],
     response_model=DocumentQA.OutputSchema
 )
-def chat_document(
+async def chat_document(
     request: Request,
     payload: DocumentQA.InputSchema
 ):
@@ -44,10 +62,12 @@ def chat_document(
     agent = DocumentQA(
         db_name="aboutme" if payload.collection == "default" else payload.collection,  # noqa: E501
         db_type=payload.database,
+        retrieval=payload.retrieval,
+        chain_type=payload.chain_type,
         model_name=payload.model,
         trace_func=get_trace_callable(request)
     )
-    return agent.ask(payload.question)
+    return await admit_or_429(agent).aask(payload.question)
 
 
 @router.get(
@@ -74,28 +94,52 @@ def create_collection_from_file(
     payload: VectorStorage.InputSchema
 ):
     """
-    Create a ChromaDB collection from an uploaded file.\n
-    This actions may take a few minutes to complete; please wait patiently.
+    Create a vector collection from an uploaded file, in background.\n
+    Returns a job id at once, progress at /ingestion-jobs/{job_id}
     """
     create_func = VectorStorage.chroma_create_persistent_collection
+    options = {}
     if payload.database.lower() == "elasticsearch":
         create_func = VectorStorage.elasticsearch_create_persistent_index
+        options = {"index_options": payload.index_options}
+    if payload.database.lower() == "local":
+        create_func = VectorStorage.local_create_persistent_collection
 
     try:
-        # VectorStorage.chroma_create_persistent_collection(
-        create_func(
+        job = IngestionJobs.submit(
+            "collection",
+            payload.collection_name,
+            create_func,
             source_file=payload.source_file,
             collection_name=payload.collection_name,
             is_web_url=payload.is_web_url,
+            **options
         )
-    except Exception as e:
-        print(e)
-        raise HTTPException(status_code=500, detail=str(e))
+    except IngestionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e))
 
-    return {"message": (
-        f"{payload.collection_name} "
-        f"created from {payload.source_file}"
-    )}
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "message": (
+            f"{payload.collection_name} "
+            f"queued from {payload.source_file}"
+        )
+    }
+
+
+@router.get(
+    path="/ingestion-jobs/{job_id}",
+    summary="[non-admin ok] Progress of a collection being created",
+    tags=["LLM Admin"],
+    response_model=dict
+)
+def get_ingestion_job(request: Request, job_id: str):
+    """documents, chunks and embeddings done, elapsed seconds and error"""
+    job = IngestionJobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"no job {job_id}")
+    return job
 
 
 @router.post(
@@ -103,15 +147,16 @@ def create_collection_from_file(
     tags=["LLM Structured Answer"],
     response_model=CodeAnalyzer.OutputSchema
 )
-def analyze_code(
+async def analyze_code(
     request: Request,
     payload: CodeAnalyzer.InputSchema
 ):
-    return CodeAnalyzer(
+    agent = CodeAnalyzer(
         temperature=payload.temperature,
         model_name=payload.model,
         trace_func=get_trace_callable(request)
-    ).analyze(payload.code)
+    )
+    return await admit_or_429(agent).aanalyze(payload.code)
 
 
 @router.post("/stream/code", tags=["LLM Streaming Response"])
@@ -126,7 +171,9 @@ def analyze_code_stream(
         trace_func=get_trace_callable(request)
     )
     return StreamingResponse(
-        agent.analyze_stream(payload.code),
+        admit_or_429(agent).analyze_stream(
+            payload.code, is_disconnected=request.is_disconnected
+        ),
         media_type="text/event-stream",
         headers={'Connection': 'keep-alive', 'Cache-Control': 'no-cache'}
     )
@@ -147,6 +194,8 @@ def chat_about_me_stream(
     agent = DocumentQA(
         db_name=db_name,
         db_type=payload.database,
+        retrieval=payload.retrieval,
+        chain_type=payload.chain_type,
         temperature=payload.temperature,
         model_name=payload.model,
         streaming=True,
@@ -154,7 +203,9 @@ def chat_about_me_stream(
     )
 
     return StreamingResponse(
-        agent.ask_stream(payload.question),
+        admit_or_429(agent).ask_stream(
+            payload.question, is_disconnected=request.is_disconnected
+        ),
         media_type="text/event-stream",
         headers={'Connection': 'keep-alive', 'Cache-Control': 'no-cache'}
     )
@@ -168,6 +219,8 @@ def chat_document_stream(
     agent = DocumentQA(
         db_name="aboutme" if payload.collection == "default" else payload.collection,  # noqa: E501
         db_type=payload.database,
+        retrieval=payload.retrieval,
+        chain_type=payload.chain_type,
         temperature=payload.temperature,
         model_name=payload.model,
         include_source=payload.include_source,
@@ -175,17 +228,49 @@ def chat_document_stream(
         trace_func=get_trace_callable(request)
     )
     return StreamingResponse(
-        agent.ask_stream(payload.question),
+        admit_or_429(agent).ask_stream(
+            payload.question, is_disconnected=request.is_disconnected
+        ),
         media_type="text/event-stream",
         headers={'Connection': 'keep-alive', 'Cache-Control': 'no-cache'}
     )
 
 
 @router.post("/alpha/chat-multi-docs", tags=["LLM Streaming Response"])
-def chat_multi_docs_stream(
+async def chat_multi_docs_stream(
     request: Request,
-    payload: DocumentQA.InputSchema
+    payload: DocumentQAMultiple.InputSchema
 ):
-    agent = DocumentQAMultiple()
-
-    return agent.ask(payload.question)
+    """
+    logs and code base (or comma separated collections) queried together;
+    use_agent answers with the tool-using agent instead, a shared agent
+    on its own model and collections: model, temperature, retrieval,
+    chain_type and collection do not apply to it
+    """
+    collections = None
+    if payload.collection != "default":
+        collections = [x.strip() for x in payload.collection.split(",")]
+    agent = DocumentQAMultiple(
+        collections=collections,
+        db_type=payload.database,
+        chain_type=payload.chain_type,
+        temperature=payload.temperature,
+        model_name=payload.model,
+        include_source=payload.include_source,
+        streaming=True,
+        trace_func=get_trace_callable(request)
+    )
+    admit_or_429(agent)
+    if payload.use_agent:
+        stream = agent.agent_stream(
+            payload.question, is_disconnected=request.is_disconnected
+        )
+    else:
+        stream = agent.ask_stream(
+            payload.question, is_disconnected=request.is_disconnected
+        )
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={'Connection': 'keep-alive', 'Cache-Control': 'no-cache'}
+    )
@@ -2,12 +2,20 @@
 from fastapi import APIRouter, HTTPException, File, Request, UploadFile
 from os import listdir
 
-from botSettings.settings import Settings
+from botSettings.settings import get_settings
+from prompts.EmbeddingCache import ChunkEmbeddingCache, EmbeddingCache
+from prompts.Hedging import Hedging
+from prompts.IngestionJobs import IngestionJobs, IngestionRejected
+from prompts.RateLimiter import ProviderScheduler
+from prompts.ResponseCache import ResponseCache
+from prompts.RetrievalCache import RetrievalCache
+from prompts.SemanticCache import SemanticCache
+from prompts.SingleFlight import SingleFlight
 from prompts.VectorStorage import VectorStorage
 from prompts.VectorSpecialty import VectorSpecialty
 
 router_admin_only = APIRouter()
-file_dir = Settings().UPLOAD_PATH
+file_dir = get_settings().UPLOAD_PATH
 
 
 @router_admin_only.post("/create-vector-codebase")
@@ -24,10 +32,16 @@ async def create_codebase_vector_db(
     except:  # noqa: E722
         params = payload.dict()  # pydantic backward compatibility
     params["name"] = f"codebase-{payload.collection_name}"
-    docs = VectorSpecialty.create_codebase_db(**params)
+    try:
+        job = await IngestionJobs.asubmit(
+            "codebase", params["name"], VectorSpecialty.create_codebase_db, **params  # noqa: E501
+        )
+    except IngestionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e))
     return {
-        "loaded": docs,
-        "message": f"codebase vectorized from {len(docs)} files"
+        "job_id": job["id"],
+        "status": job["status"],
+        "message": "codebase queued, loaded files are the job result"
     }
 
 
@@ -38,26 +52,54 @@ async def create_recent_log_vector_db(
 ):
     """
     collection name will be prefixed with logs- for frontend use\n
-    rolling database is recommended, i.e. collection_name='rolling'
+    rolling database is recommended, i.e. collection_name='rolling'\n
+    incremental appends new lines only and expires older than days
     """
     try:
         params = payload.model_dump()
     except:  # noqa: E722
         params = payload.dict()  # pydantic backward compatibility
     params["name"] = f"log-{payload.collection_name}"
-    docs = await VectorSpecialty.create_logs_db(**params)
+    try:
+        job = await IngestionJobs.asubmit(
+            "log", params["name"], VectorSpecialty.create_logs_db, **params
+        )
+    except IngestionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e))
     return {
-        "loaded": docs,
-        "message": f"log vectorized from {len(docs)} files"
+        "job_id": job["id"],
+        "status": job["status"],
+        "message": "log queued, loaded files are the job result"
     }
 
 
+@router_admin_only.get("/ingestion-jobs", summary="Recent ingestion jobs")
+def list_ingestion_jobs(request: Request, limit: int = 20):
+    """newest first, from all workers"""
+    return IngestionJobs.recent(limit)
+
+
 @router_admin_only.get("/admin", summary="Check admin privileges")
 def admin_panel(request: Request):
     """only for checking admin privileges"""
     return {"admin": "yes"}
 
 
+@router_admin_only.get("/metrics", summary="Cache and scheduling metrics")
+def get_metrics(request: Request):
+    """in-process counters of this worker"""
+    return {
+        "response_cache": ResponseCache.stats(),
+        "semantic_cache": SemanticCache.stats(),
+        "embedding_cache": EmbeddingCache.stats(),
+        "chunk_embedding_cache": ChunkEmbeddingCache.stats(),
+        "retrieval_cache": RetrievalCache.stats(),
+        "single_flight": SingleFlight.stats(),
+        "provider_scheduler": ProviderScheduler.stats(),
+        "hedging": Hedging.stats(),
+    }
+
+
 @router_admin_only.get("/list-uploaded-files", response_model=list[str])
 async def list_uploaded_files(request: Request):
     """List all uploaded files"""
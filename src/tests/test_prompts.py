@@ -0,0 +1,795 @@
+# Yan Pan
+# python -m pytest -sv
+from asyncio import CancelledError, create_task, run, sleep
+from httpx import AsyncClient, MockTransport, Response
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain_community.callbacks import OpenAICallbackHandler
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_openai import ChatOpenAI
+from pytest import fixture, raises
+from sqlite3 import connect
+from subprocess import Popen
+from time import monotonic
+
+from botSettings.settings import get_settings
+from prompts.BaseOpenAI import BaseOpenAI
+from prompts.ClientRegistry import ClientRegistry
+from prompts.CollectionGeneration import CollectionGeneration
+from prompts.ContextPacker import ContextPacker
+from prompts.DocumentQA import DocumentQA
+from prompts.DocumentQAMultiple import DocumentQAMultiple
+from prompts.EmbeddingCache import CachedEmbeddings, ChunkEmbeddingCache, EmbeddingCache
+from prompts.HybridRetriever import HybridRetriever
+from prompts.FederatedRetriever import FederatedRetriever
+from prompts.Hedging import Hedging, Racer
+from prompts.IngestionJobs import IngestionJobs
+from prompts.KnnIndex import KnnIndex
+from prompts.LocalVectorStore import LocalVectorStore
+from prompts.LogTail import LogTail
+from prompts.LogTemplates import LogTemplates
+from prompts.ModelRouter import ModelRouter
+from prompts.Reranking import Reranking
+from prompts.RetrievalCache import CachedRetriever, RetrievalCache
+from prompts.RateLimiter import ProviderScheduler, RateLimitRejected
+from prompts.ResponseCache import ResponseCache
+from prompts.SemanticCache import SemanticCache
+from prompts.SingleFlight import SingleFlight
+from prompts.TwoTierRetriever import DocumentPooling, TwoTierRetriever
+from prompts.Streaming import coalesce_tokens, sse_frame
+
+
+@fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    """no test reads or writes the real CACHE_PATH"""
+    monkeypatch.setenv("BOT_CACHE_PATH", str(tmp_path))
+    get_settings.cache_clear()
+    yield
+    get_settings.cache_clear()
+
+
+def test_client_registry_shares_pool():
+    """same key shares http client, callbacks stay per-request"""
+    cb1, cb2 = OpenAICallbackHandler(), OpenAICallbackHandler()
+    llm1 = ClientRegistry.get_chat(temperature=0.1, callbacks=[cb1])
+    llm2 = ClientRegistry.get_chat(temperature=0.1, callbacks=[cb2])
+    assert llm1.async_client is llm2.async_client
+    assert llm1.callbacks == [cb1] and llm2.callbacks == [cb2]
+    assert ClientRegistry.get_chat(temperature=0.5).client is not llm1.client
+
+
+def test_coalesce_tokens_flush():
+    """first token alone, then flush by count, remainder at the end"""
+    async def tokens():
+        for x in ["", "a", "b", "c", "d", "e", "f"]:
+            yield x
+
+    async def collect():
+        return [x async for x in coalesce_tokens(tokens(), max_tokens=2, max_ms=1000)]  # noqa: E501
+
+    assert run(collect()) == ["a", "bc", "de", "f"]
+    assert sse_frame("x\ny") == "data: x\ndata: y\n\n"
+
+
+def test_response_cache_tiers(monkeypatch):
+    """memory LRU evicts, sqlite tier still answers; generation changes key"""
+    monkeypatch.setenv("BOT_RESPONSE_CACHE_SIZE", "1")
+    get_settings.cache_clear()
+    try:
+        ResponseCache.set("k1", "answer one")
+        ResponseCache.set("k2", "answer two")
+        assert ResponseCache.get("k1") == "answer one"  # from disk
+        assert ResponseCache.stats()["hits_disk"] >= 1
+
+        key = ResponseCache.make_key(
+            collection="about", generation=CollectionGeneration.get("about")
+        )
+        CollectionGeneration.bump("about")
+        assert key != ResponseCache.make_key(
+            collection="about", generation=CollectionGeneration.get("about")
+        )
+    finally:
+        ResponseCache.clear()
+        get_settings.cache_clear()
+
+
+def test_semantic_cache_threshold_and_invalidation(monkeypatch):
+    monkeypatch.setenv("BOT_CACHE_PATH", "")
+    monkeypatch.setenv("BOT_SEMANTIC_CACHE_SIZE", "2")
+    get_settings.cache_clear()
+    try:
+        q1 = SemanticCache.normalize([1.0, 0.0, 0.0])
+        q2 = SemanticCache.normalize([0.0, 1.0, 0.0])
+        SemanticCache.store("aboutme", "m", "who", q1, "answer one")
+        SemanticCache.store("aboutme", "m", "what", q2, "answer two")
+        near = SemanticCache.normalize([0.99, 0.05, 0.0])
+        assert SemanticCache.lookup("aboutme", "m", near)[0] == "answer one"
+        assert SemanticCache.lookup("aboutme", "m", SemanticCache.normalize([1, 1, 0]))[0] is None  # noqa: E501
+
+        SemanticCache.store("aboutme", "m", "new", SemanticCache.normalize([0, 0, 1]), "three")  # noqa: E501
+        assert SemanticCache.stats()["evictions"] >= 1
+
+        CollectionGeneration.bump("aboutme")
+        assert SemanticCache.lookup("aboutme", "m", near)[0] is None
+    finally:
+        SemanticCache.clear()
+        get_settings.cache_clear()
+
+
+def test_single_flight_replays_for_late_subscriber():
+    async def upstream():
+        for x in ["a", "b", "c"]:
+            await sleep(0.01)
+            yield x
+
+    async def answer():
+        return "abc"
+
+    async def scenario():
+        leader, is_leader = SingleFlight.join("same-question")
+        follower, is_follower_leader = SingleFlight.join("same-question")
+        assert is_leader and not is_follower_leader and leader is follower
+        leader.upstream = create_task(answer())
+        leader.task = create_task(leader.pump(upstream()))
+        first = [x async for x in leader.subscribe()]
+        late = [x async for x in follower.subscribe()]  # after completion
+        await leader.task
+        return first, late, leader.result
+
+    assert run(scenario()) == (["a", "b", "c"], ["a", "b", "c"], "abc")
+    assert SingleFlight.stats()["in_flight"] == 0
+
+
+def streaming_bot(first_token_after: float):
+    """BaseOpenAI streaming from a fake generation, cancellation recorded"""
+    usages, cancelled = [], []
+    bot = BaseOpenAI(streaming=True, hedge=False, trace_func=usages.append)
+
+    async def generate():
+        try:
+            await sleep(first_token_after)
+            for x in range(100):
+                await bot.async_callback.on_llm_new_token(f"t{x} ")
+                await sleep(0.01)
+            return "done"
+        except CancelledError:
+            cancelled.append(True)
+            raise
+
+    return bot, generate, usages, cancelled
+
+
+def test_stream_disconnect_mid_stream_cancels_upstream():
+    bot, generate, usages, cancelled = streaming_bot(0)
+    checks = []
+
+    async def is_disconnected():
+        checks.append(True)
+        return len(checks) > 1  # after the first chunk
+
+    async def scenario():
+        chunks = [x async for x in bot.stream_tokens(generate(), "mid-stream", is_disconnected)]  # noqa: E501
+        await sleep(0.05)
+        return chunks
+
+    assert len(run(scenario())) == 1
+    assert cancelled == [True]
+    assert usages[-1]["cancelled"] and usages[-1]["upstream_cancelled"]
+    assert 1 <= usages[-1]["streamed_tokens"] < 100
+    assert SingleFlight.stats()["in_flight"] == 0
+
+
+def test_stream_disconnect_before_first_token_cancels_upstream():
+    bot, generate, usages, cancelled = streaming_bot(5)
+
+    async def scenario():
+        async def consume():
+            return [x async for x in bot.stream_tokens(generate(), "no-token")]  # noqa: E501
+
+        client = create_task(consume())
+        await sleep(0.05)
+        client.cancel()  # as starlette on disconnect
+        try:
+            await client
+        except CancelledError:
+            pass
+        await sleep(0.05)
+
+    started = monotonic()
+    run(scenario())
+    assert monotonic() - started < 1  # upstream not awaited
+    assert cancelled == [True]
+    assert usages[-1]["cancelled"] and usages[-1]["upstream_cancelled"]
+    assert usages[-1]["streamed_tokens"] == 0
+    assert SingleFlight.stats()["in_flight"] == 0
+
+
+def test_agent_stream_cancelled_on_disconnect(monkeypatch):
+    monkeypatch.setattr(DocumentQAMultiple, "DISCONNECT_POLL", 0.01)
+    usages, cancelled = [], []
+    agent = DocumentQAMultiple.__new__(DocumentQAMultiple)
+    BaseOpenAI.__init__(agent, streaming=True, trace_func=usages.append)
+
+    async def slow_agent(question):
+        try:
+            await sleep(5)
+        except CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def is_disconnected():
+        return True
+
+    async def scenario():
+        agent.aask_agent = slow_agent
+        chunks = [x async for x in agent.agent_stream("why?", is_disconnected)]  # noqa: E501
+        await sleep(0.01)
+        return chunks
+
+    assert run(scenario()) == [] and cancelled == [True]
+    assert usages[-1]["cancelled"]
+
+    async def failing_agent(question):
+        raise ValueError("could not parse LLM output")
+
+    async def failed():
+        agent.aask_agent = failing_agent
+        return [x async for x in agent.agent_stream("why?")]
+
+    assert run(failed()) == []  # stream ends, no exception
+    assert usages[-1]["error"] == "could not parse LLM output"
+
+
+def test_embedding_cache_tiers(monkeypatch):
+    """same question (modulo whitespace) is embedded once, also after restart"""
+    monkeypatch.setenv("BOT_EMBEDDING_CACHE_PERSIST", "true")
+    get_settings.cache_clear()
+    calls = []
+
+    class Counting:
+        def embed_query(self, text):
+            calls.append(text)
+            return [0.5, 0.25]
+
+    try:
+        embeddings = CachedEmbeddings(Counting(), "fake-model")
+        assert embeddings.embed_query("who is  Yan?") == [0.5, 0.25]
+        assert embeddings.embed_query(" who is Yan? ") == [0.5, 0.25]
+        EmbeddingCache.clear()  # memory only, as in a fresh worker
+        assert embeddings.embed_query("who is Yan?") == [0.5, 0.25]
+        assert len(calls) == 1
+        stats = EmbeddingCache.stats()
+        assert stats["hits_memory"] >= 1 and stats["hits_disk"] >= 1
+        with connect(f"{get_settings().CACHE_PATH}/cache.db") as conn:
+            stored = conn.execute("SELECT * FROM query_vectors").fetchall()
+        assert len(stored) == 1 and "Yan" not in str(stored)
+    finally:
+        EmbeddingCache.clear()
+
+
+def test_chunk_embedding_cache_embeds_only_new_chunks(monkeypatch):
+    monkeypatch.setattr(ChunkEmbeddingCache, "MAX_KEYS", 2)  # several SELECTs
+    calls, recorded = [], []
+
+    class Counting:
+        BATCH_SIZE = 2  # texts per API call
+
+        def embed_documents(self, texts):
+            calls.append(texts)
+            return [[float(len(x)), 0.5] for x in texts]
+
+    before = ChunkEmbeddingCache.stats()
+    embeddings = CachedEmbeddings(Counting(), "fake-model", on_record=lambda *x: recorded.append(x))  # noqa: E501
+    assert embeddings.embed_documents(["a", "bb"]) == [[1.0, 0.5], [2.0, 0.5]]  # noqa: E501
+    assert embeddings.embed_documents(["bb", "ccc", "a"]) == [[2.0, 0.5], [3.0, 0.5], [1.0, 0.5]]  # noqa: E501
+    embeddings.embed_documents(["a", "ccc", "bb"])
+    assert calls == [["a", "bb"], ["ccc"]]
+    assert recorded == [(0, 0), (2, 1), (3, 2)]  # (hits, API calls saved)
+    assert CachedEmbeddings(Counting(), "other-model").embed_documents(["a"])  # noqa: E501
+    assert calls[-1] == ["a"]
+    stats = ChunkEmbeddingCache.stats()
+    assert stats["hits"] - before["hits"] == 5
+    assert stats["calls_saved"] - before["calls_saved"] == 3
+
+
+def test_hedging_takes_first_backend_to_stream():
+    """primary is silent beyond the delay, the alternate streams and wins"""
+    async def generate(callback, first_token_after):
+        try:
+            await sleep(first_token_after)
+            for x in ["a", "b"]:
+                await callback.on_llm_new_token(x)
+                await sleep(0.01)
+            return "ab"
+        finally:
+            callback.done.set()
+
+    def racer(backend, first_token_after):
+        callback = AsyncIteratorCallbackHandler()
+        task = create_task(generate(callback, first_token_after))
+        return Racer(backend, task, callback)
+
+    async def scenario():
+        flight, _ = SingleFlight.join("")
+        primary = racer("openai", 5)
+        flight.upstream, usage = primary.task, {}
+        tokens = Hedging.tokens(
+            flight, primary, lambda: racer("azure", 0), 0.05, usage
+        )
+        flight.task = create_task(flight.pump(tokens))
+        await flight.task
+        await sleep(0)
+        return flight.tokens, flight.result, usage, primary.task.cancelled()
+
+    tokens, result, usage, loser_cancelled = run(scenario())
+    assert tokens == ["a", "b"] and result == "ab" and loser_cancelled
+    assert usage == {"hedged": True, "hedge_winner": "azure"}
+    assert Hedging.stats()["wins"]["azure"] >= 1
+
+
+def test_context_packer_overlap_duplicates_budget():
+    shared = "the overlapping sentence between two chunks. "
+    first = "intro words " * 20 + shared
+    second = shared + "closing words " * 20
+    docs = [
+        Document(page_content=first, metadata={"source": "a", "tokens": 50}),
+        Document(page_content=second, metadata={"source": "a", "tokens": 50}),  # noqa: E501
+        Document(page_content=first + "!", metadata={"source": "b", "tokens": 50}),  # noqa: E501
+        Document(page_content="unrelated " * 100, metadata={"tokens": 100}),
+    ]
+    packed, stats = ContextPacker.pack(docs, budget=150)
+    assert [x.metadata.get("source") for x in packed] == ["a", "a"]
+    assert not packed[1].page_content.startswith(shared.strip())
+    assert stats["raw_tokens"] == 250 and stats["packed_tokens"] <= 150
+    assert stats["duplicates"] == 1 and stats["overlaps"] == 1
+
+
+def test_hybrid_retrieval_fuses_bm25_and_knn():
+    """a hit found by both queries ranks above single-query hits"""
+    def hit(id):
+        return {"_id": id, "_source": {"text": id, "metadata": {}}}
+
+    class FakeStore:
+        index_name, query_field, vector_query_field = "logs", "text", "vector"  # noqa: E501
+
+        class embedding:
+            async def aembed_query(text):
+                return [1.0, 0.0]
+
+        class client:
+            def search(index, size, source, query=None, knn=None):
+                ids = ["E1234", "both", "x"] if query else ["both", "y", "z"]
+                return {"hits": {"hits": [hit(x) for x in ids]}}
+
+    retriever = HybridRetriever.construct(store=FakeStore, k=3, fetch_k=3, rrf_k=60)  # noqa: E501
+    docs = run(retriever.ainvoke("error E1234"))
+    assert [x.page_content for x in docs] == ["both", "E1234", "y"]
+
+
+def test_mmr_prefers_diverse_candidates(monkeypatch):
+    query = [1.0, 0.0, 0.0]
+    vectors = [[1.0, 0.1, 0.0], [1.0, 0.11, 0.0], [0.7, 0.0, 0.7]]
+    assert Reranking.mmr(query, vectors, k=2, lambda_mult=1.0) == [0, 1]
+    assert Reranking.mmr(query, vectors, k=2, lambda_mult=0.5) == [0, 2]
+
+    monkeypatch.setenv("BOT_MMR_COLLECTIONS", '{"log-": {"lambda": 0.3}}')
+    get_settings.cache_clear()
+    try:
+        assert Reranking.params("log-rolling")["lambda"] == 0.3
+        assert Reranking.params("aboutme")["lambda"] == 0.5
+    finally:
+        get_settings.cache_clear()
+
+
+def test_knn_index_options_recorded_and_read(monkeypatch):
+    monkeypatch.setenv("BOT_CACHE_PATH", "")
+    monkeypatch.setenv("BOT_ES_KNN_COLLECTIONS", '{"log-": {"index_type": "int8_hnsw"}}')  # noqa: E501
+    get_settings.cache_clear()
+    try:
+        options = KnnIndex.options("log-rolling", num_candidates=40, m=0)
+        assert options["index_type"] == "int8_hnsw" and options["m"] == 16
+        mappings = KnnIndex.mappings(options)
+        assert mappings["properties"]["vector"]["index_options"]["type"] == "int8_hnsw"  # noqa: E501
+        with raises(ValueError):
+            KnnIndex.options("log-rolling", index_type="int3_hnsw")
+
+        class FakeIndices:
+            def get_mapping(self, index):
+                return {index: {"mappings": mappings}}
+
+        class FakeStore:
+            client = type("FakeClient", (), {"indices": FakeIndices()})
+            index_name = "log-rolling"
+
+        assert KnnIndex.num_candidates(FakeStore, 4) == 40
+        assert KnnIndex.num_candidates(FakeStore, 50) == 50
+
+        class Unreachable:
+            calls = 0
+
+            def get_mapping(self, index):
+                Unreachable.calls += 1
+                raise ConnectionError("down")
+
+        class DownStore:
+            client = type("FakeClient", (), {"indices": Unreachable()})
+            index_name = "log-down"
+
+        assert KnnIndex.num_candidates(DownStore, 4) == get_settings().ES_KNN_NUM_CANDIDATES  # noqa: E501
+        KnnIndex.num_candidates(DownStore, 4)
+        assert Unreachable.calls == 1  # defaults cached for FAILURE_TTL
+    finally:
+        get_settings.cache_clear()
+
+
+def test_federated_retrieval_merges_by_score():
+    class FakeStore:
+        def __init__(self, scores):
+            self.scores = scores
+
+        def similarity_search_by_vector_with_relevance_scores(self, vector, k):  # noqa: E501
+            return [(Document(page_content=str(x)), x) for x in self.scores]
+
+        def _select_relevance_score_fn(self):
+            return lambda x: x
+
+    class FakeEmbeddings:
+        async def aembed_query(self, text):
+            return [1.0]
+
+    retriever = FederatedRetriever.construct(
+        stores={"logs": FakeStore([0.9, 0.5]), "code": FakeStore([0.8, 0.7])},
+        embeddings=FakeEmbeddings(),
+        k=3,
+    )
+    docs = run(retriever.ainvoke("why did it fail?"))
+    assert [(x.page_content, x.metadata["collection"]) for x in docs] == [
+        ("0.9", "logs"), ("0.8", "code"), ("0.7", "code")
+    ]
+
+
+def test_ingestion_job_reports_progress_and_errors():
+
+    async def ingest(files: int):
+        for _ in range(files):
+            IngestionJobs.report(documents=1, chunks=3)
+        IngestionJobs.report(embeddings=3 * files)
+        return ["a.log"]
+
+    def wait(job_id: str) -> dict:
+        start = monotonic()
+        while IngestionJobs.get(job_id)["status"] in ["queued", "running"]:
+            assert monotonic() - start < 5
+        return IngestionJobs.get(job_id)
+
+    job = wait(IngestionJobs.submit("log", "log-test", ingest, files=2)["id"])  # noqa: E501
+    assert (job["status"], job["documents"], job["chunks"], job["embeddings"]) == ("done", 2, 6, 6)  # noqa: E501
+    assert job["result"] == ["a.log"] and job["elapsed"] >= 0
+
+    failed = wait(IngestionJobs.submit("log", "log-test", ingest, days=1)["id"])  # noqa: E501
+    assert failed["status"] == "failed" and "days" in failed["error"]
+    assert [x["id"] for x in IngestionJobs.recent(2)] == [failed["id"], job["id"]]  # noqa: E501
+    assert job["id"] not in IngestionJobs._local
+
+
+def test_ingestion_jobs_trimmed_and_orphans_failed(monkeypatch):
+    monkeypatch.setenv("BOT_INGEST_JOBS_KEPT", "2")
+    get_settings.cache_clear()
+    dead = Popen(["true"])
+    dead.wait()
+    for i, status in enumerate(["done", "done", "running"]):
+        IngestionJobs.save({"id": f"j{i}", "created": i, "status": status, "worker": dead.pid})  # noqa: E501
+    assert [x["id"] for x in IngestionJobs.recent(5)] == ["j2", "j1", "j0"]
+
+    monkeypatch.setattr(IngestionJobs, "_pool", None)
+    IngestionJobs.pool().shutdown()
+    orphan = IngestionJobs.get("j2")
+    assert orphan["status"] == "failed" and str(dead.pid) in orphan["error"]
+    assert [x["id"] for x in IngestionJobs.recent(5)] == ["j2", "j1"]
+    assert not {"j0", "j1", "j2"} & set(IngestionJobs._local)
+
+
+def test_log_tail_reads_new_lines_and_rotations(tmp_path):
+    log = tmp_path / "app.log"
+
+    def run() -> str:
+        with LogTail("log-test") as tail:
+            text = "".join(x.page_content for x in tail.update([str(log)]).blocks(8))  # noqa: E501
+            tail.save()
+        return text
+
+    log.write_text("a 1\nb 2\nc")
+    assert run() == "a 1\nb 2\n"  # partial line waits
+    with open(log, "a") as f:
+        f.write(" 3\n")
+    assert run() == "c 3\n"
+    assert run() == ""
+    log.rename(tmp_path / "app.1.log")
+    log.write_text("d 4\n")  # rotated: new inode
+    assert run() == "d 4\n"
+    with LogTail("log-test") as tail, LogTail("log-test") as other:
+        assert tail.locked and not other.locked
+
+
+def test_log_templates_count_lines_per_template_and_bucket():
+    miner = LogTemplates(similarity=0.5, bucket=3600)
+    lines = [
+        "2023-10-12 10:00:01 request 17 took 5 ms on worker 1",
+        "2023-10-12 10:20:00 request 99 took 12 ms on worker 3",
+        "2023-10-12 10:30:00 cache miss for key abc",
+        "2023-10-12 11:05:00 request 5 took 7 ms on worker 2",
+    ]
+    docs = list(miner.documents([Document(page_content="\n".join(lines), metadata={"source": "a.log"})]))  # noqa: E501
+    assert [(x.metadata["template"], x.metadata["count"]) for x in docs] == [
+        ("<*> <*> request <*> took <*> ms on worker <*>", 2),
+        ("<*> <*> request <*> took <*> ms on worker <*>", 1),
+        ("<*> <*> cache miss for key abc", 1),
+    ]
+    assert "seen 2 times from 2023-10-12 10:00:01 to 2023-10-12 10:20:00" in docs[0].page_content  # noqa: E501
+    assert docs[0].metadata["embed_text"].endswith(lines[0])
+
+    resumed = LogTemplates(miner.state(), similarity=0.5, bucket=3600)
+    again = list(resumed.documents([Document(page_content=lines[1])]))
+    assert len(again) == 1 and again[0].metadata["id"] == docs[0].metadata["id"]  # noqa: E501
+    assert again[0].metadata["count"] == 3
+
+
+def test_local_vector_store_exact_top_k_and_rebuild(tmp_path):
+    class FakeEmbeddings:
+        def embed_documents(self, texts):
+            return [[float(x == text) for x in "abc"] for text in texts]
+
+    path = f"{tmp_path}/about"
+    store = LocalVectorStore.from_texts(
+        ["a", "b", "c"], FakeEmbeddings(), [{"i": i} for i in range(3)], path=path  # noqa: E501
+    )
+    hits = store.similarity_search_by_vector_with_relevance_scores([0.1, 1, 0.5], k=2)  # noqa: E501
+    assert [(x.page_content, x.metadata["i"]) for x, _ in hits] == [("b", 1), ("c", 2)]  # noqa: E501
+    assert 0.5 < hits[1][1] < hits[0][1] <= 1.0
+
+    searching = LocalVectorStore.open(path)  # held by a search in progress
+    LocalVectorStore.from_texts(["c"], FakeEmbeddings(), path=path)  # swapped in
+    assert store.similarity_search_by_vector([1, 0, 0], k=4)[0].page_content == "c"  # noqa: E501
+    assert store.documents([1], searching)[0].page_content == "b"  # still open
+    LocalVectorStore.close(path)
+
+
+def test_two_tier_pools_by_tokens_and_filters_chunks():
+    chunks = [
+        Document(page_content="a", metadata={"source": "x", "tokens": 3}),
+        Document(page_content="b", metadata={"source": "x", "tokens": 1}),
+        Document(page_content="c", metadata={"source": "y", "tokens": 5}),
+    ]
+    pooled = DocumentPooling.add({}, chunks[:1], [[1, 0]])
+    pooled = DocumentPooling.add(pooled, chunks[1:], [[0, 1], [0, 1]])
+    _, pooled, metadatas = DocumentPooling.documents(pooled)
+    assert pooled[0][0] > 2.9 * pooled[0][1]  # 3:1 by tokens, normalized
+    assert [x["chunks"] for x in metadatas] == [2, 1]
+
+    class FakeStore:
+        filters = []
+
+        def similarity_search_by_vector_with_relevance_scores(self, vector, k, filter=None):  # noqa: E501
+            self.filters.append(filter)
+            return [(Document(page_content="", metadata={"source": "y"}), 1.0)]  # noqa: E501
+
+    retriever = TwoTierRetriever.construct(
+        documents=FakeStore(), chunks=FakeStore(), k=4, top_documents=5, search_kwargs={}  # noqa: E501
+    )
+    retriever.search([1.0, 0.0])
+    assert FakeStore.filters[-1] == [{"terms": {"metadata.source.keyword": ["y"]}}]  # noqa: E501
+
+
+def test_two_tier_appends_repool_whole_source():
+    """two appends to one source pool as a single ingestion of all chunks"""
+    index = []
+
+    def append(texts, vectors, tokens):
+        for text, vector, n in zip(texts, vectors, tokens):
+            index.append({"_source": {
+                "text": text,
+                "vector": vector,
+                "metadata": {"source": "app.log", "tokens": n},
+            }})
+        return DocumentPooling.documents(DocumentPooling.from_hits(index))
+
+    append(["a"], [[1, 0]], [3])
+    _, vectors, metadatas = append(["b", "c"], [[0, 1], [0, 1]], [1, 2])
+    assert metadatas == [{"source": "app.log", "chunks": 3, "tokens": 6}]
+    assert abs(vectors[0][0] - vectors[0][1]) < 1e-6  # 3 tokens each way
+    chunks = [
+        Document(page_content=x, metadata={"source": "app.log", "tokens": n})
+        for x, n in zip("abc", [3, 1, 2])
+    ]
+    once = DocumentPooling.add({}, chunks, [[1, 0], [0, 1], [0, 1]])
+    assert vectors == DocumentPooling.documents(once)[1]
+
+
+def test_retrieval_cache_invalidated_by_generation(monkeypatch):
+
+    monkeypatch.setenv("BOT_CACHE_PATH", "")
+    get_settings.cache_clear()
+    calls = []
+
+    class Counting(BaseRetriever):
+        def _get_relevant_documents(self, query, *, run_manager):
+            calls.append(query)
+            return [Document(page_content="chunk")]
+
+    class FakeEmbeddings:
+        def embed_query(self, text):
+            return [1.0, 2.0]
+
+    try:
+        retriever = CachedRetriever.construct(
+            retriever=Counting(), embeddings=FakeEmbeddings(),
+            collections=["logs"], params={},
+        )
+        retriever.invoke("q")
+        assert retriever.invoke("q")[0].page_content == "chunk"
+        CollectionGeneration.bump("logs")
+        retriever.invoke("q")
+        assert len(calls) == 2
+        assert RetrievalCache.stats()["stale"] >= 1
+    finally:
+        RetrievalCache.clear()
+        get_settings.cache_clear()
+
+
+def fake_llm(delay: float = 0.05, calls: list = None):
+    """ChatOpenAI on a local fake provider, calls record (active, peak)"""
+    calls = calls if calls is not None else []
+    active = [0]
+
+    async def reply(request):
+        active[0] += 1
+        calls.append(active[0])
+        await sleep(delay)
+        active[0] -= 1
+        return Response(200, json={
+            "id": "1", "object": "chat.completion", "created": 0, "model": "fake",  # noqa: E501
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "extract"}}],  # noqa: E501
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},  # noqa: E501
+        })
+
+    return ChatOpenAI(
+        model_name="fake", openai_api_key="x", max_retries=0,
+        http_async_client=AsyncClient(transport=MockTransport(reply)),
+    )
+
+
+def fake_document_qa(llm, docs: list, chain_type: str = "auto") -> DocumentQA:  # noqa: E501
+    """DocumentQA on a fixed retriever, without a vector store"""
+    class Fixed(BaseRetriever):
+        def _get_relevant_documents(self, query, *, run_manager):
+            return docs
+
+    qa = DocumentQA.__new__(DocumentQA)
+    BaseOpenAI.__init__(qa, temperature=0, trace_func=lambda x: None)
+    qa.llm, qa.retriever = llm, Fixed()
+    qa.include_source, qa.question_vector = False, None
+    qa.chain_type, qa.retrieval = chain_type, "vector"
+    qa.qa = qa.build_chain(llm)
+    return qa
+
+
+def test_map_reduce_bounded_concurrency_and_auto_selection(monkeypatch):
+    monkeypatch.setenv("BOT_MAP_CONCURRENCY", "2")
+    monkeypatch.setenv("BOT_CONTEXT_TOKEN_BUDGET", "50")
+    get_settings.cache_clear()
+    docs = [Document(page_content=f"chunk {x} " * 20) for x in range(6)]
+
+    calls = []
+    qa = fake_document_qa(fake_llm(calls=calls), docs)
+    assert run(qa.aask("what about the chunks?"))["response"] == "extract"
+    assert qa.usage_extra["chain_type"] == "map_reduce"  # over the budget
+    assert len(calls) == 7 and max(calls) == 2  # 6 map calls, 1 reduce
+
+    calls.clear()
+    qa = fake_document_qa(fake_llm(calls=calls), docs[:1])
+    run(qa.aask("what about one chunk?"))
+    assert qa.usage_extra["chain_type"] == "stuff" and len(calls) == 1
+
+
+def test_aask_does_not_block_the_event_loop():
+    """a ticker keeps running while aask waits on the provider"""
+    docs = [Document(page_content="Yan lives in Helsinki")]
+    qa = fake_document_qa(fake_llm(delay=0.3), docs, chain_type="stuff")
+
+    async def scenario():
+        await qa.aask("warm up")  # one-off lazy loading, e.g. tokenizers
+        gaps, running = [], True
+
+        async def ticker():
+            while running:
+                started = monotonic()
+                await sleep(0.01)
+                gaps.append(monotonic() - started)
+
+        task = create_task(ticker())
+        started = monotonic()
+        answer = await qa.aask("where does Yan live?")
+        elapsed = monotonic() - started
+        running = False
+        await task
+        return answer, elapsed, gaps
+
+    answer, elapsed, gaps = run(scenario())
+    assert answer["response"] == "extract" and elapsed >= 0.3
+    assert len(gaps) >= 10 and max(gaps) < 0.1
+
+
+def test_model_router_thresholds():
+    small, large = "gpt-4o-mini", "gpt-4o"
+    assert ModelRouter.choose("what is your email?")[0] == small
+    assert ModelRouter.choose("why and how does X compare to Y?")[0] == large
+    assert ModelRouter.choose("word " * 2000)[1].startswith("question tokens")  # noqa: E501
+    assert ModelRouter.choose("print(1)", kind="code")[0] == small
+
+
+def test_scheduler_honors_retry_after_from_fake_provider(monkeypatch):
+    """local fake provider answers 429 once, then succeeds"""
+    replies = [
+        Response(429, headers={"retry-after": "0.2"}, json={"error": {"message": "slow down"}}),  # noqa: E501
+        Response(200, json={
+            "id": "1", "object": "chat.completion", "created": 0, "model": "fake",  # noqa: E501
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],  # noqa: E501
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},  # noqa: E501
+        }),
+    ]
+    http_clients = ClientRegistry.http_clients
+
+    def fake_provider(model):
+        """pooled clients of the registry, on the fake provider"""
+        _, ahook = ProviderScheduler.response_hooks(model)
+        return {**http_clients(model), "http_async_client": AsyncClient(
+            transport=MockTransport(lambda request: replies.pop(0)),
+            event_hooks={"response": [ahook]},
+        )}
+
+    monkeypatch.setattr(ClientRegistry, "http_clients", fake_provider)
+    ClientRegistry.clear()
+    try:
+        llm = ClientRegistry.get_chat(model_name="fake")
+        assert llm.max_retries == 0  # no retries outside the scheduler
+        assert ClientRegistry.get_embeddings().embeddings.embeddings.max_retries == 0  # noqa: E501
+
+        async def call():
+            return await ProviderScheduler.run("fake", lambda: llm.ainvoke("hi"))  # noqa: E501
+
+        start = monotonic()
+        assert run(call()).content == "ok"
+        assert monotonic() - start >= 0.2
+        assert ProviderScheduler.stats()["fake"]["throttled"] >= 1
+        assert not replies
+    finally:
+        ClientRegistry.clear()
+
+
+def test_scheduler_admits_once_per_request(monkeypatch):
+    """a retry after a 429 is not rejected by a queue filled meanwhile"""
+    attempts = []
+
+    class Throttled(Exception):
+        response = Response(429, headers={"retry-after": "0.05"})
+
+    async def make_call():
+        attempts.append(True)
+        if len(attempts) == 1:
+            monkeypatch.setenv("BOT_RATE_LIMIT_QUEUE_DEPTH", "0")  # full now
+            get_settings.cache_clear()
+            raise Throttled()
+        return "ok"
+
+    assert run(ProviderScheduler.run("fake-admit", make_call)) == "ok"
+    assert len(attempts) == 2
+
+
+def test_scheduler_rejects_when_queue_full(monkeypatch):
+    monkeypatch.setenv("BOT_RATE_LIMIT_QUEUE_DEPTH", "0")
+    get_settings.cache_clear()
+    try:
+        with raises(RateLimitRejected):
+            ProviderScheduler.admit("fake-full", "bulk")
+    finally:
+        get_settings.cache_clear()